@@ -0,0 +1,218 @@
+import threading
+import time
+from functools import wraps
+from flask import g, request
+
+from json_provider import jsonify
+from metrics import Counter, Gauge, Histogram
+
+# Route classes with their own concurrency limits, so slow searches and
+# writes can't take every worker thread from the cheap reads
+ROUTE_CLASSES = ('read', 'heavy', 'write')
+
+# Endpoints doing more work than a paginated list or a detail lookup
+HEAVY_ENDPOINTS = frozenset((
+    'search_students',
+    'search_instructors',
+    'retrieve_course_students',
+    'retrieve_instructor_dashboard',
+    'retrieve_profile',
+    'run_batch',
+    'retrieve_top_students',
+    'retrieve_students_at_risk',
+    'retrieve_course_correlations',
+))
+
+# Always admitted (monitoring must keep working under overload)
+EXEMPT_ENDPOINTS = frozenset(('retrieve_metrics', 'static'))
+
+WRITE_METHODS = frozenset(('POST', 'PATCH', 'PUT', 'DELETE'))
+
+# Per worker, below its 16 gthread threads (gunicorn.conf.py). A waiting
+# request holds a thread too, so the queues are short.
+DEFAULT_LIMITS = {'read': 8, 'heavy': 2, 'write': 4}
+DEFAULT_QUEUES = {'read': 4, 'heavy': 2, 'write': 2}
+
+IN_FLIGHT = Gauge(
+    'cms_admission_in_flight',
+    'Requests being served, by route class.')
+QUEUE_DEPTH = Gauge(
+    'cms_admission_queue_depth',
+    'Requests waiting for a slot, by route class.')
+WAIT = Histogram(
+    'cms_admission_wait_seconds',
+    'Time admitted requests waited for a slot, by route class.')
+SHED = Counter(
+    'cms_admission_shed_total',
+    'Requests rejected with 503, by route class and reason (queue_full, '
+    'timeout or deadline).')
+
+
+def route_class(endpoint, methods):
+    # Returns the route class of an endpoint, or None when it is exempt
+    if endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if endpoint in HEAVY_ENDPOINTS:
+        return 'heavy'
+    if methods & WRITE_METHODS:
+        return 'write'
+    return 'read'
+
+
+def parse_limits(value, defaults):
+    '''
+    parse_limits(value, defaults) method
+        @INPUTS
+                value: "class=n,class=n" (e.g. "read=32,heavy=4") or None
+                defaults: limits of the classes not listed
+    '''
+    # Raises ValueError on unknown classes or invalid numbers
+    limits = dict(defaults)
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        name, _, number = item.partition('=')
+        name = name.strip()
+        if name not in ROUTE_CLASSES:
+            raise ValueError('Unknown route class: {0}'.format(name))
+        limits[name] = int(number)
+    return limits
+
+
+def request_start(header):
+    # Parses X-Request-Start (set by the Heroku router in ms, or by nginx
+    # as "t=<seconds>") into a time.time() timestamp
+    if not header:
+        return None
+    try:
+        value = float(header.strip().lstrip('t='))
+    except ValueError:
+        return None
+    return value / 1000 if value > 1e11 else value
+
+
+class Limiter:
+    '''
+    Limiter
+    Admits at most `limit` concurrent requests; up to `max_queue` more wait
+    for a slot until their deadline
+    '''
+
+    def __init__(self, name, limit, max_queue, clock=time.monotonic):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.clock = clock
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+        IN_FLIGHT.set_function(lambda: self.in_flight, route_class=name)
+        QUEUE_DEPTH.set_function(lambda: self.waiting, route_class=name)
+
+    def acquire(self, timeout):
+        '''
+        acquire(timeout) method
+            @INPUTS
+                    timeout: seconds the request may wait for a slot
+        '''
+        # Returns None once admitted, or the reason the request is shed
+        with self._condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return None
+            if timeout <= 0:
+                return 'deadline'
+            if self.waiting >= self.max_queue:
+                return 'queue_full'
+
+            deadline = self.clock() + timeout
+            self.waiting += 1
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return 'timeout'
+                    self._condition.wait(remaining)
+                self.in_flight += 1
+                return None
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+def overloaded(retry_after):
+    response = jsonify({
+        "success": False,
+        "error": 503,
+        "message": "Server is busy, retry later"
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def admit(limiter, view, queue_timeout, retry_after):
+    # Wraps a view function with its route class's limiter
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # POST /batch sub-requests run within the batch's slot
+        if g.get('admitted'):
+            return view(*args, **kwargs)
+
+        # Time already spent in the router and gunicorn backlog counts
+        # towards the deadline
+        timeout = queue_timeout
+        started = request_start(request.headers.get('X-Request-Start'))
+        if started is not None:
+            timeout = min(timeout, started + queue_timeout - time.time())
+
+        waited = time.perf_counter()
+        reason = limiter.acquire(timeout)
+        if reason is not None:
+            SHED.inc(route_class=limiter.name, reason=reason)
+            return overloaded(retry_after)
+        WAIT.observe(time.perf_counter() - waited,
+                     route_class=limiter.name)
+
+        g.admitted = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g.admitted = False
+            limiter.release()
+
+    return wrapper
+
+
+def init_app(app):
+    # Wraps the registered view functions with per route class concurrency
+    # limits (ADMISSION_ENABLED). Called once every route is defined.
+    app.config.setdefault('ADMISSION_ENABLED', True)
+    app.config.setdefault('ADMISSION_LIMITS', None)
+    app.config.setdefault('ADMISSION_QUEUE', None)
+    app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 5.0)
+    app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+    if not app.config['ADMISSION_ENABLED']:
+        return
+
+    limits = parse_limits(app.config['ADMISSION_LIMITS'], DEFAULT_LIMITS)
+    queues = parse_limits(app.config['ADMISSION_QUEUE'], DEFAULT_QUEUES)
+    limiters = app.extensions['admission'] = {
+        name: Limiter(name, limits[name], queues[name])
+        for name in ROUTE_CLASSES}
+
+    methods = {}
+    for rule in app.url_map.iter_rules():
+        methods.setdefault(rule.endpoint, set()).update(rule.methods)
+    for endpoint, view in list(app.view_functions.items()):
+        name = route_class(endpoint, methods.get(endpoint, set()))
+        if name is not None:
+            app.view_functions[endpoint] = admit(
+                limiters[name], view,
+                app.config['ADMISSION_QUEUE_TIMEOUT'],
+                app.config['ADMISSION_RETRY_AFTER'])
@@ -1,12 +1,35 @@
+import hmac
+import io
 import os
-import json
-import requests
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_cors import CORS
 
-from models import setup_db, Student, Instructor, Course, Grade
-from auth import AuthError, requires_auth
+from flask import Flask, request, abort, send_file, g
+
+from models import setup_db, db, Student, Instructor, Course, ReportJob
+from auth import AuthError, requires_auth, get_userinfo, parse_auth_header
+from json_provider import jsonify
+import json_provider
+import compression
+import metrics
+import instrumentation
+import query_audit
+import profiling
+import cache
+import coherence
+import batch
+import admission
+import reports
+import terms
+import coalescing
+import gradebook
+from settings import get_settings
+from queries import (select_columns, format_rows, format_row, student_grades,
+                     instructor_courses, column_fields, parse_fields,
+                     course_roster, instructor_dashboard, parse_ids,
+                     students_grades, instructors_courses, enroll_student,
+                     enrollment_failure, update_score, unenroll_student,
+                     find_enrollment,
+                     SHORT_COLUMNS, LONG_COLUMNS, STUDENT_DETAIL_FIELDS,
+                     INSTRUCTOR_DETAIL_FIELDS, ROSTER_SORTS)
 
 
 def get_error_message(error):
@@ -20,26 +43,227 @@ def get_error_message(error):
 
 
 data_per_page = 10
+max_per_page = 100
+max_batch_ids = 100
+max_batch_requests = 20
 
 
 def paginate_data(request, selection):
-    # Paginates and formats database queries
+    # Paginates a column query in SQL (OFFSET/LIMIT) and formats the rows
     page = request.args.get("page", 1, type=int)
+    if page < 1:
+        return []
     start = (page - 1) * data_per_page
-    end = start + data_per_page
 
-    data = [data.short() for data in selection]
-    current_data = data[start:end]
+    current_data = selection.offset(start).limit(data_per_page).all()
 
-    return current_data
+    return format_rows(current_data)
+
+
+def get_fields(request, allowed, default):
+    # Parses the comma separated ?fields= parameter and validates it against
+    # the allowed fields. Returns default when the parameter is absent.
+    try:
+        return parse_fields(request.args.get("fields", None), allowed, default)
+    except ValueError as error:
+        abort(400, {'message': str(error)})
+
+
+def get_include(request, allowed):
+    # Parses the comma separated ?include= parameter (related collections)
+    try:
+        return parse_fields(request.args.get("include", None), allowed, (),
+                            "include")
+    except ValueError as error:
+        abort(400, {'message': str(error)})
+
+
+def get_ids(request):
+    # Parses the comma separated ?ids= parameter of the batch lookups
+    try:
+        return parse_ids(request.args["ids"], max_batch_ids)
+    except ValueError as error:
+        abort(400, {'message': str(error)})
+
+
+def batch_details(model, ids, fields, include, message):
+    '''
+    batch_details(model, ids, fields, include, message) method
+        @INPUTS
+                model: Student or Instructor
+                ids: requested ids, in response order
+                fields: columns to return
+                include: (name, batch loader) of a related collection, or
+                         None
+                message: message of the entries of missing ids
+    '''
+    # Loads every record in one IN (...) query and the related collection
+    # in one more, then answers in request order
+    rows = select_columns(model, column_fields(fields)).filter(
+        model.id.in_(set(ids))).all()
+    found = {row.id: format_row(row) for row in rows}
+    if include is not None and found:
+        name, load = include
+        related = load(list(found))
+        for record_id, details in found.items():
+            details[name] = related[record_id]
+
+    return [found.get(record_id) or
+            {"id": record_id, "error": 404, "message": message}
+            for record_id in ids]
+
+
+def get_bounded(request, name, default, minimum, maximum, type=int):
+    # Parses a numeric query parameter and checks it is within bounds
+    value = request.args.get(name, default, type=type)
+    if not minimum <= value <= maximum:
+        abort(400, {'message': '{0} must be between {1} and {2}'.format(
+            name, minimum, maximum)})
+    return value
+
+
+def get_gradebook(app):
+    # This worker's gradebook; the analytics endpoints need numpy
+    book = gradebook.get_gradebook(app)
+    if book is None:
+        abort(503, {'message': 'Analytics are unavailable (numpy is not '
+                               'installed)'})
+    return book
+
+
+def column_values(model, column, ids):
+    # Returns {id: column value} of some rows in one IN (...) query
+    return dict(db.session.query(model.id, getattr(model, column)).filter(
+        model.id.in_(set(ids))).all()) if ids else {}
+
+
+def get_course(request):
+    # Returns the course title of an enrollment request body (matched case
+    # insensitively), or None
+    course = (request.get_json(silent=True) or {}).get("course", None)
+    return course if isinstance(course, str) else None
+
+
+def commit_enrollment_change(student_id, enrollment):
+    # Commits a single-statement enrollment write. It bypasses the ORM, so
+    # the cached documents it changes are marked for eviction here.
+    keys = {cache.student_key(student_id)}
+    if enrollment.instructor_id is not None:
+        keys.add(cache.dashboard_key(enrollment.instructor_id))
+    cache.mark_dirty(db.session, keys)
+    db.session.commit()
+
+
+def count_rows(model):
+    # Counts the rows of a table without loading them
+    return db.session.query(db.func.count(model.id)).scalar()
+
+
+def student_details(student, fields=STUDENT_DETAIL_FIELDS):
+    # Formats a student profile Row, adding the transcript only when the
+    # grades field is requested
+    student_details = format_row(student)
+    if "grades" in fields:
+        scores = coalescing.pending_scores([student.id])
+        student_details.update({"grades": coalescing.overlay(
+            student.id, format_rows(student_grades(
+                student.id, versions=bool(scores))), scores)})
+    return student_details
+
+
+def students_transcripts(student_ids):
+    # Transcripts of many students (?include=grades), with the pending score
+    # writes of every worker
+    scores = coalescing.pending_scores(student_ids)
+    grades = students_grades(student_ids, versions=bool(scores))
+    for student_id in grades:
+        coalescing.overlay(student_id, grades[student_id], scores)
+    return grades
+
+
+def cached_student_document(student_id, fields, build):
+    # Cached documents of other workers only learn of a coalesced score
+    # write when it is flushed, so they are bypassed until then
+    if coalescing.pending_scores([student_id]):
+        return build()
+    return cache.cached(cache.student_key(student_id), fields, build)
+
+
+def student_document(student, fields=STUDENT_DETAIL_FIELDS):
+    # Encoded GET /students/${id} response body (cached per student)
+    return json_provider.dumps(
+        {
+            "success": True,
+            "student_details": student_details(student, fields)
+        }
+    )
 
 
 def create_app(test_config=None):
     # Create and configure the app
     app = Flask(__name__)
     setup_db(app)
+    settings = get_settings()
+
+    # JSON encoder used by every response: "auto" (orjson when installed,
+    # stdlib otherwise), "orjson" or "stdlib"
+    app.config["JSON_BACKEND"] = settings.json_backend
+    # Responses smaller than COMPRESS_MIN_SIZE bytes are sent uncompressed
+    app.config["COMPRESS_MIN_SIZE"] = settings.compress_min_size
+    app.config["COMPRESS_LEVEL"] = settings.compress_level
+    app.config["COMPRESS_BR_LEVEL"] = settings.compress_br_level
+    # Logs N+1 statement patterns and slow queries (tests and staging)
+    app.config["QUERY_AUDIT_ENABLED"] = settings.query_audit_enabled
+    app.config["SLOW_QUERY_MS"] = settings.slow_query_ms
+    app.config["N_PLUS_ONE_THRESHOLD"] = settings.n_plus_one_threshold
+    # Encoded student and instructor detail documents, evicted when the
+    # rows they were built from change
+    app.config["DETAIL_CACHE_ENABLED"] = settings.detail_cache_enabled
+    app.config["DETAIL_CACHE_MAX_ENTRIES"] = settings.detail_cache_max_entries
+    app.config["DETAIL_CACHE_MAX_BYTES"] = settings.detail_cache_max_bytes
+    app.config["DETAIL_CACHE_TTL"] = settings.detail_cache_ttl
+    app.config["CACHE_NOTIFY_ENABLED"] = settings.cache_notify_enabled
+    # Term of the enrollments read and written by every endpoint
+    app.config["CURRENT_TERM"] = settings.current_term
+    # Score writes acknowledged once in the local write-ahead log, then
+    # applied in batches (see coalescing.py)
+    app.config["SCORE_COALESCING_ENABLED"] = settings.score_coalescing_enabled
+    app.config["SCORE_WAL_DIR"] = settings.score_wal_dir
+    app.config["SCORE_FLUSH_INTERVAL"] = settings.score_flush_interval
+    app.config["SCORE_FLUSH_MAX_ROWS"] = settings.score_flush_max_rows
+    # In-memory score matrix of the analytics endpoints (see gradebook.py)
+    app.config["GRADEBOOK_MAX_AGE"] = settings.gradebook_max_age
+    app.config["GRADEBOOK_PATCH_LIMIT"] = settings.gradebook_patch_limit
+    app.config["ADMISSION_ENABLED"] = settings.admission_enabled
+    app.config["ADMISSION_LIMITS"] = settings.admission_limits
+    app.config["ADMISSION_QUEUE"] = settings.admission_queue
+    app.config["ADMISSION_QUEUE_TIMEOUT"] = settings.admission_queue_timeout
+    app.config["ADMISSION_RETRY_AFTER"] = settings.admission_retry_after
+    # Bearer token Prometheus sends to /metrics (open when unset)
+    app.config["METRICS_TOKEN"] = settings.metrics_token
+    # Profiles taken with the profile:request permission are stored here;
+    # a rate above 0 also samples every worker continuously
+    app.config["PROFILE_DIR"] = settings.profile_dir
+    app.config["CONTINUOUS_PROFILING_RATE"] = \
+        settings.continuous_profiling_rate
+    app.config["CONTINUOUS_PROFILING_FLUSH"] = \
+        settings.continuous_profiling_flush
+    if test_config is not None:
+        app.config.update(test_config)
+    terms.init_app(app)
+    json_provider.init_app(app)
+    compression.init_app(app)
+    instrumentation.init_app(app)
+    query_audit.init_app(app)
+    profiling.init_app(app)
+    cache.init_app(app)
+    gradebook.init_app(app)
+    coherence.init_app(app)
+    coalescing.init_app(app)
 
     # Basic initialization of CORS
+    from flask_cors import CORS
+
     CORS(app)
 
     @app.after_request
@@ -53,6 +277,62 @@ def create_app(test_config=None):
         )
         return response
 
+    @app.route("/metrics")
+    # Handles GET requests for process metrics in Prometheus text format
+    def retrieve_metrics():
+        expected = app.config["METRICS_TOKEN"]
+        if expected:
+            token = parse_auth_header(request.headers.get("Authorization"))
+            if not hmac.compare_digest(token, expected):
+                raise AuthError({
+                    'error': 401,
+                    'code': 'invalid_token',
+                    'description': 'Metrics token is invalid.'
+                }, 401)
+        return app.response_class(
+            metrics.REGISTRY.render(metrics.process_labels()),
+            content_type=metrics.CONTENT_TYPE)
+
+    @app.route("/profiles/<profile_id>")
+    @requires_auth(profiling.PROFILE_PERMISSION)
+    # Handles GET requests for a stored request profile: its metadata, or the
+    # pstats / collapsed stack data itself with ?format=raw
+    def retrieve_profile(token, profile_id):
+        profile = profiling.load_profile(app.config["PROFILE_DIR"], profile_id)
+        if profile is None:
+            abort(404, {'message': 'Profile not found'})
+        metadata, path = profile
+
+        if request.args.get("format") == "raw":
+            return send_file(
+                path, mimetype="text/plain" if metadata["format"] ==
+                "collapsed" else "application/octet-stream",
+                as_attachment=True, attachment_filename=os.path.basename(path))
+        return jsonify({"success": True, "profile": metadata})
+
+    @app.route("/batch", methods=['POST'])
+    @requires_auth(None)
+    # Handles POST requests running several API requests in one round trip.
+    # The token is verified once; each sub-request still needs its route's
+    # permission. With "atomic": true the writes share one transaction.
+    def run_batch(token):
+        try:
+            operations, atomic = batch.parse_operations(
+                app, request.get_json(), max_batch_requests)
+        except batch.BatchError as error:
+            abort(400, {'message': str(error)})
+
+        responses = batch.run(app, db.session(), operations, atomic)
+
+        return jsonify(
+            {
+                "success": all(response["status"] < 400
+                               for response in responses),
+                "atomic": atomic,
+                "responses": responses
+            }
+        )
+
     # ----------------------------------------------------------------------#
     # Students
     # ----------------------------------------------------------------------#
@@ -60,9 +340,24 @@ def create_app(test_config=None):
     @app.route("/students")
     @requires_auth("get:students")
     # Handles GET requests for all student records including pagination (every
-    # 10 students)
+    # 10 students), or for the students listed in ?ids=
     def retrieve_students(token):
-        selection = Student.query.order_by(Student.name).all()
+        fields = get_fields(request, LONG_COLUMNS, SHORT_COLUMNS)
+        if "ids" in request.args:
+            # Batch lookup: GET /students?ids=22001,22002[&include=grades]
+            include = get_include(request, ("grades",))
+            return jsonify(
+                {
+                    "success": True,
+                    "students": batch_details(
+                        Student, get_ids(request), fields,
+                        ("grades", students_transcripts) if include else None,
+                        "Student not found")
+                }
+            )
+
+        selection = select_columns(
+            Student, column_fields(fields)).order_by(Student.name, Student.id)
         students = paginate_data(request, selection)
 
         if len(students) == 0:
@@ -72,7 +367,7 @@ def create_app(test_config=None):
             {
                 "success": True,
                 "students": students,
-                "total_students": len(Student.query.all())
+                "total_students": count_rows(Student)
             }
         )
 
@@ -80,109 +375,79 @@ def create_app(test_config=None):
     @requires_auth("get:student-profile")
     # Handles GET requests GET requests to retrieve student details using a student ID.
     def retrieve_student_details(token, student_id):
-        try:
-            student = Student.query.get(student_id)
+        fields = get_fields(
+            request, STUDENT_DETAIL_FIELDS, STUDENT_DETAIL_FIELDS)
 
-            course_score = []
-            for grade in student.grades:
-                course_score.append(
-                    {
-                        "course": grade.course.title,
-                        "score": grade.score
-                    }
-                )
-
-            student_details = student.long()
-            student_details.update({"grades": course_score})
-
-            return jsonify(
-                {
-                    "success": True,
-                    "student_details": student_details
-                }
-            )
+        def build():
+            student = select_columns(Student, column_fields(fields)).filter(
+                Student.id == student_id).one_or_none()
+            if student is None:
+                return None
+            return student_document(student, fields)
 
-        except BaseException:
+        document = cached_student_document(student_id, fields, build)
+        if document is None:
             abort(404, {'message': 'Student not found'})
 
+        return json_provider.json_response(document)
+
     @app.route("/students/myProfile")
     @requires_auth("get:my-student-profile")
     # Handles GET requests to retrieve signed-in student details.
     def retrieve_signedIn_student_details(token):
+        fields = get_fields(
+            request, STUDENT_DETAIL_FIELDS, STUDENT_DETAIL_FIELDS)
         # Retrieves signed-in student's email address from Auth0 /userinfo API
-        res = requests.get(
-            "https://dev-nixmqqqv.us.auth0.com/userinfo", headers={"Authorization": f"Bearer {token}"})
-        data = res.json()
-        student_email = data["email"]
-
-        try:
-            student = Student.query.filter(
-                Student.email == student_email).one_or_none()
-
-            course_score = []
-            for grade in student.grades:
-                course_score.append(
-                    {
-                        "course": grade.course.title,
-                        "score": grade.score
-                    }
-                )
-
-            student_details = student.long()
-            student_details.update({"grades": course_score})
-
-            return jsonify(
-                {
-                    "success": True,
-                    "student_details": student_details
-                }
-            )
+        data = get_userinfo(token)
+        student_email = data.get("email")
+        if student_email is None:
+            abort(404, {'message': 'Student not found'})
 
-        except BaseException:
+        student = select_columns(Student, column_fields(fields)).filter(
+            Student.email == student_email).one_or_none()
+        if student is None:
             abort(404, {'message': 'Student not found'})
 
+        return json_provider.json_response(cached_student_document(
+            student.id, fields, lambda: student_document(student, fields)))
+
     @app.route("/students/<int:student_id>/course", methods=['POST'])
     @requires_auth("enroll:student-course")
-    # Handles POST requests to add student to course
+    # Handles POST requests to add student to course (one INSERT ... SELECT)
     def add_student_course(token, student_id):
-
-        body = request.get_json()
-
-        course_input = body.get("course", None)
-        course = Course.query.filter(
-            Course.title.ilike(course_input)).one_or_none()
-        if course is None:
-            abort(404, {'message': 'Course not found'})
-
-        try:
-            add_course = Grade(
-                student_id=student_id,
-                course_id=course.id)
-            add_course.insert()
-
-            return jsonify(
-                {
-                    "course": course_input,
-                    "success": True
-                }
-            )
-
-        except BaseException:
+        course_input = get_course(request)
+        enrollment = enroll_student(student_id, course_input)
+
+        if enrollment is None:
+            failure = enrollment_failure(student_id, course_input)
+            if failure == 'course':
+                abort(404, {'message': 'Course not found'})
+            if failure == 'student':
+                abort(404, {'message': 'Student not found'})
             abort(422, {'message': 'Student is already enrolled in course'})
 
+        commit_enrollment_change(student_id, enrollment)
+        return jsonify(
+            {
+                "course": course_input,
+                "success": True
+            }
+        )
+
     @app.route("/students", methods=['POST'])
     @requires_auth("post:student_search")
     # Handles POST requests to get student records based on search term.
     # Search allows partial string matching and case-insensitive.
     def search_students(token):
+        fields = get_fields(request, LONG_COLUMNS, SHORT_COLUMNS)
         try:
             body = request.get_json()
 
             search_term = body.get("search_term", None)
             formatted_input = '%{0}%'.format(search_term)
-            selection = Student.query.filter(
+            selection = select_columns(Student, column_fields(fields)).filter(
                 Student.name.ilike(formatted_input)).all()
-            students = [student.short() for student in selection]
+            students = format_rows(selection)
 
             return jsonify(
                 {
@@ -196,29 +461,32 @@ def create_app(test_config=None):
 
     @app.route("/students/<int:student_id>/score", methods=['PATCH'])
     @requires_auth("patch:student_edit")
-    # Handles PATCH requests to update students score.
+    # Handles PATCH requests to update students score (one UPDATE, or one
+    # write-ahead log append with SCORE_COALESCING_ENABLED)
     def update_student_grade(token, student_id):
-        try:
-            body = request.get_json()
+        course_input = get_course(request)
+        grade_input = (request.get_json(silent=True) or {}).get("score", None)
+        if grade_input is not None and (not isinstance(grade_input, int) or
+                                        isinstance(grade_input, bool)):
+            abort(422, {'message': 'Invalid score'})
+
+        if coalescing.enabled(app) and not g.get("atomic_batch"):
+            enrollment = find_enrollment(student_id, course_input)
+            if enrollment is None:
+                abort(422, {'message': 'Invalid student ID'})
+            coalescing.get_log(app).append(student_id, enrollment,
+                                           grade_input)
+        else:
+            enrollment = update_score(student_id, course_input, grade_input)
+            if enrollment is None:
+                abort(422, {'message': 'Invalid student ID'})
+            commit_enrollment_change(student_id, enrollment)
 
-            grade_input = body.get("score", None)
-            course_input = body.get("course", None)
-            course = Course.query.filter(
-                Course.title.ilike(course_input)).one()
-            grade = Grade.query.filter(
-                Grade.course_id == course.id,
-                Grade.student_id == student_id).one()
-            grade.score = grade_input
-            grade.update()
-
-            return jsonify(
-                {
-                    "success": True
-                }
-            )
-
-        except BaseException:
-            abort(422, {'message': 'Invalid student ID'})
+        return jsonify(
+            {
+                "success": True
+            }
+        )
 
     @app.route("/students/<int:student_id>", methods=["DELETE"])
     @requires_auth("delete:student_id")
@@ -242,29 +510,56 @@ def create_app(test_config=None):
 
     @app.route("/students/<int:student_id>/course", methods=["DELETE"])
     @requires_auth("unenroll:student-course")
-    # Handles DELETE requests to un-enroll student from course.
+    # Handles DELETE requests to un-enroll student from course (one DELETE)
     def delete_student_course(token, student_id):
-        try:
-            body = request.get_json()
+        enrollment = unenroll_student(student_id, get_course(request))
+        if enrollment is None:
+            abort(422, {'message': 'Student not enrolled in course'})
 
-            course_input = body.get("course", None)
-            course = Course.query.filter(
-                Course.title.ilike(course_input)).one()
-            grade = Grade.query.filter(
-                Grade.course_id == course.id,
-                Grade.student_id == student_id).one()
-            student_course = course.title
-            grade.delete()
+        commit_enrollment_change(student_id, enrollment)
+        return jsonify(
+            {
+                "student_course": enrollment.title,
+                "success": True
+            }
+        )
 
-            return jsonify(
-                {
-                    "student_course": student_course,
-                    "success": True
-                }
-            )
+    # ----------------------------------------------------------------------#
+    # Courses
+    # ----------------------------------------------------------------------#
 
-        except BaseException:
-            abort(422, {'message': 'Student not enrolled in course'})
+    @app.route("/courses/<int:course_id>/students")
+    @requires_auth("get:students")
+    # Handles GET requests for the students enrolled in a course, sorted by
+    # name or score, one page at a time (keyset pagination with ?after=)
+    def retrieve_course_students(token, course_id):
+        sort = request.args.get("sort", "name")
+        if sort not in ROSTER_SORTS:
+            abort(400, {'message': 'Invalid sort: {0}'.format(sort)})
+        limit = request.args.get("limit", data_per_page, type=int)
+        if not 1 <= limit <= max_per_page:
+            abort(400, {'message': 'limit must be between 1 and {0}'.format(
+                max_per_page)})
+
+        course = select_columns(Course, ('id', 'title')).filter(
+            Course.id == course_id).one_or_none()
+        if course is None:
+            abort(404, {'message': 'Course not found'})
+
+        try:
+            students, next_cursor = course_roster(
+                course_id, sort, request.args.get("after", None), limit)
+        except ValueError as error:
+            abort(400, {'message': str(error)})
+
+        return jsonify(
+            {
+                "success": True,
+                "course": format_row(course),
+                "students": format_rows(students),
+                "next_cursor": next_cursor
+            }
+        )
 
     # ----------------------------------------------------------------------#
     # Instructors
@@ -273,9 +568,26 @@ def create_app(test_config=None):
     @app.route("/instructors")
     @requires_auth("get:instructors")
     # Handles GET requests for all instructor records including pagination
-    # (every 10 instructors)
+    # (every 10 instructors), or for the instructors listed in ?ids=
     def retrieve_instructors(payload):
-        selection = Instructor.query.order_by(Instructor.name).all()
+        fields = get_fields(request, LONG_COLUMNS, SHORT_COLUMNS)
+        if "ids" in request.args:
+            # Batch lookup: GET /instructors?ids=2201,2202[&include=courses]
+            include = get_include(request, ("courses",))
+            return jsonify(
+                {
+                    "success": True,
+                    "instructors": batch_details(
+                        Instructor, get_ids(request), fields,
+                        ("courses", instructors_courses) if include
+                        else None,
+                        "Instructor not found")
+                }
+            )
+
+        selection = select_columns(
+            Instructor, column_fields(fields)).order_by(
+            Instructor.name, Instructor.id)
         instructors = paginate_data(request, selection)
 
         if len(instructors) == 0:
@@ -285,7 +597,7 @@ def create_app(test_config=None):
             {
                 "success": True,
                 "instructors": instructors,
-                "total_instructors": len(Instructor.query.all())
+                "total_instructors": count_rows(Instructor)
             }
         )
 
@@ -293,44 +605,77 @@ def create_app(test_config=None):
     @requires_auth("get:instructor_profile")
     # Handles GET requests for instructors using an instructor ID.
     def retrieve_instructor_details(token, instructor_id):
-        try:
-            instructor = Instructor.query.get(instructor_id)
+        fields = get_fields(
+            request, INSTRUCTOR_DETAIL_FIELDS, INSTRUCTOR_DETAIL_FIELDS)
+
+        def build():
+            instructor = select_columns(
+                Instructor, column_fields(fields)).filter(
+                Instructor.id == instructor_id).one_or_none()
+            if instructor is None:
+                return None
+
+            instructor_details = format_row(instructor)
+            if "courses" in fields:
+                instructor_details.update({"courses": format_rows(
+                    instructor_courses(instructor.id))})
+            return json_provider.dumps(
+                {
+                    "success": True,
+                    "instructor_details": instructor_details
+                }
+            )
 
-            instructor_course = []
-            for course in instructor.courses:
-                instructor_course.append(
-                    {
-                        "course": course.title
-                    }
-                )
+        document = cache.cached(
+            cache.instructor_key(instructor_id), fields, build)
+        if document is None:
+            abort(404, {'message': 'Instructor not found'})
 
-            instructor_details = instructor.long()
-            instructor_details.update({"courses": instructor_course})
+        return json_provider.json_response(document)
 
-            return jsonify(
+    @app.route("/instructors/<int:instructor_id>/dashboard")
+    @requires_auth("get:students")
+    # Handles GET requests for an instructor's dashboard: enrollment and
+    # score aggregates for each course they teach
+    def retrieve_instructor_dashboard(token, instructor_id):
+
+        def build():
+            instructor = select_columns(Instructor, ('id', 'name')).filter(
+                Instructor.id == instructor_id).one_or_none()
+            if instructor is None:
+                return None
+
+            return json_provider.dumps(
                 {
                     "success": True,
-                    "instructor_details": instructor_details
+                    "instructor": format_row(instructor),
+                    "courses": format_rows(
+                        instructor_dashboard(instructor_id))
                 }
             )
 
-        except BaseException:
+        document = cache.cached(
+            cache.dashboard_key(instructor_id), (), build)
+        if document is None:
             abort(404, {'message': 'Instructor not found'})
 
+        return json_provider.json_response(document)
+
     @app.route("/instructors", methods=['POST'])
     @requires_auth("post:instructor_search")
     # Handles POST requests to get instructor records based on search term.
     # Search allows partial string matching and case-insensitive.
     def search_instructors(token):
+        fields = get_fields(request, LONG_COLUMNS, SHORT_COLUMNS)
         try:
             body = request.get_json()
 
             search_term = body.get("search_term", None)
             formatted_input = '%{0}%'.format(search_term)
-            selection = Instructor.query.filter(
+            selection = select_columns(
+                Instructor, column_fields(fields)).filter(
                 Instructor.name.ilike(formatted_input)).all()
-            instructors = [instructor.short()
-                           for instructor in selection]
+            instructors = format_rows(selection)
 
             return jsonify(
                 {
@@ -342,6 +687,145 @@ def create_app(test_config=None):
         except BaseException:
             abort(400)
 
+    # ----------------------------------------------------------------------#
+    # Reports
+    # ----------------------------------------------------------------------#
+
+    @app.route("/reports", methods=['POST'])
+    @requires_auth("post:reports")
+    # Handles POST requests queueing a report (report cards or course grade
+    # sheets, as CSV or PDF). The report worker builds it; poll
+    # GET /reports/${id} until it is done.
+    def create_report(token):
+        try:
+            kind, output_format, params = reports.parse_request(
+                request.get_json(silent=True))
+        except ValueError as error:
+            abort(400, {'message': str(error)})
+
+        if "course_id" in params and select_columns(Course, ('id',)).filter(
+                Course.id == params["course_id"]).one_or_none() is None:
+            abort(404, {'message': 'Course not found'})
+
+        job = reports.enqueue(kind, output_format, params)
+
+        return jsonify(
+            {
+                "success": True,
+                "report": job.format()
+            }
+        ), 202, {"Location": "/reports/{0}".format(job.id)}
+
+    @app.route("/reports/<int:report_id>")
+    @requires_auth("get:students")
+    # Handles GET requests for a report job's status, or the finished file
+    # itself with ?format=raw
+    def retrieve_report(token, report_id):
+        job = db.session.query(ReportJob).filter(
+            ReportJob.id == report_id).one_or_none()
+        if job is None:
+            abort(404, {'message': 'Report not found'})
+
+        if request.args.get("format") == "raw":
+            if job.status != "done":
+                abort(409, {'message': 'Report is {0}'.format(job.status)})
+            return send_file(
+                io.BytesIO(job.output),
+                mimetype=reports.CONTENT_TYPES[job.output_format],
+                as_attachment=True, attachment_filename=reports.filename(job))
+        return jsonify({"success": True, "report": job.format()})
+
+    # ----------------------------------------------------------------------#
+    # Analytics
+    # ----------------------------------------------------------------------#
+
+    @app.route("/analytics/top-students")
+    @requires_auth("get:students")
+    # Handles GET requests for the students with the best average score
+    # across their scored courses of the current term
+    def retrieve_top_students(token):
+        limit = get_bounded(request, "limit", data_per_page, 1, max_per_page)
+        min_courses = get_bounded(request, "min_courses", 1, 1, 1000)
+
+        ranked = get_gradebook(app).top_students(limit, min_courses)
+        names = column_values(Student, "name", [row[0] for row in ranked])
+
+        return jsonify(
+            {
+                "success": True,
+                "term": terms.current_term(),
+                "students": [
+                    {
+                        "id": student_id,
+                        "name": names.get(student_id),
+                        "average": round(average, 2),
+                        "courses": courses
+                    }
+                    for student_id, average, courses in ranked]
+            }
+        )
+
+    @app.route("/analytics/at-risk")
+    @requires_auth("get:students")
+    # Handles GET requests for the students scoring below a threshold in
+    # several courses of the current term, most failing courses first
+    def retrieve_students_at_risk(token):
+        below = get_bounded(request, "below", 60, 0, 1000, type=float)
+        courses = get_bounded(request, "courses", 2, 1, 1000)
+        limit = get_bounded(request, "limit", data_per_page, 1, max_per_page)
+        page = get_bounded(request, "page", 1, 1, 100000)
+
+        total, students = get_gradebook(app).at_risk(
+            below, courses, (page - 1) * limit, limit)
+        names = column_values(Student, "name", [row[0] for row in students])
+        titles = column_values(Course, "title", [
+            course_id for _, failing in students
+            for course_id, _ in failing])
+
+        return jsonify(
+            {
+                "success": True,
+                "term": terms.current_term(),
+                "students": [
+                    {
+                        "id": student_id,
+                        "name": names.get(student_id),
+                        "grades": [
+                            {"course": titles.get(course_id),
+                             "score": score}
+                            for course_id, score in failing]
+                    }
+                    for student_id, failing in students],
+                "total_students": total
+            }
+        )
+
+    @app.route("/analytics/course-correlations")
+    @requires_auth("get:students")
+    # Handles GET requests for the correlation between the scores of each
+    # pair of courses, over the students taking both, strongest first
+    def retrieve_course_correlations(token):
+        min_students = get_bounded(request, "min_students", 10, 2, 100000)
+        limit = get_bounded(request, "limit", data_per_page, 1, max_per_page)
+
+        pairs = get_gradebook(app).course_correlations(min_students)[:limit]
+        titles = column_values(Course, "title", [
+            course_id for pair in pairs for course_id in pair[:2]])
+
+        return jsonify(
+            {
+                "success": True,
+                "term": terms.current_term(),
+                "correlations": [
+                    {
+                        "courses": [titles.get(first), titles.get(second)],
+                        "correlation": round(correlation, 4),
+                        "students": students
+                    }
+                    for first, second, correlation, students in pairs]
+            }
+        )
+
     # ----------------------------------------------------------------------#
     # Error handlers for all expected HTTP error
     # ----------------------------------------------------------------------#
@@ -362,6 +846,14 @@ def create_app(test_config=None):
             "message": get_error_message(error)
         }), 422
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": get_error_message(error)
+        }), 409
+
     @app.errorhandler(404)
     def notFound(error):
         return jsonify({
@@ -370,16 +862,36 @@ def create_app(test_config=None):
             "message": get_error_message(error)
         }), 404
 
+    @app.errorhandler(503)
+    def unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": get_error_message(error)
+        }), 503
+
     @app.errorhandler(AuthError)
     # Error handler for all expected Auth error
     def handle_auth_error(ex):
         response = jsonify(ex.error)
         return response, ex.status_code
 
+    # Wraps the routes above, so it must come last
+    admission.init_app(app)
+
     return app
 
 
-app = create_app()
+def __getattr__(name):
+    # The module level app (used by gunicorn app:app and manage.py) is only
+    # built on first access, so importing this module for create_app() or
+    # its helpers stays cheap
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
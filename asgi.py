@@ -0,0 +1,400 @@
+'''
+Optional ASGI serving mode for the I/O-bound read endpoints.
+
+Run with an ASGI server, e.g.:
+    pip install asyncpg uvicorn
+    uvicorn asgi:app --workers 1
+
+Database queries use SQLAlchemy's asyncio extension with asyncpg, so
+requests waiting on Postgres don't hold a worker. Token verification and
+/userinfo calls go through the same identity provider client as the sync
+app (with its timeouts, circuit breaker and JWKS cache) on a thread pool,
+so those waits overlap on the event loop as well.
+
+Only the read endpoints are served here; writes stay on the sync app
+(`gunicorn app:app`), which keeps working unchanged. With
+SCORE_COALESCING_ENABLED the transcripts overlay the scores pending in
+SCORE_WAL_DIR, like the sync app's, so this app must share the directory.
+'''
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from sqlalchemy import select, func
+
+from models import Student, Instructor, Course, Grade
+from auth import (AuthError, parse_auth_header, verify_decode_jwt,
+                  check_permissions, get_userinfo)
+from json_provider import get_encoder
+import coalescing
+from queries import (format_rows, format_row, column_fields, parse_fields,
+                     SHORT_COLUMNS, LONG_COLUMNS, STUDENT_DETAIL_FIELDS,
+                     INSTRUCTOR_DETAIL_FIELDS)
+import compression
+from settings import get_settings
+from terms import check_term
+
+data_per_page = 10
+
+
+class HTTPError(Exception):
+    '''
+    HTTPError Exception
+    Mirrors flask's abort(status, {'message': ...}) for the ASGI app
+    '''
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.message = message
+
+
+class Request:
+    '''
+    Parsed ASGI request passed to the route handlers
+    '''
+
+    def __init__(self, scope, params):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.params = params
+        self.headers = {
+            name.decode('latin-1').lower(): value.decode('latin-1')
+            for name, value in scope.get('headers', [])
+        }
+        self.args = {
+            name: values[0] for name, values in parse_qs(
+                scope.get('query_string', b'').decode('latin-1')).items()
+        }
+        self.token = None
+
+    def get_int(self, name, default):
+        try:
+            return int(self.args.get(name, default))
+        except ValueError:
+            return default
+
+    def get_fields(self, allowed, default):
+        try:
+            return parse_fields(self.args.get('fields'), allowed, default)
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+
+
+def async_database_url(database_url):
+    # Rewrites a postgres URL to use the asyncpg driver
+    for prefix in ('postgres://', 'postgresql://', 'postgresql+psycopg2://'):
+        if database_url.startswith(prefix):
+            return 'postgresql+asyncpg://' + database_url[len(prefix):]
+    return database_url
+
+
+def select_columns(model, names=SHORT_COLUMNS):
+    # Core select over the named columns (same projection as queries.py)
+    return select(*[getattr(model, name) for name in names])
+
+
+class AsyncCMSApp:
+    '''
+    ASGI application serving the read-only student and instructor endpoints
+    '''
+
+    # (method, path pattern, handler name, permission); permissions match
+    # the ones required by the same routes in app.py
+    routes = [
+        ('GET', r'/students', 'retrieve_students', 'get:students'),
+        ('GET', r'/students/myProfile', 'retrieve_signedIn_student_details',
+         'get:my-student-profile'),
+        ('GET', r'/students/(?P<student_id>\d+)', 'retrieve_student_details',
+         'get:student-profile'),
+        ('GET', r'/instructors', 'retrieve_instructors', 'get:instructors'),
+        ('GET', r'/instructors/(?P<instructor_id>\d+)',
+         'retrieve_instructor_details', 'get:instructor_profile'),
+    ]
+
+    def __init__(self, database_url=None, json_backend=None, pool_size=None,
+                 max_overflow=None, auth_threads=None, config=None):
+        settings = get_settings()
+        self.database_url = async_database_url(
+            database_url or settings.database_url or '')
+        self.pool_size = pool_size or settings.async_pool_size
+        self.max_overflow = max_overflow or settings.async_max_overflow
+        self.encoder = get_encoder(json_backend or settings.json_backend)
+        # Blocking identity provider calls run here, off the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=auth_threads or settings.async_auth_threads,
+            thread_name_prefix='cms-auth')
+        self.config = {
+            'COMPRESS_ENABLED': True,
+            'COMPRESS_MIN_SIZE': settings.compress_min_size,
+            'COMPRESS_LEVEL': settings.compress_level,
+            'COMPRESS_BR_LEVEL': settings.compress_br_level,
+            'COMPRESS_ALGORITHMS': ('br', 'gzip'),
+            'CURRENT_TERM': settings.current_term,
+            'SCORE_COALESCING_ENABLED': settings.score_coalescing_enabled,
+            'SCORE_WAL_DIR': settings.score_wal_dir,
+        }
+        self.config.update(config or {})
+        if self.config['SCORE_COALESCING_ENABLED']:
+            coalescing.check_host()
+        # Transcripts read the current term only (one partition on Postgres),
+        # like current_grades() in the sync app, which needs current_app
+        self.current_term = check_term(self.config['CURRENT_TERM'])
+        self.engine = None
+        self._routes = [
+            (method, re.compile('^' + pattern + '$'), name, permission)
+            for method, pattern, name, permission in self.routes
+        ]
+
+    # ------------------------------------------------------------------#
+    # ASGI plumbing
+    # ------------------------------------------------------------------#
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] == 'OPTIONS':
+            # CORS preflight
+            return await self.send_json(scope, send, 200, None)
+
+        try:
+            status, body = await self.dispatch(scope)
+        except AuthError as ex:
+            status, body = ex.status_code, ex.error
+        except HTTPError as ex:
+            status, body = ex.status_code, {
+                'success': False,
+                'error': ex.status_code,
+                'message': ex.message
+            }
+        await self.send_json(scope, send, status, body)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        self.engine = create_async_engine(
+            self.database_url, pool_size=self.pool_size,
+            max_overflow=self.max_overflow, pool_pre_ping=True)
+
+    async def shutdown(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+        self.executor.shutdown(wait=False)
+
+    async def dispatch(self, scope):
+        path = scope['path'].rstrip('/') or '/'
+        for method, pattern, name, permission in self._routes:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            if scope['method'] not in (method, 'HEAD'):
+                raise HTTPError(405, 'Method not allowed')
+            request = Request(scope, match.groupdict())
+            await self.authorize(request, permission)
+            return 200, await getattr(self, name)(request)
+        raise HTTPError(404, 'resource not found')
+
+    async def authorize(self, request, permission):
+        # Same checks as requires_auth, with the (possibly blocking) JWKS
+        # lookup run on the executor
+        request.token = parse_auth_header(request.headers.get('authorization'))
+        loop = asyncio.get_running_loop()
+        payload = await loop.run_in_executor(
+            self.executor, verify_decode_jwt, request.token)
+        check_permissions(permission, payload)
+
+    async def send_json(self, scope, send, status, body):
+        data = b''
+        if body is not None:
+            data = self.encoder.dumps(body, sort_keys=True) + b'\n'
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'access-control-allow-origin', b'*'),
+            (b'access-control-allow-headers',
+             b'Content-Type,Authorization,true'),
+            (b'access-control-allow-methods', b'GET,PATCH,POST,DELETE'),
+            (b'vary', b'Accept-Encoding'),
+        ]
+
+        accept_encoding = dict(
+            (name.lower(), value) for name, value in scope.get('headers', [])
+        ).get(b'accept-encoding', b'').decode('latin-1')
+        encoding = compression.negotiate_encoding(
+            accept_encoding, self.config['COMPRESS_ALGORITHMS'])
+        if encoding is not None and \
+                len(data) >= self.config['COMPRESS_MIN_SIZE']:
+            compressor = compression.make_compressor(encoding, self.config)
+            data = compressor.compress(data) + compressor.flush()
+            headers.append((b'content-encoding', encoding.encode()))
+
+        headers.append((b'content-length', str(len(data)).encode()))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body',
+                    'body': b'' if scope['method'] == 'HEAD' else data})
+
+    async def fetch_all(self, statement):
+        async with self.engine.connect() as connection:
+            result = await connection.execute(statement)
+            return result.all()
+
+    async def fetch_one(self, statement):
+        async with self.engine.connect() as connection:
+            result = await connection.execute(statement)
+            return result.one_or_none()
+
+    # ------------------------------------------------------------------#
+    # Students
+    # ------------------------------------------------------------------#
+
+    async def retrieve_students(self, request):
+        return await self.paginate(request, Student, 'students',
+                                   'No student found')
+
+    async def pending_scores(self):
+        # coalescing.pending_scores() of every student, read off the event
+        # loop before the transcript
+        if not self.config['SCORE_COALESCING_ENABLED']:
+            return {}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, coalescing.read_pending,
+            self.config['SCORE_WAL_DIR'], self.current_term)
+
+    async def student_details(self, where, fields):
+        # Loads the profile and, if requested, the transcript concurrently
+        profile = self.fetch_one(
+            select_columns(Student, column_fields(fields)).where(where))
+        scores = {}
+        if 'grades' not in fields:
+            student = await profile
+            grades = None
+        else:
+            scores = await self.pending_scores()
+            columns = [Course.title.label('course'), Grade.score]
+            if scores:
+                columns += [Grade.student_id,
+                            Grade.score_version.label('version')]
+            grades_query = select(*columns).join(
+                Course, Grade.course_id == Course.id).join(
+                Student, Grade.student_id == Student.id).where(
+                Grade.term == self.current_term, where).order_by(Grade.id)
+            student, grades = await asyncio.gather(
+                profile, self.fetch_all(grades_query))
+
+        if student is None:
+            raise HTTPError(404, 'Student not found')
+
+        student_details = format_row(student)
+        if grades is not None:
+            grades = format_rows(grades)
+            if scores:
+                for grade in grades:
+                    coalescing.overlay(grade.pop('student_id'), [grade],
+                                       scores)
+            student_details.update({'grades': grades})
+        return {
+            'success': True,
+            'student_details': student_details
+        }
+
+    async def retrieve_student_details(self, request):
+        fields = request.get_fields(STUDENT_DETAIL_FIELDS,
+                                    STUDENT_DETAIL_FIELDS)
+        student_id = int(request.params['student_id'])
+        return await self.student_details(Student.id == student_id, fields)
+
+    async def retrieve_signedIn_student_details(self, request):
+        fields = request.get_fields(STUDENT_DETAIL_FIELDS,
+                                    STUDENT_DETAIL_FIELDS)
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(
+            self.executor, get_userinfo, request.token)
+        student_email = data.get('email')
+        if student_email is None:
+            raise HTTPError(404, 'Student not found')
+        return await self.student_details(Student.email == student_email,
+                                          fields)
+
+    # ------------------------------------------------------------------#
+    # Instructors
+    # ------------------------------------------------------------------#
+
+    async def retrieve_instructors(self, request):
+        return await self.paginate(request, Instructor, 'instructors',
+                                   'No instructor found')
+
+    async def retrieve_instructor_details(self, request):
+        fields = request.get_fields(INSTRUCTOR_DETAIL_FIELDS,
+                                    INSTRUCTOR_DETAIL_FIELDS)
+        instructor_id = int(request.params['instructor_id'])
+        profile = self.fetch_one(
+            select_columns(Instructor, column_fields(fields)).where(
+                Instructor.id == instructor_id))
+        if 'courses' not in fields:
+            instructor, courses = await profile, None
+        else:
+            courses_query = select(Course.title.label('course')).where(
+                Course.instructor_id == instructor_id).order_by(Course.id)
+            instructor, courses = await asyncio.gather(
+                profile, self.fetch_all(courses_query))
+
+        if instructor is None:
+            raise HTTPError(404, 'Instructor not found')
+
+        instructor_details = format_row(instructor)
+        if courses is not None:
+            instructor_details.update({'courses': format_rows(courses)})
+        return {
+            'success': True,
+            'instructor_details': instructor_details
+        }
+
+    # ------------------------------------------------------------------#
+    # Helpers
+    # ------------------------------------------------------------------#
+
+    async def paginate(self, request, model, key, not_found):
+        # Paginated list with the same shape as the sync endpoints
+        fields = request.get_fields(LONG_COLUMNS, SHORT_COLUMNS)
+        page = request.get_int('page', 1)
+        if page < 1:
+            raise HTTPError(404, not_found)
+
+        page_query = select_columns(model, column_fields(fields)).order_by(
+            model.name, model.id).offset(
+            (page - 1) * data_per_page).limit(data_per_page)
+        count_query = select(func.count(model.id))
+        rows, total = await asyncio.gather(
+            self.fetch_all(page_query), self.fetch_one(count_query))
+        if len(rows) == 0:
+            raise HTTPError(404, not_found)
+
+        return {
+            'success': True,
+            key: format_rows(rows),
+            'total_' + key: total[0]
+        }
+
+
+def create_async_app(**kwargs):
+    # Create and configure the ASGI app
+    return AsyncCMSApp(**kwargs)
+
+
+app = create_async_app()
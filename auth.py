@@ -1,17 +1,10 @@
-import os
-import json
-from flask import request, _request_ctx_stack
+from flask import g, request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
-from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
-
-AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
-ALGORITHMS = os.getenv('ALGORITHMS')
-API_AUDIENCE = os.getenv('API_AUDIENCE')
+import profiling
+from identity_provider import get_client, IdentityProviderError
+from instrumentation import timed
+from settings import get_settings
 
 
 class AuthError(Exception):
@@ -28,7 +21,12 @@ class AuthError(Exception):
 def get_token_auth_header():
     # Auth header
     # Obtains the Access Token from the Authorization Header
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
+    # Extracts the token from an Authorization header value (also used by
+    # the ASGI app, which has no flask request)
     # Attempts to get the header from the request. Raises an AuthError if no
     # header is present
     if not auth:
@@ -92,15 +90,58 @@ def check_permissions(permission, payload):
     return True
 
 
+def identity_provider_unavailable():
+    # AuthError raised when the identity provider is degraded
+    return AuthError({
+        'error': 503,
+        'code': 'identity_provider_unavailable',
+        'description': 'Identity provider is unavailable.'
+    }, 503)
+
+
+def get_jwks(unverified_header):
+    # Returns the cached JWKS, refreshing it once if the key id is unknown
+    try:
+        jwks = get_client().get_jwks()
+        kids = [key.get('kid') for key in jwks.get('keys', [])]
+        if unverified_header.get('kid') not in kids:
+            jwks = get_client().get_jwks(refresh=True)
+    except IdentityProviderError:
+        raise identity_provider_unavailable()
+    return jwks
+
+
+def get_userinfo(token):
+    '''
+    get_userinfo(token) method
+        @INPUTS
+                token: a json web token (string)
+    '''
+    # Retrieves the signed-in user's profile from the Auth0 /userinfo API
+    try:
+        return get_client().get_userinfo(token)
+    except IdentityProviderError as error:
+        if error.status_code in (401, 403):
+            raise AuthError({
+                'error': 401,
+                'code': 'invalid_token',
+                'description': 'Token rejected by identity provider.'
+            }, 401)
+        raise identity_provider_unavailable()
+
+
 def verify_decode_jwt(token):
     '''
     verify_decode_jwt(token) method
         @INPUTS
                 token: a json web token (string)
     '''
-    # Verifies the token using Auth0 /.well-known/jwks.json
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # python-jose is only imported once the first token is verified
+    from jose import jwt
+
+    settings = get_settings()
+    # Verifies the token using Auth0 /.well-known/jwks.json (cached by the
+    # identity provider client)
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -110,6 +151,8 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
+    jwks = get_jwks(unverified_header)
+
     for key in jwks['keys']:
         if key['kid'] == unverified_header['kid']:
             rsa_key = {
@@ -127,9 +170,9 @@ def verify_decode_jwt(token):
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=settings.algorithms,
+                audience=settings.api_audience,
+                issuer='https://' + str(settings.auth0_domain) + '/'
             )
 
             return payload
@@ -161,18 +204,42 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+def authenticate():
+    # Returns the (token, payload) of the request's verified bearer token.
+    # The result is kept on g, so POST /batch sub-requests, which run in
+    # the batch's app context with its Authorization header, don't verify
+    # the token again.
+    token = get_token_auth_header()
+    verified = g.get('verified_token')
+    if verified is not None and verified[0] == token:
+        return verified
+    payload = verify_decode_jwt(token)
+    g.verified_token = (token, payload)
+    return token, payload
+
+
 def requires_auth(permission=''):
     '''
     @requires_auth(permission) decorator method
         @INPUTS
-                permission: string permission (i.e. 'get:students')
+                permission: string permission (i.e. 'get:students'), or
+                            None to only require a valid token
     '''
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token, payload = authenticate()
+                if permission is not None:
+                    check_permissions(permission, payload)
+                # Profiling a request needs its own permission on top of the
+                # route's
+                profile_mode = profiling.requested_mode()
+                if profile_mode is not None:
+                    check_permissions(profiling.PROFILE_PERMISSION, payload)
+            if profile_mode is not None:
+                return profiling.profile_call(
+                    profile_mode, f, token, *args, **kwargs)
             return f(token, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,156 @@
+import json
+from flask import g, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+from metrics import Histogram
+
+BATCH_SIZE = Histogram(
+    'cms_batch_requests',
+    'Sub-requests per POST /batch.',
+    buckets=(1, 2, 3, 5, 10, 20))
+
+# Status of the sub-requests skipped after a failure in an atomic batch
+FAILED_DEPENDENCY = 424
+
+METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+
+
+class BatchError(ValueError):
+    '''
+    BatchError Exception
+    An invalid POST /batch body (reported as a 400)
+    '''
+
+
+def parse_operations(app, body, limit):
+    '''
+    parse_operations(app, body, limit) method
+        @INPUTS
+                app: the Flask app serving the batch
+                body: decoded POST /batch body
+                limit: maximum number of sub-requests
+    '''
+    # Returns ([(method, path, json body)], atomic). Raises BatchError with a
+    # client facing message on invalid input
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('requests'), list):
+        raise BatchError('A list of requests is expected')
+    operations = body['requests']
+    if len(operations) == 0:
+        raise BatchError('No requests')
+    if len(operations) > limit:
+        raise BatchError('At most {0} requests can be batched'.format(limit))
+
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise BatchError('Request {0} must be an object'.format(index))
+        method = str(operation.get('method', 'GET')).upper()
+        path = operation.get('path')
+        if method not in METHODS:
+            raise BatchError('Request {0}: invalid method'.format(index))
+        if not isinstance(path, str) or not path.startswith('/'):
+            raise BatchError('Request {0}: invalid path'.format(index))
+        if endpoint(app, method, path) == 'run_batch':
+            raise BatchError('Request {0}: batches can\'t be nested'.format(
+                index))
+        parsed.append((method, path, operation.get('body')))
+    return parsed, bool(body.get('atomic', False))
+
+
+def build_environ(method, path, body=None, headers=None):
+    builder = EnvironBuilder(path=path, method=method, json=body,
+                             headers=headers)
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def endpoint(app, method, path):
+    # Endpoint a sub-request reaches, with its path decoded and matched the
+    # way dispatch() will (so "/%62atch" is still the batch route), or None
+    adapter = app.url_map.bind_to_environ(build_environ(method, path))
+    try:
+        return adapter.match()[0]
+    except HTTPException:
+        # Not found, method not allowed or a redirect: no view runs
+        return None
+
+
+def dispatch(app, method, path, body):
+    # Runs one sub-request through the app's URL map, view and error
+    # handlers, without the before/after request hooks (the batch request
+    # itself is timed, logged and compressed). Returns (status, body).
+    environ = build_environ(
+        method, path, body,
+        {'Authorization': request.headers.get('Authorization', '')})
+
+    with app.request_context(environ):
+        try:
+            response = app.make_response(app.dispatch_request())
+        except Exception as error:
+            response = app.make_response(app.handle_user_exception(error))
+
+        data = response.get_data(as_text=True)
+        if response.is_json:
+            data = json.loads(data)
+        return response.status_code, data
+
+
+def skipped():
+    return {
+        'success': False,
+        'error': FAILED_DEPENDENCY,
+        'message': 'Not run: an earlier request in the atomic batch failed'
+    }
+
+
+def run(app, session, operations, atomic):
+    '''
+    run(app, session, operations, atomic) method
+        @INPUTS
+                app: the Flask app serving the batch
+                session: database session shared by the sub-requests
+                operations: [(method, path, json body)] from parse_operations
+                atomic: run the writes in one transaction
+    '''
+    # Returns the responses, in order. In an atomic batch each sub-request
+    # runs in a SAVEPOINT, so the handlers' own commits only release it;
+    # the first failure rolls every write back and skips the rest.
+    BATCH_SIZE.observe(len(operations))
+    responses = []
+    failed = False
+    # Writes of an atomic batch can't be deferred (see coalescing.py)
+    g.atomic_batch = atomic
+    try:
+        failed = run_operations(app, session, operations, atomic, responses)
+    finally:
+        g.atomic_batch = False
+
+    if atomic and not failed:
+        session.commit()
+    return responses
+
+
+def run_operations(app, session, operations, atomic, responses):
+    # Appends each sub-request's response; returns True when an atomic
+    # batch failed
+    failed = False
+    for method, path, body in operations:
+        if failed:
+            responses.append({'status': FAILED_DEPENDENCY, 'body': skipped()})
+            continue
+        if atomic:
+            session.begin_nested()
+        status, data = dispatch(app, method, path, body)
+        responses.append({'status': status, 'body': data})
+        if status >= 400:
+            # A failed write may leave the session needing a rollback
+            session.rollback()
+            failed = atomic
+        elif atomic and session.in_nested_transaction():
+            # Read-only handlers don't commit
+            session.commit()
+    return failed
@@ -0,0 +1,3 @@
+'''
+Benchmark scripts and the reproducible benchmark suite (see README).
+'''
@@ -0,0 +1,81 @@
+'''
+Measures JSON encode time per payload size for the encoders in
+json_provider.py, next to flask.json.dumps (what jsonify used before).
+
+Run from the project root:
+    python benchmarks/bench_json.py [--repeat 20]
+'''
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, json as flask_json  # noqa: E402
+
+import json_provider  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000, 100000)
+
+
+def roster_payload(size):
+    # Same shape as GET /students and POST /students responses
+    return {
+        "success": True,
+        "students": [
+            {
+                "id": 22000 + i,
+                "name": f"Student {i:06d}",
+                "email": f"student{i}@student.com",
+                "image_link": "https://cdn.pixabay.com/photo/2016/08/08/09/"
+                              "17/avatar-1577909_960_720.png",
+                "grades": [{"course": "Mathematics", "score": i % 100},
+                           {"course": "Science", "score": None}]
+            }
+            for i in range(size)
+        ],
+        "total_students": size
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    encoders = [('flask.json', None), ('stdlib', 'stdlib')]
+    if json_provider.orjson is not None:
+        encoders.append(('orjson', 'orjson'))
+
+    header = f'{"rows":>8}{"bytes":>12}'
+    for name, _ in encoders:
+        header += f'{name + " (ms)":>16}'
+    print(header)
+
+    with app.app_context():
+        for size in SIZES:
+            payload = roster_payload(size)
+            number = max(1, args.repeat * 100 // size)
+            line = f'{size:>8}'
+            for index, (name, backend) in enumerate(encoders):
+                if backend is None:
+                    def encode():
+                        return flask_json.dumps(
+                            payload, separators=(",", ":")).encode('utf-8')
+                else:
+                    app.config['JSON_BACKEND'] = backend
+                    json_provider.init_app(app)
+
+                    def encode():
+                        return json_provider.dumps(payload)
+                if index == 0:
+                    line += f'{len(encode()):>12}'
+                best = min(timeit.repeat(encode, number=number, repeat=3))
+                line += f'{best / number * 1000:>16.3f}'
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
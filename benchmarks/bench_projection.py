@@ -0,0 +1,94 @@
+'''
+Compares the ORM serialization path used by the list and search endpoints
+before the column-projection change ([data.short() for data in selection])
+with the Row projection path in queries.py.
+
+Run from the project root:
+    python benchmarks/bench_projection.py [--rows 10000] [--repeat 5]
+
+An in-memory SQLite database is used by default; pass --database-url to run
+against Postgres.
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flask import Flask  # noqa: E402
+
+import terms  # noqa: E402
+from models import setup_db, db, Student, Course, Grade  # noqa: E402
+from queries import select_columns, format_rows  # noqa: E402
+
+
+def populate(rows):
+    # Creates `rows` students enrolled in two courses each
+    db.create_all()
+    courses = [Course(title=f'Course {i}', credit='3') for i in range(2)]
+    db.session.add_all(courses)
+    db.session.flush()
+    db.session.bulk_insert_mappings(Student, [
+        {'id': i + 1, 'name': f'Student {i:06d}',
+         'email': f'student{i}@student.com', 'image_link': None}
+        for i in range(rows)])
+    db.session.bulk_insert_mappings(Grade, [
+        {'student_id': i + 1, 'course_id': course.id, 'score': i % 100}
+        for i in range(rows) for course in courses])
+    db.session.commit()
+
+
+def orm_path():
+    selection = Student.query.order_by(Student.name).all()
+    return [data.short() for data in selection]
+
+
+def projection_path():
+    return format_rows(select_columns(Student).order_by(Student.name).all())
+
+
+def measure(fn, repeat):
+    # Returns (best wall time in ms, peak traced allocation in KiB)
+    timings = []
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    db.session.remove()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database-url', default='sqlite://')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, args.database_url)
+    # Grade.term defaults to the current term
+    terms.init_app(app)
+    with app.app_context():
+        if args.database_url == 'sqlite://':
+            populate(args.rows)
+        assert orm_path() == projection_path()
+
+        print(f'{args.rows} rows per request, best of {args.repeat}')
+        print(f'{"path":<12}{"latency (ms)":>14}{"peak alloc (KiB)":>18}')
+        for name, fn in (('orm', orm_path), ('projection', projection_path)):
+            latency, peak = measure(fn, args.repeat)
+            print(f'{name:<12}{latency:>14.1f}{peak:>18.0f}')
+
+
+if __name__ == '__main__':
+    main()
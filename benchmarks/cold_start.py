@@ -0,0 +1,98 @@
+'''
+Measures time-to-first-request of the gunicorn server with and without the
+production profile in gunicorn.conf.py (preload + per-worker warm-up).
+
+For each mode the server is started, the script polls until the port
+accepts connections and then times the first authenticated request, which
+is where the JWKS fetch, connection setup and statement compilation land
+on a cold worker.
+
+Run from the project root (DATABASE_URL and the Auth0 settings must be set):
+    python benchmarks/cold_start.py --token "$ADMIN_TOKEN" [--runs 5]
+'''
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+MODES = {
+    'cold': ['gunicorn', '--workers', '1', 'app:app'],
+    'warm': ['gunicorn', '-c', 'gunicorn.conf.py', '--workers', '1',
+             'app:app'],
+}
+
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return True
+        time.sleep(0.01)
+    return False
+
+
+def measure(mode, port, path, token, timeout):
+    # Returns (seconds until the first response, first request latency)
+    env = dict(os.environ, PORT=str(port))
+    command = MODES[mode] + ['--bind', f'127.0.0.1:{port}']
+    start = time.perf_counter()
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(port, timeout):
+            raise RuntimeError(f'{mode} server did not start')
+        # The port opens before the worker is ready; keep retrying until
+        # the worker answers
+        while True:
+            request_start = time.perf_counter()
+            try:
+                response = requests.get(
+                    f'http://127.0.0.1:{port}{path}',
+                    headers={'Authorization': f'Bearer {token}'},
+                    timeout=timeout)
+                break
+            except requests.ConnectionError:
+                if time.perf_counter() - start > timeout:
+                    raise
+                time.sleep(0.01)
+        end = time.perf_counter()
+        if response.status_code >= 500:
+            raise RuntimeError(
+                f'{mode} first request failed: {response.status_code}')
+        return end - start, end - request_start
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--token', default=os.getenv('ADMIN_TOKEN', ''))
+    parser.add_argument('--path', default='/students/22001')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+    token = args.token.split()[-1] if args.token else ''
+
+    print(f'{"mode":<6}{"time to first response (ms)":>30}'
+          f'{"first request (ms)":>20}')
+    for mode in MODES:
+        results = [measure(mode, args.port, args.path, token, args.timeout)
+                   for _ in range(args.runs)]
+        startup = statistics.median(result[0] for result in results)
+        first = statistics.median(result[1] for result in results)
+        print(f'{mode:<6}{startup * 1000:>30.1f}{first * 1000:>20.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
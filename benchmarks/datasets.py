@@ -0,0 +1,169 @@
+'''
+Deterministic synthetic datasets for the benchmark suite.
+
+generate(students=10000, seed=42) fills an empty database (db.create_all())
+with students, instructors, courses and enrollments. Course popularity is
+skewed (a few large lecture courses, a long tail of small electives), each
+student takes 3 to 6 courses, and about one grade in ten has no score yet.
+The same seed always produces the same rows.
+'''
+import random
+from dataclasses import dataclass, field
+
+from models import db, Student, Instructor, Course, Grade
+
+FIRST_NAMES = (
+    'Ada', 'Alan', 'Amara', 'Chidi', 'Chioma', 'Dami', 'Emeka', 'Fatima',
+    'Grace', 'Hassan', 'Ifeoma', 'Ike', 'Ji-woo', 'Kemi', 'Lars', 'Lucia',
+    'Mateo', 'Mei', 'Ngozi', 'Obi', 'Olu', 'Priya', 'Rosa', 'Sade', 'Tariq',
+    'Tunde', 'Uche', 'Yusuf', 'Zainab', 'Zoe',
+)
+LAST_NAMES = (
+    'Adeyemi', 'Bello', 'Chukwu', 'Diaz', 'Eze', 'Fischer', 'Garcia',
+    'Hughes', 'Ibrahim', 'Johnson', 'Kim', 'Lopez', 'Mensah', 'Nwosu',
+    'Okafor', 'Okonkwo', 'Patel', 'Rossi', 'Sato', 'Smith', 'Tanaka',
+    'Umeh', 'Wang', 'Yilmaz',
+)
+SUBJECTS = (
+    'Algebra', 'Biology', 'Chemistry', 'Computer Science', 'Economics',
+    'English', 'Geography', 'History', 'Literature', 'Music', 'Philosophy',
+    'Physics', 'Psychology', 'Sociology', 'Statistics',
+)
+
+# Course every run can enroll students into and remove them from again
+ELECTIVE = 'Benchmark Elective'
+
+BATCH_SIZE = 10000
+
+
+@dataclass
+class Dataset:
+    '''
+    Dataset
+    Ids and names the benchmark routes are built from
+    '''
+    students: int
+    instructors: int
+    courses: int
+    grades: int
+    student_ids: list = field(default_factory=list)
+    instructor_ids: list = field(default_factory=list)
+    # Students reserved for DELETE /students/${id}
+    disposable_ids: list = field(default_factory=list)
+    # (student id, course title) pairs of existing enrollments
+    enrollments: list = field(default_factory=list)
+    # (student id, email) pairs for GET /students/myProfile
+    profiles: list = field(default_factory=list)
+    search_terms: list = field(default_factory=list)
+
+    def summary(self):
+        return {'students': self.students, 'instructors': self.instructors,
+                'courses': self.courses, 'grades': self.grades,
+                'disposable': len(self.disposable_ids)}
+
+
+def insert_batches(model, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(model.__table__.insert(),
+                           rows[start:start + BATCH_SIZE])
+
+
+def student_name(rng, index):
+    # Names are unique (student.name has a unique constraint)
+    return '{0} {1} {2:07d}'.format(
+        rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), index)
+
+
+def generate(students=10000, seed=42, disposable=1000, sample=1000):
+    '''
+    generate(students, seed, disposable, sample) method
+        @INPUTS
+                students: number of enrolled students (10k to 1M)
+                seed: random seed, the same seed gives the same dataset
+                disposable: extra students without grades, to be deleted
+                sample: number of ids/enrollments kept for the routes
+    '''
+    rng = random.Random(seed)
+    db.create_all()
+
+    course_count = max(20, students // 40)
+    instructor_count = max(5, course_count // 3)
+
+    instructors = [{
+        'id': i + 1,
+        'name': 'Dr. {0} {1} {2:05d}'.format(
+            rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), i),
+        'email': 'instructor{0}@cms.local'.format(i + 1),
+        'image_link': None,
+    } for i in range(instructor_count)]
+    insert_batches(Instructor, instructors)
+
+    courses = [{
+        'id': i + 1,
+        'title': '{0} {1}'.format(SUBJECTS[i % len(SUBJECTS)], 100 + i),
+        'credit': str(rng.choice((2, 3, 3, 4))),
+        'instructor_id': rng.randint(1, instructor_count),
+    } for i in range(course_count)]
+    courses.append({'id': course_count + 1, 'title': ELECTIVE, 'credit': '1',
+                    'instructor_id': 1})
+    insert_batches(Course, courses)
+
+    # Skewed popularity: weight 1/rank (Zipf-like)
+    weights = [1.0 / (rank + 1) for rank in range(course_count)]
+    course_ids = list(range(1, course_count + 1))
+
+    dataset = Dataset(students=students, instructors=instructor_count,
+                      courses=len(courses), grades=0)
+    student_rows, grade_rows = [], []
+    for i in range(students):
+        student_id = i + 1
+        email = 'student{0}@cms.local'.format(student_id)
+        student_rows.append({'id': student_id,
+                             'name': student_name(rng, student_id),
+                             'email': email, 'image_link': None})
+        taken, count = set(), rng.randint(3, 6)
+        while len(taken) < count:
+            taken.add(rng.choices(course_ids, weights)[0])
+        for course_id in sorted(taken):
+            score = None if rng.random() < 0.1 else \
+                max(0, min(100, int(rng.gauss(72, 12))))
+            grade_rows.append({'student_id': student_id,
+                               'course_id': course_id, 'score': score})
+        if len(student_rows) >= BATCH_SIZE:
+            insert_batches(Student, student_rows)
+            insert_batches(Grade, grade_rows)
+            dataset.grades += len(grade_rows)
+            student_rows, grade_rows = [], []
+
+    student_rows.extend({
+        'id': students + i + 1,
+        'name': 'Disposable {0:07d}'.format(i),
+        'email': None,
+        'image_link': None,
+    } for i in range(disposable))
+    insert_batches(Student, student_rows)
+    insert_batches(Grade, grade_rows)
+    dataset.grades += len(grade_rows)
+    if db.engine.dialect.name == 'postgresql':
+        # Rows were inserted with explicit ids
+        for table in ('instructor', 'course', 'student'):
+            db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "(SELECT max(id) FROM {0}))".format(table))
+    db.session.commit()
+
+    titles = {course['id']: course['title'] for course in courses}
+    dataset.student_ids = rng.sample(range(1, students + 1),
+                                     min(sample, students))
+    dataset.instructor_ids = list(range(1, instructor_count + 1))
+    dataset.disposable_ids = list(
+        range(students + 1, students + disposable + 1))
+    dataset.enrollments = [
+        (row.student_id, titles[row.course_id]) for row in
+        db.session.query(Grade.student_id, Grade.course_id).filter(
+            Grade.student_id.in_(dataset.student_ids)).order_by(Grade.id)]
+    dataset.profiles = [
+        (student_id, 'student{0}@cms.local'.format(student_id))
+        for student_id in dataset.student_ids]
+    dataset.search_terms = list(FIRST_NAMES[:10]) + list(LAST_NAMES[:10])
+    return dataset
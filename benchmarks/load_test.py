@@ -0,0 +1,126 @@
+'''
+Closed-loop load test comparing the sync (gunicorn) and async (ASGI)
+serving modes on the read endpoints.
+
+Start both servers with the same number of worker processes, e.g.:
+    gunicorn app:app --workers 1 --bind 127.0.0.1:8000
+    uvicorn asgi:app --workers 1 --port 8001
+
+then run from the project root:
+    python benchmarks/load_test.py --token "$ADMIN_TOKEN" \\
+        --target sync=http://127.0.0.1:8000 \\
+        --target async=http://127.0.0.1:8001 \\
+        --concurrency 64 --duration 30 --cores 1
+
+The token needs the get:students, get:student-profile, get:instructors and
+get:instructor_profile permissions (the admin token has all of them).
+'''
+import argparse
+import itertools
+import os
+import statistics
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_PATHS = (
+    '/students?page=1',
+    '/students/22001',
+    '/instructors?page=1',
+    '/instructors/2203',
+)
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return float('nan')
+    index = max(0, min(len(values) - 1,
+                       int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def run_client(base_url, paths, headers, deadline, results, errors):
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=1))
+    for path in itertools.cycle(paths):
+        if time.monotonic() >= deadline:
+            break
+        start = time.perf_counter()
+        try:
+            response = session.get(base_url + path, headers=headers,
+                                   timeout=30)
+            ok = response.status_code < 500
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        if ok:
+            results.append(elapsed)
+        else:
+            errors.append(elapsed)
+    session.close()
+
+
+def load_test(base_url, paths, token, concurrency, duration):
+    # Runs `concurrency` closed-loop clients for `duration` seconds
+    headers = {'Authorization': f'Bearer {token}'}
+    results, errors = [], []
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=run_client, args=(
+            base_url, paths, headers, deadline, results, errors))
+        for _ in range(concurrency)
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(results)
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': (statistics.mean(latencies) * 1000
+                    if latencies else float('nan')),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--target', action='append', required=True,
+                        help='name=base_url (repeatable)')
+    parser.add_argument('--token', default=os.getenv('ADMIN_TOKEN', ''))
+    parser.add_argument('--path', action='append',
+                        help='request path (repeatable)')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--cores', type=int, default=1,
+                        help='CPU cores given to each server')
+    args = parser.parse_args()
+
+    token = args.token.split()[-1] if args.token else ''
+    paths = tuple(args.path or DEFAULT_PATHS)
+
+    print(f'{"mode":<10}{"requests":>10}{"errors":>8}{"rps/core":>10}'
+          f'{"p50 (ms)":>10}{"p99 (ms)":>10}')
+    for target in args.target:
+        name, _, base_url = target.partition('=')
+        result = load_test(base_url.rstrip('/'), paths, token,
+                           args.concurrency, args.duration)
+        print(f'{name:<10}{result["requests"]:>10}{result["errors"]:>8}'
+              f'{result["rps"] / args.cores:>10.1f}'
+              f'{result["p50_ms"]:>10.1f}{result["p99_ms"]:>10.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,488 @@
+'''
+Reproducible benchmark of every route registered by create_app().
+
+The suite generates a synthetic dataset (benchmarks/datasets.py), signs its
+own tokens with a local RSA key served as a stand-in JWKS (local_auth.py),
+starts the app and drives each route with a fixed number of requests at
+each concurrency level. p50/p95/p99 latency, throughput and SQL statements
+per request (from the Server-Timing header) are written to a JSON baseline.
+No Auth0 tenant or shared database is needed.
+
+Run from the project root:
+    python -m benchmarks.suite --students 10000 --concurrency 1,8,32 \\
+        --output baseline.json
+
+and compare a later run against the stored baseline (exits with status 1
+when a route got slower or runs more queries than allowed):
+    python -m benchmarks.suite --students 10000 --concurrency 1,8,32 \\
+        --compare baseline.json --tolerance 0.25
+
+A temporary SQLite file is used unless --database-url is given (use an
+empty Postgres database for numbers close to production, --reset drops
+and recreates its tables). --server gunicorn serves the app with
+gunicorn.conf.py instead of the in-process threaded server. Admission
+control is off unless --admission is given, as levels above its per-class
+limits would measure shed requests rather than the routes.
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from benchmarks import datasets
+from benchmarks.load_test import percentile
+
+QUERY_COUNT = re.compile(r'desc="(\d+) queries"')
+
+PROFILE_TOKENS = 20
+
+
+@dataclass
+class Scenario:
+    '''
+    Scenario
+    One route driven by the suite. build(i, context) returns the path and
+    JSON body of the i-th request.
+    '''
+    name: str
+    endpoint: str
+    method: str
+    role: str
+    build: object
+    expected: int = 200
+
+
+def cycle(values, i):
+    return values[i % len(values)]
+
+
+def my_profile_token(i, context):
+    return cycle(context.student_tokens, i)
+
+
+SCENARIOS = (
+    Scenario('metrics', 'retrieve_metrics', 'GET', None,
+             lambda i, c: ('/metrics', None)),
+    Scenario('profile', 'retrieve_profile', 'GET', 'profiler',
+             lambda i, c: ('/profiles/' + c.profile_id, None)),
+    Scenario('list_students', 'retrieve_students', 'GET', 'admin',
+             lambda i, c: ('/students?page={0}'.format(i % 50 + 1), None)),
+    # A class list page: 25 students with their transcripts in one request
+    Scenario('students_batch', 'retrieve_students', 'GET', 'admin',
+             lambda i, c: ('/students?include=grades&ids=' + ','.join(
+                 str(cycle(c.dataset.student_ids, i * 25 + j))
+                 for j in range(25)), None)),
+    Scenario('student_details', 'retrieve_student_details', 'GET', 'admin',
+             lambda i, c: ('/students/{0}'.format(
+                 cycle(c.dataset.student_ids, i)), None)),
+    Scenario('my_profile', 'retrieve_signedIn_student_details', 'GET',
+             my_profile_token,
+             lambda i, c: ('/students/myProfile', None)),
+    Scenario('search_students', 'search_students', 'POST', 'admin',
+             lambda i, c: ('/students', {
+                 'search_term': cycle(c.dataset.search_terms, i)})),
+    # Enrolls sampled students in the elective, which unenroll_course then
+    # removes again, so every run leaves the dataset as it found it
+    Scenario('enroll_course', 'add_student_course', 'POST', 'admin',
+             lambda i, c: ('/students/{0}/course'.format(
+                 c.dataset.student_ids[i]), {'course': datasets.ELECTIVE})),
+    Scenario('unenroll_course', 'delete_student_course', 'DELETE', 'admin',
+             lambda i, c: ('/students/{0}/course'.format(
+                 c.dataset.student_ids[i]), {'course': datasets.ELECTIVE})),
+    # An admin tool's enroll -> score -> details chain in one atomic batch,
+    # unenrolling again at the end
+    Scenario('batch', 'run_batch', 'POST', 'admin',
+             lambda i, c: ('/batch', {'atomic': True, 'requests': [
+                 {'method': 'POST', 'path': '/students/{0}/course'.format(
+                     c.dataset.student_ids[i]),
+                  'body': {'course': datasets.ELECTIVE}},
+                 {'method': 'PATCH', 'path': '/students/{0}/score'.format(
+                     c.dataset.student_ids[i]),
+                  'body': {'course': datasets.ELECTIVE, 'score': i % 101}},
+                 {'path': '/students/{0}'.format(c.dataset.student_ids[i])},
+                 {'method': 'DELETE', 'path': '/students/{0}/course'.format(
+                     c.dataset.student_ids[i]),
+                  'body': {'course': datasets.ELECTIVE}},
+             ]})),
+    Scenario('update_score', 'update_student_grade', 'PATCH', 'admin',
+             lambda i, c: ('/students/{0}/score'.format(
+                 cycle(c.dataset.enrollments, i)[0]), {
+                 'course': cycle(c.dataset.enrollments, i)[1],
+                 'score': i % 101})),
+    Scenario('delete_student', 'delete_student', 'DELETE', 'admin',
+             lambda i, c: ('/students/{0}'.format(
+                 c.next_disposable()), None)),
+    # First pages of the most popular (largest) courses' rosters
+    Scenario('course_roster', 'retrieve_course_students', 'GET', 'admin',
+             lambda i, c: ('/courses/{0}/students?sort={1}&limit=50'.format(
+                 i % 10 + 1, ('name', '-score')[i % 2]), None)),
+    Scenario('list_instructors', 'retrieve_instructors', 'GET', 'admin',
+             lambda i, c: ('/instructors?page={0}'.format(
+                 i % max(1, c.dataset.instructors // 10) + 1), None)),
+    Scenario('instructor_details', 'retrieve_instructor_details', 'GET',
+             'admin',
+             lambda i, c: ('/instructors/{0}'.format(
+                 cycle(c.dataset.instructor_ids, i)), None)),
+    Scenario('instructor_dashboard', 'retrieve_instructor_dashboard', 'GET',
+             'admin',
+             lambda i, c: ('/instructors/{0}/dashboard'.format(
+                 cycle(c.dataset.instructor_ids, i)), None)),
+    Scenario('search_instructors', 'search_instructors', 'POST', 'admin',
+             lambda i, c: ('/instructors', {
+                 'search_term': cycle(c.dataset.search_terms, i)})),
+    # Only queues the job (no report worker runs during the suite); the
+    # report_job rows it adds are the one thing a run leaves behind
+    Scenario('create_report', 'create_report', 'POST', 'admin',
+             lambda i, c: ('/reports', {
+                 'kind': ('course_grades', 'report_cards')[i % 2],
+                 'format': ('csv', 'pdf')[i // 2 % 2],
+                 'course_id': i % 10 + 1}), expected=202),
+    Scenario('report_status', 'retrieve_report', 'GET', 'admin',
+             lambda i, c: ('/reports/{0}'.format(c.report_id), None)),
+    # The first request of each worker loads the gradebook; the writes of
+    # the other scenarios patch it
+    Scenario('top_students', 'retrieve_top_students', 'GET', 'admin',
+             lambda i, c: ('/analytics/top-students?limit=50&min_courses={0}'
+                           .format(i % 3 + 1), None)),
+    Scenario('students_at_risk', 'retrieve_students_at_risk', 'GET',
+             'admin',
+             lambda i, c: ('/analytics/at-risk?below={0}&courses=2'.format(
+                 50 + i % 3 * 10), None)),
+    Scenario('course_correlations', 'retrieve_course_correlations', 'GET',
+             'admin',
+             lambda i, c: ('/analytics/course-correlations?limit=20', None)),
+)
+
+
+class Context:
+    '''
+    Context
+    Dataset, tokens and counters shared by the scenarios of one run
+    '''
+
+    def __init__(self, dataset, provider):
+        self.dataset = dataset
+        self.tokens = {
+            'admin': provider.issue_token(role='admin'),
+            'profiler': provider.issue_token(
+                role='admin', permissions=['profile:request']),
+        }
+        # Signing is slow with the pure Python RSA backend, so a few student
+        # tokens are reused for GET /students/myProfile
+        self.student_tokens = [
+            provider.issue_token(role='student', email=email)
+            for _, email in dataset.profiles[:PROFILE_TOKENS]]
+        self.profile_id = None
+        self.report_id = None
+        self._disposable = iter(dataset.disposable_ids)
+        self._lock = threading.Lock()
+
+    def next_disposable(self):
+        with self._lock:
+            return next(self._disposable)
+
+    def headers(self, scenario, i):
+        if scenario.role is None:
+            return {}
+        if callable(scenario.role):
+            token = scenario.role(i, self)
+        else:
+            token = self.tokens[scenario.role]
+        return {'Authorization': 'Bearer ' + token}
+
+
+def run_scenario(base_url, scenario, context, total, concurrency):
+    # Sends `total` requests from `concurrency` closed-loop clients
+    latencies, queries, failures = [], [], []
+    counter = iter(range(total))
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_maxsize=1))
+        while True:
+            with lock:
+                i = next(counter, None)
+                if i is None:
+                    break
+                path, body = scenario.build(i, context)
+            headers = context.headers(scenario, i)
+            start = time.perf_counter()
+            try:
+                response = session.request(
+                    scenario.method, base_url + path, json=body,
+                    headers=headers, timeout=60)
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+            elapsed = time.perf_counter() - start
+            with lock:
+                if status != scenario.expected:
+                    failures.append(status)
+                    continue
+                latencies.append(elapsed)
+                match = QUERY_COUNT.search(
+                    response.headers.get('Server-Timing', ''))
+                if match:
+                    queries.append(int(match.group(1)))
+        session.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': total,
+        'errors': len(failures),
+        'rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'queries_mean': round(sum(queries) / len(queries), 2)
+        if queries else None,
+        'queries_max': max(queries) if queries else None,
+    }
+
+
+def uncovered_routes(app):
+    # Endpoints registered by create_app() that no scenario drives
+    covered = {scenario.endpoint for scenario in SCENARIOS}
+    return sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                  if rule.endpoint != 'static'
+                  and rule.endpoint not in covered)
+
+
+def compare(baseline, current, tolerance):
+    '''
+    compare(baseline, current, tolerance) method
+        @INPUTS
+                baseline, current: suite results (dicts read from JSON)
+                tolerance: allowed relative change of p95 and throughput
+    '''
+    # Returns a list of regression descriptions (empty when none)
+    regressions = []
+    for name, levels in current['results'].items():
+        for level, result in levels.items():
+            base = baseline['results'].get(name, {}).get(level)
+            if base is None:
+                continue
+            label = '{0} @ {1}'.format(name, level)
+            if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+                regressions.append('{0}: p95 {1} ms > {2} ms'.format(
+                    label, result['p95_ms'], base['p95_ms']))
+            if result['rps'] < base['rps'] * (1 - tolerance):
+                regressions.append('{0}: {1} req/s < {2} req/s'.format(
+                    label, result['rps'], base['rps']))
+            # Query counts are deterministic, so any increase counts
+            if (base['queries_max'] is not None
+                    and result['queries_max'] is not None
+                    and result['queries_max'] > base['queries_max']):
+                regressions.append('{0}: {1} queries > {2}'.format(
+                    label, result['queries_max'], base['queries_max']))
+            if result['errors'] > base['errors']:
+                regressions.append('{0}: {1} errors'.format(
+                    label, result['errors']))
+    return regressions
+
+
+def wait_for_server(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(base_url + '/metrics', timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+class InProcessServer:
+    # Threaded werkzeug server running the app in this process
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        return False
+
+
+class GunicornServer:
+    # gunicorn with gunicorn.conf.py in a subprocess, configured through the
+    # environment like the Heroku dyno
+
+    def __init__(self, environ, port, workers):
+        self.url = 'http://127.0.0.1:{0}'.format(port)
+        self.environ = dict(os.environ, PORT=str(port),
+                            WEB_CONCURRENCY=str(workers), **environ)
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            ['gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+            env=self.environ, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        return self
+
+    def __exit__(self, *exc):
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait()
+        return False
+
+
+def print_results(results):
+    print(f'{"route":<20}{"conc":>6}{"req/s":>10}{"p50 ms":>10}'
+          f'{"p95 ms":>10}{"p99 ms":>10}{"queries":>9}{"errors":>8}')
+    for name, levels in results.items():
+        for level, result in levels.items():
+            print(f'{name:<20}{level:>6}{result["rps"]:>10.1f}'
+                  f'{result["p50_ms"]:>10.2f}{result["p95_ms"]:>10.2f}'
+                  f'{result["p99_ms"]:>10.2f}'
+                  f'{str(result["queries_max"]):>9}{result["errors"]:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--students', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and concurrency level')
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--database-url')
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and recreate the tables first')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'),
+                        default='werkzeug')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--admission', action='store_true',
+                        help='keep admission control on (ADMISSION_*)')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--key-file', default=os.path.join(
+        tempfile.gettempdir(), 'cms-benchmark-key.pem'),
+        help='RSA key used to sign tokens (generated when missing)')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    workdir = tempfile.mkdtemp(prefix='cms-benchmark-')
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        workdir, 'cms.db')
+
+    from local_auth import LocalIdentityProvider, load_or_generate_key
+
+    provider = LocalIdentityProvider(
+        private_key=load_or_generate_key(args.key_file)).start()
+    environ = dict(provider.environ(), DATABASE_URL=database_url,
+                   PROFILE_DIR=os.path.join(workdir, 'profiles'),
+                   ADMISSION_ENABLED=str(args.admission).lower(),
+                   METRICS_TOKEN='')
+    os.environ.update(environ)
+    provider.install()
+
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+        start = time.perf_counter()
+        dataset = datasets.generate(
+            args.students, seed=args.seed, sample=args.requests,
+            disposable=args.requests * len(levels))
+        print('Generated {0} in {1:.1f}s'.format(
+            dataset.summary(), time.perf_counter() - start))
+        db.session.remove()
+
+    uncovered = uncovered_routes(app)
+    if uncovered:
+        print('Routes without a benchmark scenario: ' + ', '.join(uncovered))
+
+    context = Context(dataset, provider)
+    if args.server == 'gunicorn':
+        server = GunicornServer(environ, args.port, args.workers)
+    else:
+        server = InProcessServer(app)
+
+    results = {}
+    with server:
+        wait_for_server(server.url)
+        response = requests.get(
+            server.url + '/students', headers={
+                'Authorization': 'Bearer ' + context.tokens['profiler'],
+                'X-Profile': 'sample'})
+        context.profile_id = response.headers['X-Profile-Id']
+        response = requests.post(
+            server.url + '/reports', json={'kind': 'course_grades'},
+            headers={'Authorization': 'Bearer ' + context.tokens['admin']})
+        context.report_id = response.json()['report']['id']
+
+        for scenario in SCENARIOS:
+            results[scenario.name] = {}
+        for level in levels:
+            for scenario in SCENARIOS:
+                results[scenario.name][str(level)] = run_scenario(
+                    server.url, scenario, context, args.requests, level)
+    provider.stop()
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': database_url.split(':', 1)[0],
+            'server': args.server,
+            'seed': args.seed,
+            'dataset': dataset.summary(),
+            'requests': args.requests,
+            'concurrency': levels,
+            'uncovered_routes': uncovered,
+        },
+        'results': results,
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.util import identity_key
+
+from metrics import Counter, Gauge
+from models import db, Student, Instructor, Course, Grade
+
+LOOKUPS = Counter(
+    'cms_cache_requests_total',
+    'Detail cache lookups by cache and result (hit or miss).')
+EVICTIONS = Counter(
+    'cms_cache_evictions_total',
+    'Detail cache evictions by cache and reason (invalidated, capacity or '
+    'expired).')
+ENTRIES = Gauge(
+    'cms_cache_entries',
+    'Entities held in the detail cache.')
+MEMORY = Gauge(
+    'cms_cache_bytes',
+    'Approximate memory used by the cached documents, in bytes.')
+HIT_RATIO = Gauge(
+    'cms_cache_hit_ratio',
+    'Share of detail cache lookups served from the cache.')
+
+# Caches of this process, all invalidated together
+_caches = weakref.WeakSet()
+
+
+def student_key(student_id):
+    return ('student', student_id)
+
+
+def instructor_key(instructor_id):
+    return ('instructor', instructor_id)
+
+
+def dashboard_key(instructor_id):
+    return ('dashboard', instructor_id)
+
+
+class LRUCache:
+    '''
+    LRUCache
+    Bounded LRU of encoded documents. Each entry holds the documents of one
+    entity (e.g. ('student', 22001)), one per field selection.
+    '''
+
+    def __init__(self, name, max_entries=10000, max_bytes=32 * 1024 * 1024,
+                 ttl=60, clock=time.monotonic):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation; a document built before the last
+        # invalidation may be stale and is not stored
+        self.version = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+        ENTRIES.set_function(lambda: len(self), cache=name)
+        MEMORY.set_function(lambda: self.memory_usage(), cache=name)
+        HIT_RATIO.set_function(lambda: self.hit_ratio(), cache=name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def memory_usage(self):
+        return self._bytes
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key, variant):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires'] <= self.clock():
+                self._remove(key)
+                EVICTIONS.inc(cache=self.name, reason='expired')
+                entry = None
+            value = entry['documents'].get(variant) if entry else None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        LOOKUPS.inc(cache=self.name, result='miss' if value is None
+                    else 'hit')
+        return value
+
+    def set(self, key, variant, value, version=None):
+        # Stores value unless an invalidation happened since `version`
+        size = sys.getsizeof(value)
+        with self._lock:
+            if version is not None and version != self.version:
+                return False
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {
+                    'documents': {}, 'size': 0,
+                    'expires': self.clock() + self.ttl}
+            previous = entry['documents'].get(variant)
+            if previous is not None:
+                entry['size'] -= sys.getsizeof(previous)
+                self._bytes -= sys.getsizeof(previous)
+            entry['documents'][variant] = value
+            entry['size'] += size
+            self._bytes += size
+            self._entries.move_to_end(key)
+
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                EVICTIONS.inc(cache=self.name, reason='capacity')
+        return True
+
+    def get_or_build(self, key, variant, build):
+        '''
+        get_or_build(key, variant, build) method
+            @INPUTS
+                    key: entity key (e.g. student_key(22001))
+                    variant: hashable field selection
+                    build: returns the encoded document, or None
+        '''
+        value = self.get(key, variant)
+        if value is not None:
+            return value
+        version = self.version
+        value = build()
+        if value is not None:
+            self.set(key, variant, value, version)
+        return value
+
+    def invalidate(self, keys):
+        # A key with id '*' (e.g. ('student', '*')) evicts the whole kind
+        with self._lock:
+            self.version += 1
+            kinds = {key[0] for key in keys if key[1] == '*'}
+            if kinds:
+                keys = set(keys) | {key for key in self._entries
+                                    if key[0] in kinds}
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+                    EVICTIONS.inc(cache=self.name, reason='invalidated')
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+
+
+def register(local_cache):
+    # Adds a process-local copy of database rows with invalidate(keys) and
+    # clear() methods (e.g. the gradebook) to the caches evicted together
+    _caches.add(local_cache)
+    return local_cache
+
+
+def invalidate(keys):
+    # Evicts keys from every cache of this process
+    keys = set(keys)
+    if keys:
+        for cache in list(_caches):
+            cache.invalidate(keys)
+
+
+def clear_all():
+    for cache in list(_caches):
+        cache.clear()
+
+
+def attribute_values(obj, name):
+    # Current and previous (before this flush) values of an attribute
+    history = inspect(obj).attrs[name].history
+    return {value for values in (history.added, history.unchanged,
+                                 history.deleted)
+            for value in values or () if value is not None}
+
+
+def course_dashboard_keys(session, course_id):
+    # Dashboard keys of the instructor(s) of a course, if the course is in
+    # the session; otherwise every dashboard, rather than query mid-flush
+    course = session.identity_map.get(identity_key(Course, course_id)) \
+        if session is not None else None
+    if course is None:
+        return {('dashboard', '*')}
+    return {dashboard_key(instructor_id) for instructor_id in
+            attribute_values(course, 'instructor_id')}
+
+
+def affected_keys(obj):
+    # Cache keys whose documents include a changed row
+    if isinstance(obj, Student):
+        return {student_key(obj.id)}
+    if isinstance(obj, Instructor):
+        return {instructor_key(obj.id), dashboard_key(obj.id)}
+    if isinstance(obj, Grade):
+        keys = {student_key(student_id) for student_id in
+                attribute_values(obj, 'student_id')}
+        for course_id in attribute_values(obj, 'course_id'):
+            keys |= course_dashboard_keys(object_session(obj), course_id)
+        return keys
+    if isinstance(obj, Course):
+        keys = set()
+        for instructor_id in attribute_values(obj, 'instructor_id'):
+            keys |= {instructor_key(instructor_id),
+                     dashboard_key(instructor_id)}
+        # Transcripts show the course title. Grades are loaded with the
+        # course (lazy='joined'); when they are not, every student document
+        # is dropped rather than queried for during the flush.
+        if 'grades' in inspect(obj).unloaded:
+            keys.add(('student', '*'))
+        else:
+            keys.update(student_key(grade.student_id)
+                        for grade in obj.grades)
+        return keys
+    return set()
+
+
+def mark_dirty(session, keys):
+    '''
+    mark_dirty(session, keys) method
+        @INPUTS
+                session: SQLAlchemy session running the write
+                keys: cache keys (student_key(id), instructor_key(id),
+                      dashboard_key(id))
+    '''
+    # For writes the flush events can't see (Core statements, bulk
+    # updates): the keys are evicted when the session commits
+    session.info.setdefault('cache_invalidations', set()).update(keys)
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_invalidations(session, flush_context):
+    keys = set()
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        keys |= affected_keys(obj)
+    if keys:
+        mark_dirty(session, keys)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_invalidations(session):
+    # Evicted after commit, so a concurrent request can't cache the rows
+    # being replaced after they were evicted (see LRUCache.version).
+    # Releasing a SAVEPOINT (begin_nested) also fires after_commit; its
+    # keys wait for the enclosing transaction.
+    if session.in_nested_transaction():
+        return
+    keys = session.info.pop('cache_invalidations', None)
+    if keys:
+        invalidate(keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_invalidations(session):
+    # Keys are kept when only a SAVEPOINT rolled back (evicting too much is
+    # harmless)
+    if not session.in_nested_transaction():
+        session.info.pop('cache_invalidations', None)
+
+
+def init_app(app):
+    # Registers the detail cache (DETAIL_CACHE_ENABLED)
+    app.config.setdefault('DETAIL_CACHE_ENABLED', True)
+    app.config.setdefault('DETAIL_CACHE_MAX_ENTRIES', 10000)
+    app.config.setdefault('DETAIL_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+    app.config.setdefault('DETAIL_CACHE_TTL', 60)
+    if app.config['DETAIL_CACHE_ENABLED']:
+        app.extensions['detail_cache'] = LRUCache(
+            'detail',
+            max_entries=app.config['DETAIL_CACHE_MAX_ENTRIES'],
+            max_bytes=app.config['DETAIL_CACHE_MAX_BYTES'],
+            ttl=app.config['DETAIL_CACHE_TTL'])
+
+
+def cached(key, variant, build):
+    # Returns build() through the app's detail cache, if enabled. The cache
+    # is bypassed while the session holds uncommitted writes (e.g. in an
+    # atomic POST /batch), which a cached document would not show and a
+    # built one must not outlive.
+    detail_cache = current_app.extensions.get('detail_cache')
+    if detail_cache is None or db.session.info.get('cache_invalidations'):
+        return build()
+    return detail_cache.get_or_build(key, variant, build)
@@ -0,0 +1,394 @@
+'''
+Coalesced score writes (SCORE_COALESCING_ENABLED, off by default).
+
+During live grading an instructor UI sends bursts of PATCH
+/students/<id>/score, often for the same enrollment. With coalescing on,
+the handler checks the enrollment, appends the score to this process's
+write-ahead log (fsync'ed before the response) and returns. A flusher
+thread keeps only the latest score per enrollment and applies them every
+SCORE_FLUSH_INTERVAL seconds (or once SCORE_FLUSH_MAX_ROWS are pending) in
+one transaction and one UPDATE statement.
+
+The log is a series of segment files in SCORE_WAL_DIR, each held under an
+exclusive flock by its process and deleted once its scores are committed.
+Segments left by a process that died are replayed by the next flusher to
+start.
+
+Every write takes a version when it is accepted
+(queries.next_score_version), stored on grade with its score. Flushes,
+recovery and direct writes only replace a score with a later version, so
+the order in which workers flush doesn't matter.
+
+Until the flush the detail endpoints, of the sync and the ASGI app, overlay
+the latest version logged in every segment of the directory on the
+transcript, so a client reads its own writes whichever worker serves it.
+Lists, rosters and dashboards see them after the flush. Every web process
+must therefore share SCORE_WAL_DIR, and the directory must outlive them: a
+Heroku dyno has its own filesystem, wiped on restart, so the mode refuses
+to start there.
+'''
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+from flask import current_app
+
+import cache
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+PENDING = Gauge(
+    'cms_score_writes_pending',
+    'Acknowledged score writes not yet applied to the database.')
+COALESCED = Counter(
+    'cms_score_writes_coalesced_total',
+    'Score writes replaced by a later write to the same enrollment before '
+    'they were applied.')
+FLUSH_ROWS = Histogram(
+    'cms_score_flush_rows',
+    'Scores applied per flush transaction.',
+    buckets=(1, 5, 10, 50, 100, 500, 1000))
+FLUSH_ERRORS = Counter(
+    'cms_score_flush_errors_total',
+    'Flushes that failed and were retried.')
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def enabled(app):
+    return app.config.get('SCORE_COALESCING_ENABLED', False)
+
+
+class ScoreLog:
+    '''
+    ScoreLog
+    Write-ahead log and pending scores of one process, with the thread
+    flushing them to the database
+    '''
+
+    def __init__(self, app, directory, flush_interval=0.5, max_rows=500):
+        self.app = app
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.pid = os.getpid()
+        # {(student_id, course_id): entry}, newest score per enrollment
+        self.pending = {}
+        # Entries of the flush in progress (still pending until committed)
+        self.flushing = {}
+        # Segment files whose scores aren't committed yet
+        self.segments = []
+        self.segment = None
+        self.sequence = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+        PENDING.set_function(lambda: len(self.pending) + len(self.flushing))
+
+    def open_segment(self):
+        self.sequence += 1
+        path = os.path.join(self.directory, 'scores-{0}-{1}.wal'.format(
+            self.pid, self.sequence))
+        segment = open(path, 'a', encoding='utf-8')
+        fcntl.flock(segment, fcntl.LOCK_EX)
+        self.segments.append(segment)
+        return segment
+
+    def append(self, student_id, enrollment, score):
+        '''
+        append(student_id, enrollment, score) method
+            @INPUTS
+                    student_id: student ID
+                    enrollment: (course_id, title, instructor_id) row of the
+                                current enrollment (find_enrollment)
+                    score: new score (or None)
+        '''
+        # Returns once the write is on disk
+        from terms import current_term
+        from queries import next_score_version
+
+        entry = {
+            'term': current_term(),
+            'student_id': student_id,
+            'course_id': enrollment.course_id,
+            'title': enrollment.title,
+            'instructor_id': enrollment.instructor_id,
+            'score': score,
+            'version': next_score_version(),
+        }
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self.segment is None:
+                self.segment = self.open_segment()
+            self.segment.write(line)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            key = (student_id, enrollment.course_id)
+            if key in self.pending:
+                COALESCED.inc()
+            self.pending[key] = latest(self.pending.get(key), entry)
+            full = len(self.pending) >= self.max_rows
+
+        # Documents cached by this process no longer match; the flush's
+        # commit evicts them everywhere else
+        cache.invalidate(invalidation_keys([entry]))
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        # Applies the pending scores in one transaction. Returns the number
+        # of scores written; on failure they are kept for the next flush.
+        with self._flush_lock:
+            with self._lock:
+                if not self.pending:
+                    return 0
+                batch, self.pending = self.pending, {}
+                self.flushing = batch
+                segments, self.segments = self.segments, []
+                self.segment = None
+
+            try:
+                apply_entries(self.app, list(batch.values()))
+            except Exception:
+                FLUSH_ERRORS.inc()
+                logger.exception('Flushing %d scores failed', len(batch))
+                with self._lock:
+                    # Scores written since take precedence
+                    for key, entry in batch.items():
+                        self.pending[key] = latest(
+                            entry, self.pending.get(key))
+                    self.flushing = {}
+                    self.segments = segments + self.segments
+                return 0
+
+            with self._lock:
+                self.flushing = {}
+            for segment in segments:
+                remove_segment(segment)
+            FLUSH_ROWS.observe(len(batch))
+            return len(batch)
+
+    def recover(self):
+        # Replays the segments of processes that died before flushing them.
+        # Segments still locked belong to a live process.
+        recovered = 0
+        for path in sorted(glob.glob(os.path.join(
+                self.directory, 'scores-*.wal')), key=segment_order):
+            segment = open(path, 'r+', encoding='utf-8')
+            try:
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                segment.close()
+                continue
+            entries = {}
+            for line in segment:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn final write: it was never acknowledged
+                    break
+                key = (entry['term'], entry['student_id'],
+                       entry['course_id'])
+                entries[key] = latest(entries.get(key), entry)
+            if entries:
+                apply_entries(self.app, list(entries.values()))
+                recovered += len(entries)
+            remove_segment(segment)
+        if recovered:
+            logger.info('Recovered %d scores from %s', recovered,
+                        self.directory)
+        return recovered
+
+    def run(self):
+        from models import db
+
+        try:
+            self.recover()
+        except Exception:
+            logger.exception('Recovering scores from %s failed',
+                             self.directory)
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            db.session.remove()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name='cms-score-flusher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Flushes what is left (graceful shutdown)
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+
+
+def segment_order(path):
+    # Segments of a process are replayed in the order they were written
+    pid, _, sequence = os.path.basename(path)[7:-4].partition('-')
+    return int(pid), int(sequence)
+
+
+def version(entry):
+    # Entries logged before versions existed replay as the oldest writes, in
+    # the order of their lines
+    return entry.get('version', 1)
+
+
+def latest(entry, other):
+    # Returns the later of two writes to an enrollment, other on a tie
+    # (either may be None)
+    if entry is None or (
+            other is not None and version(other) >= version(entry)):
+        return other
+    return entry
+
+
+def remove_segment(segment):
+    # Deletes a segment while still holding its lock, so no other process
+    # replays it
+    os.unlink(segment.name)
+    segment.close()
+
+
+def invalidation_keys(entries):
+    keys = set()
+    for entry in entries:
+        keys.add(cache.student_key(entry['student_id']))
+        if entry['instructor_id'] is not None:
+            keys.add(cache.dashboard_key(entry['instructor_id']))
+    return keys
+
+
+def apply_entries(app, entries):
+    from models import db
+    from queries import apply_scores
+
+    with app.app_context():
+        for start in range(0, len(entries), 500):
+            apply_scores(entries[start:start + 500])
+        cache.mark_dirty(db.session, invalidation_keys(entries))
+        db.session.commit()
+
+
+def get_log(app):
+    # Returns this process's log, starting its flusher on first use (in each
+    # gunicorn worker, not in the preloading master)
+    global _log
+    if _log is not None and _log.pid == os.getpid():
+        return _log
+    with _log_lock:
+        if _log is None or _log.pid != os.getpid():
+            _log = ScoreLog(
+                app, app.config['SCORE_WAL_DIR'],
+                app.config['SCORE_FLUSH_INTERVAL'],
+                app.config['SCORE_FLUSH_MAX_ROWS']).start()
+    return _log
+
+
+def pending_scores(student_ids):
+    '''
+    pending_scores(student_ids) method
+        @INPUTS
+                student_ids: IDs of the students whose transcripts are read
+    '''
+    # Returns {(student_id, course title): (version, score)} of the latest
+    # writes logged by every process sharing SCORE_WAL_DIR and not applied
+    # yet. Read before the transcripts: a segment is only deleted once its
+    # scores are committed, so no write is missed in between.
+    if not enabled(current_app):
+        return {}
+    from terms import current_term
+
+    return read_pending(current_app.config['SCORE_WAL_DIR'], current_term(),
+                        set(student_ids))
+
+
+def read_pending(directory, term, student_ids=None):
+    '''
+    read_pending(directory, term, student_ids) method
+        @INPUTS
+                directory: SCORE_WAL_DIR
+                term: term of the transcripts read
+                student_ids: set of student IDs, or None for every student
+    '''
+    # pending_scores() without an app context (the ASGI app)
+    scores = {}
+    # Segments are read in any order: the versions order the writes
+    for path in glob.glob(os.path.join(directory, 'scores-*.wal')):
+        try:
+            with open(path, encoding='utf-8') as segment:
+                lines = segment.readlines()
+        except FileNotFoundError:
+            # Committed since the directory was listed
+            continue
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A write still in progress
+                break
+            if entry['term'] != term or (
+                    student_ids is not None and
+                    entry['student_id'] not in student_ids):
+                continue
+            key = (entry['student_id'], entry['title'])
+            if key not in scores or version(entry) >= scores[key][0]:
+                scores[key] = (version(entry), entry['score'])
+    return scores
+
+
+def overlay(student_id, grades, scores):
+    '''
+    overlay(student_id, grades, scores) method
+        @INPUTS
+                student_id: student ID
+                grades: the student's transcript ([{'course', 'score'}], with
+                        each score's 'version' when scores isn't empty)
+                scores: pending_scores() read before the transcript
+    '''
+    # Replaces the scores of pending writes later than the committed ones in
+    # a transcript (read your writes on the detail endpoints)
+    for grade in grades:
+        committed = grade.pop('version', 0)
+        pending = scores.get((student_id, grade['course']))
+        if pending is not None and pending[0] > committed:
+            grade['score'] = pending[1]
+    return grades
+
+
+def shutdown():
+    # Flushes this process's pending scores (gunicorn worker_exit)
+    if _log is not None and _log.pid == os.getpid():
+        _log.stop()
+
+
+def init_app(app):
+    app.config.setdefault('SCORE_COALESCING_ENABLED', False)
+    app.config.setdefault('SCORE_WAL_DIR', 'wal')
+    app.config.setdefault('SCORE_FLUSH_INTERVAL', 0.5)
+    app.config.setdefault('SCORE_FLUSH_MAX_ROWS', 500)
+    if enabled(app):
+        check_host()
+
+
+def check_host():
+    if 'DYNO' in os.environ:
+        # Acknowledged scores would be lost on a dyno restart, and other
+        # dynos couldn't read them back before the flush
+        raise ValueError('SCORE_COALESCING_ENABLED needs a SCORE_WAL_DIR '
+                         'shared by every web process that survives '
+                         'restarts, which a Heroku dyno does not have')
@@ -0,0 +1,267 @@
+import logging
+import os
+import select
+import threading
+import uuid
+from sqlalchemy import event, func, select as sql_select
+from sqlalchemy.orm import Session
+
+import cache
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# Postgres channel carrying cache invalidations between workers and dynos
+CHANNEL = 'cms_cache'
+
+# NOTIFY payloads must stay under 8000 bytes
+MAX_PAYLOAD = 7900
+
+# Compact names of the cache key kinds in messages
+KINDS = {'student': 's', 'instructor': 'i', 'dashboard': 'd'}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+
+SENT = Counter(
+    'cms_cache_notifications_sent_total',
+    'Cache invalidation messages published with NOTIFY.')
+RECEIVED = Counter(
+    'cms_cache_notifications_received_total',
+    'Cache invalidation messages received from other processes.')
+RECONNECTS = Counter(
+    'cms_cache_listener_reconnects_total',
+    'Times the LISTEN connection was re-established.')
+CONNECTED = Gauge(
+    'cms_cache_listener_connected',
+    '1 while this worker is listening for cache invalidations.')
+
+_origin = None
+_origin_pid = None
+
+
+def origin():
+    # Identifies this process in its own messages (new after fork)
+    global _origin, _origin_pid
+    if _origin_pid != os.getpid():
+        _origin, _origin_pid = uuid.uuid4().hex[:8], os.getpid()
+    return _origin
+
+
+def encode(keys, sender=None):
+    '''
+    encode(keys, sender) method
+        @INPUTS
+                keys: cache keys (e.g. {('student', 22001)})
+                sender: origin id of the publishing process
+    '''
+    # Returns payloads like "1f3a9c2e|s:22001,22002;i:2201", split so each
+    # fits in one NOTIFY
+    sender = sender or origin()
+    ids = {}
+    for kind, key in sorted(keys, key=str):
+        ids.setdefault(KINDS[kind], []).append(str(key))
+
+    payloads, groups, size = [], {}, len(sender) + 1
+    for code, values in sorted(ids.items()):
+        for value in values:
+            # "code:" opens a new group, "," separates values and groups
+            cost = len(value) + 1 + (0 if code in groups else len(code) + 1)
+            if groups and size + cost > MAX_PAYLOAD:
+                payloads.append(format_payload(sender, groups))
+                groups, size = {}, len(sender) + 1
+                cost = len(value) + len(code) + 2
+            groups.setdefault(code, []).append(value)
+            size += cost
+    if groups:
+        payloads.append(format_payload(sender, groups))
+    return payloads
+
+
+def format_payload(sender, groups):
+    return sender + '|' + ';'.join(
+        code + ':' + ','.join(values) for code, values in groups.items())
+
+
+def decode(payload):
+    # Returns (sender, keys) of a message built by encode()
+    sender, _, body = payload.partition('|')
+    keys = set()
+    for part in body.split(';'):
+        code, _, values = part.partition(':')
+        kind = KIND_NAMES.get(code)
+        if kind is None:
+            continue
+        for value in values.split(','):
+            keys.add((kind, value if value == '*' else int(value)))
+    return sender, keys
+
+
+def publishing(session):
+    bind = session.get_bind()
+    return bind.dialect.name == 'postgresql' and \
+        session.info.get('cache_notify', _enabled)
+
+
+def publish_pending(session):
+    # NOTIFY is transactional: messages sent here are delivered when the
+    # transaction commits, and dropped if it rolls back
+    keys = session.info.get('cache_invalidations')
+    if not keys or not publishing(session):
+        return
+    published = session.info.setdefault('cache_published', set())
+    pending = keys - published
+    if not pending:
+        return
+    for payload in encode(pending):
+        session.execute(sql_select(func.pg_notify(CHANNEL, payload)))
+        SENT.inc()
+    published |= pending
+
+
+@event.listens_for(Session, 'after_flush')
+def publish_after_flush(session, flush_context):
+    # Registered after cache.collect_invalidations, so the keys of this
+    # flush are already collected
+    publish_pending(session)
+
+
+@event.listens_for(Session, 'before_commit')
+def publish_before_commit(session):
+    # Keys added with cache.mark_dirty() after the last flush
+    publish_pending(session)
+
+
+@event.listens_for(Session, 'after_commit')
+def reset_published(session):
+    # Not when a SAVEPOINT is released: the enclosing transaction still
+    # holds the messages sent so far
+    if not session.in_nested_transaction():
+        session.info.pop('cache_published', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_published(session):
+    # A rolled back SAVEPOINT drops its messages too; everything still
+    # pending is sent again before the commit
+    session.info.pop('cache_published', None)
+
+
+class InvalidationListener:
+    '''
+    InvalidationListener
+    Thread holding a dedicated connection that LISTENs on CHANNEL and evicts
+    the keys other processes publish from this process's caches
+    '''
+
+    def __init__(self, engine, channel=CHANNEL, poll_interval=5.0,
+                 retry_interval=1.0):
+        self.engine = engine
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.pid = os.getpid()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def handle(self, payload):
+        sender, keys = decode(payload)
+        if sender == origin():
+            # Already evicted by this process's own commit
+            return
+        RECEIVED.inc()
+        cache.invalidate(keys)
+
+    def connect(self):
+        # A connection detached from the pool, in autocommit mode
+        connection = self.engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        cursor = dbapi_connection.cursor()
+        cursor.execute('LISTEN {0}'.format(self.channel))
+        cursor.close()
+        return dbapi_connection
+
+    def listen(self, dbapi_connection):
+        while not self._stop.is_set():
+            readable, _, _ = select.select(
+                [dbapi_connection], [], [], self.poll_interval)
+            if not readable:
+                continue
+            dbapi_connection.poll()
+            while dbapi_connection.notifies:
+                self.handle(dbapi_connection.notifies.pop(0).payload)
+
+    def run(self):
+        first = True
+        while not self._stop.is_set():
+            dbapi_connection = None
+            try:
+                dbapi_connection = self.connect()
+                if not first:
+                    # Messages sent while disconnected are lost
+                    RECONNECTS.inc()
+                    cache.clear_all()
+                first = False
+                CONNECTED.set(1)
+                self.listen(dbapi_connection)
+            except Exception:
+                logger.exception('Cache invalidation listener failed, '
+                                 'reconnecting in %.1fs', self.retry_interval)
+                first = False
+            finally:
+                CONNECTED.set(0)
+                if dbapi_connection is not None:
+                    try:
+                        dbapi_connection.close()
+                    except Exception:
+                        pass
+            self._stop.wait(self.retry_interval)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name='cms-cache-listener', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+_enabled = False
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def ensure_listener(engine):
+    # Starts one listener per process, on the first request so it runs in
+    # each gunicorn worker and not in the preloading master
+    global _listener
+    if _listener is not None and _listener.pid == os.getpid():
+        return _listener
+    with _listener_lock:
+        if _listener is None or _listener.pid != os.getpid():
+            _listener = InvalidationListener(engine).start()
+    return _listener
+
+
+def init_app(app):
+    # Publishes and consumes cache invalidations through Postgres
+    # LISTEN/NOTIFY when the detail cache or the gradebook is enabled
+    # (CACHE_NOTIFY_ENABLED)
+    global _enabled
+    app.config.setdefault('CACHE_NOTIFY_ENABLED', True)
+    _enabled = app.config['CACHE_NOTIFY_ENABLED'] and (
+        app.extensions.get('detail_cache') is not None or
+        app.extensions.get('gradebook') is not None)
+    if not _enabled:
+        return
+
+    from models import db
+
+    @app.before_request
+    def start_cache_listener():
+        engine = db.get_engine(app)
+        if engine.dialect.name == 'postgresql':
+            ensure_listener(engine)
@@ -0,0 +1,179 @@
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+
+# Content types worth compressing
+COMPRESS_MIMETYPES = (
+    'application/json',
+    'text/csv',
+    'text/html',
+    'text/plain',
+)
+
+
+class GzipCompressor:
+    '''
+    Incremental gzip compressor
+    '''
+    encoding = 'gzip'
+
+    def __init__(self, level):
+        # wbits=31 writes a gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    '''
+    Incremental brotli compressor (only used when brotli is installed)
+    '''
+    encoding = 'br'
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def parse_accept_encoding(header):
+    # Returns {encoding: q} for the Accept-Encoding request header
+    accepted = {}
+    for part in header.split(','):
+        params = part.strip().split(';')
+        encoding = params[0].strip().lower()
+        if not encoding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[encoding] = q
+    return accepted
+
+
+def negotiate_encoding(header, algorithms):
+    '''
+    negotiate_encoding(header, algorithms) method
+        @INPUTS
+                header: Accept-Encoding request header
+                algorithms: server supported encodings in order of preference
+    '''
+    # Picks the client's highest q-value encoding, breaking ties with the
+    # server's order of preference. Returns None if nothing is acceptable.
+    accepted = parse_accept_encoding(header or '')
+    best, best_q = None, 0.0
+    for encoding in algorithms:
+        if encoding == 'br' and brotli is None:
+            continue
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def make_compressor(encoding, config):
+    if encoding == 'br':
+        return BrotliCompressor(config['COMPRESS_BR_LEVEL'])
+    return GzipCompressor(config['COMPRESS_LEVEL'])
+
+
+def compress_stream(chunks, compressor, close=None):
+    # Compresses a streamed (chunked) response body chunk by chunk
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if close is not None:
+            close()
+
+
+def should_compress(response, min_size):
+    # Skips informational, empty and 304 responses, responses that are
+    # already encoded and content types that don't compress well
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    if response.mimetype not in COMPRESS_MIMETYPES:
+        return False
+    if response.direct_passthrough:
+        return False
+    if response.is_streamed:
+        # Unknown size; only skip if a small Content-Length was declared
+        length = response.content_length
+        return length is None or length >= min_size
+    return response.content_length is None or \
+        response.content_length >= min_size
+
+
+def compress_response(response, config):
+    '''
+    compress_response(response, config) method
+        @INPUTS
+                response: outgoing flask response
+                config: app config holding the COMPRESS_* settings
+    '''
+    if not config['COMPRESS_ENABLED']:
+        return response
+    if request.method == 'HEAD':
+        return response
+    if not should_compress(response, config['COMPRESS_MIN_SIZE']):
+        return response
+
+    encoding = negotiate_encoding(
+        request.headers.get('Accept-Encoding'),
+        config['COMPRESS_ALGORITHMS'])
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+
+    compressor = make_compressor(encoding, config)
+    if response.is_streamed:
+        response.response = compress_stream(
+            response.response, compressor,
+            getattr(response.response, 'close', None))
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compressor.compress(body) + compressor.flush())
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    # Registers negotiated gzip/brotli compression for large responses
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BR_LEVEL', 4)
+    app.config.setdefault('COMPRESS_ALGORITHMS', ('br', 'gzip'))
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, app.config)
@@ -0,0 +1,410 @@
+'''
+Worker-local gradebook for the cross-course analytics endpoints.
+
+Each worker holds the scores of the current term as a student x course
+matrix (float32 scores plus a boolean mask of the scored enrollments). It is
+loaded on the first analytics request with one streamed query over grade,
+then kept up to date like the detail cache: the keys evicted by this
+process's commits, and those published by other workers on Postgres (see
+coherence.py), mark students dirty, and the next analytics request re-reads
+the scores of those students only. ('student', '*'), more than
+GRADEBOOK_PATCH_LIMIT dirty students or a matrix older than
+GRADEBOOK_MAX_AGE seconds (the bound on staleness when invalidation
+messages aren't delivered) trigger a full load instead.
+
+The matrix takes about 5 bytes per student and course of the term, plus a
+quarter of spare rows (65MB for 200,000 students and 50 courses). numpy is
+imported on first use; without it the analytics endpoints answer 503.
+'''
+import importlib.util
+import threading
+import time
+from itertools import chain
+
+import cache
+from metrics import Counter, Gauge, Histogram
+
+LOADS = Counter(
+    'cms_gradebook_loads_total',
+    'Full loads of the gradebook matrix by reason (initial, invalidated, '
+    'expired or term).')
+PATCHED = Counter(
+    'cms_gradebook_patched_students_total',
+    'Students whose scores were read again to patch the gradebook.')
+LOAD_SECONDS = Histogram(
+    'cms_gradebook_load_seconds',
+    'Time spent loading the gradebook matrix from grade.')
+SCORES = Gauge(
+    'cms_gradebook_scores',
+    'Scored enrollments held in the gradebook matrix.')
+MEMORY = Gauge(
+    'cms_gradebook_bytes',
+    'Memory used by the gradebook matrix, in bytes.')
+
+# Rows converted at once while loading, and multiplied at once by the
+# course correlations (bounds the temporary float64 copies)
+LOAD_CHUNK_ROWS = 50000
+CORRELATION_CHUNK_ROWS = 65536
+
+
+def available():
+    # numpy is an optional dependency of the analytics endpoints
+    return importlib.util.find_spec('numpy') is not None
+
+
+def score_array(query):
+    '''
+    score_array(query) method
+        @INPUTS
+                query: query of (student_id, course_id, score) rows
+                       (queries.scored_grades)
+    '''
+    # Returns the rows as an (n, 3) int64 array. They are fetched from the
+    # DBAPI cursor in chunks (a server-side cursor on Postgres), skipping
+    # the Row objects, which cost 5 times more than the fetch itself.
+    import numpy as np
+    from models import db
+
+    result = db.session.connection().execute(
+        query.statement.execution_options(stream_results=True))
+    parts = []
+    try:
+        while True:
+            chunk = result.cursor.fetchmany(LOAD_CHUNK_ROWS)
+            if not chunk:
+                break
+            parts.append(np.fromiter(chain.from_iterable(chunk), np.int64,
+                                     len(chunk) * 3).reshape(-1, 3))
+    finally:
+        result.close()
+    if not parts:
+        return np.empty((0, 3), np.int64)
+    return np.concatenate(parts)
+
+
+class Gradebook:
+    '''
+    Gradebook
+    Scores of the current term as a student x course matrix, patched when
+    the cache invalidations of this process name a student
+    '''
+
+    def __init__(self, max_age=300, patch_limit=5000, clock=time.monotonic):
+        self.max_age = max_age
+        self.patch_limit = patch_limit
+        self.clock = clock
+        self.term = None
+        self.loaded_at = None
+        # Scores (0 where missing) and mask of the scored cells. Rows past
+        # self.size are spare capacity for new students.
+        self.scores = None
+        self.mask = None
+        self.student_ids = None
+        self.course_ids = None
+        # Scored courses and score total of each row (kept by load and
+        # patch, so rankings don't scan the matrix)
+        self.counts = None
+        self.totals = None
+        self.rows = {}
+        self.columns = {}
+        self.size = 0
+        # Bumped by every load and patch; (version, min_students, pairs) of
+        # the last correlations computed
+        self.version = 0
+        self._correlations = None
+        # Students written since the last refresh, and the reason for a
+        # full load, if one is due
+        self._dirty = set()
+        self._reload = 'initial'
+        self._dirty_lock = threading.Lock()
+        self._lock = threading.Lock()
+        cache.register(self)
+
+        SCORES.set_function(lambda: self.scored())
+        MEMORY.set_function(lambda: self.memory_usage())
+
+    def scored(self):
+        counts = self.counts
+        return int(counts[:self.size].sum()) if counts is not None else 0
+
+    def memory_usage(self):
+        arrays = (self.scores, self.mask, self.student_ids, self.course_ids,
+                  self.counts, self.totals)
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def invalidate(self, keys):
+        # Called by cache.invalidate() after commits and for the messages of
+        # other workers: only marks students, the next request reads them
+        students = set()
+        reload = False
+        for kind, key_id in keys:
+            if kind == 'student':
+                if key_id == '*':
+                    reload = True
+                else:
+                    students.add(key_id)
+        with self._dirty_lock:
+            if reload:
+                self._reload = 'invalidated'
+            self._dirty |= students
+
+    def clear(self):
+        with self._dirty_lock:
+            self._reload = 'invalidated'
+
+    def refresh(self):
+        # Brings the matrix up to date; called with self._lock held
+        from models import db
+        from terms import current_term
+
+        term = current_term()
+        with self._dirty_lock:
+            reason = self._reload
+            if reason is None and term != self.term:
+                reason = 'term'
+            if reason is None and self.max_age and \
+                    self.clock() - self.loaded_at >= self.max_age:
+                reason = 'expired'
+            if reason is None and len(self._dirty) > self.patch_limit:
+                reason = 'invalidated'
+            dirty, self._dirty = self._dirty, set()
+            self._reload = None
+
+        try:
+            if reason is not None:
+                self.load(term, reason)
+            elif dirty:
+                self.patch(dirty)
+        except Exception:
+            with self._dirty_lock:
+                self._reload = self._reload or reason
+                self._dirty |= dirty
+            raise
+
+        # Uncommitted writes of this session (an atomic POST /batch) were
+        # read too: those students are read again after it ends
+        pending = db.session.info.get('cache_invalidations')
+        if pending:
+            self.invalidate(pending)
+
+    def load(self, term, reason):
+        '''
+        load(term, reason) method
+            @INPUTS
+                    term: term of the grades to load
+                    reason: load reason (metric label)
+        '''
+        # Reads every scored enrollment of the term in one streamed query
+        import numpy as np
+        from queries import scored_grades
+
+        started = time.perf_counter()
+        data = score_array(scored_grades(term=term))
+        student_ids, rows = np.unique(data[:, 0], return_inverse=True)
+        course_ids, columns = np.unique(data[:, 1], return_inverse=True)
+        size = len(student_ids)
+        capacity = size + size // 4 + 16
+
+        scores = np.zeros((capacity, len(course_ids)), np.float32)
+        mask = np.zeros((capacity, len(course_ids)), bool)
+        scores[rows, columns] = data[:, 2]
+        mask[rows, columns] = True
+        self.student_ids = np.zeros(capacity, np.int64)
+        self.student_ids[:size] = student_ids
+        self.course_ids = course_ids
+        self.scores, self.mask = scores, mask
+        self.counts = np.count_nonzero(mask, axis=1)
+        self.totals = scores.sum(axis=1, dtype=np.float64)
+        self.rows = dict(zip(student_ids.tolist(), range(size)))
+        self.columns = dict(zip(course_ids.tolist(), range(len(course_ids))))
+        self.size = size
+        self.term = term
+        self.loaded_at = self.clock()
+        self.version += 1
+
+        LOADS.inc(reason=reason)
+        LOAD_SECONDS.observe(time.perf_counter() - started)
+
+    def patch(self, student_ids):
+        # Replaces the scores of some students (500 per query)
+        import numpy as np
+        from queries import scored_grades
+
+        student_ids = sorted(student_ids)
+        data = [score_array(scored_grades(student_ids[start:start + 500],
+                                          self.term))
+                for start in range(0, len(student_ids), 500)]
+
+        known = [self.rows[student_id] for student_id in student_ids
+                 if student_id in self.rows]
+        self.scores[known] = 0
+        self.mask[known] = False
+        for rows in data:
+            for student_id, course_id, score in rows.tolist():
+                row, column = self.row(student_id), self.column(course_id)
+                self.scores[row, column] = score
+                self.mask[row, column] = True
+                known.append(row)
+        self.counts[known] = np.count_nonzero(self.mask[known], axis=1)
+        self.totals[known] = self.scores[known].sum(axis=1, dtype=np.float64)
+        self.version += 1
+
+        PATCHED.inc(len(student_ids))
+
+    def row(self, student_id):
+        # Row of a student, taken from the spare capacity when new
+        row = self.rows.get(student_id)
+        if row is None:
+            if self.size == len(self.student_ids):
+                self.grow(rows=max(self.size // 2, 16))
+            row = self.rows[student_id] = self.size
+            self.student_ids[row] = student_id
+            self.size += 1
+        return row
+
+    def column(self, course_id):
+        # Column of a course, added when new
+        import numpy as np
+
+        column = self.columns.get(course_id)
+        if column is None:
+            self.grow(columns=1)
+            column = self.columns[course_id] = len(self.course_ids)
+            self.course_ids = np.append(self.course_ids, course_id)
+        return column
+
+    def grow(self, rows=0, columns=0):
+        import numpy as np
+
+        height, width = self.scores.shape
+        scores = np.zeros((height + rows, width + columns), np.float32)
+        mask = np.zeros((height + rows, width + columns), bool)
+        scores[:height, :width] = self.scores
+        mask[:height, :width] = self.mask
+        self.scores, self.mask = scores, mask
+        if rows:
+            self.student_ids, self.counts, self.totals = (
+                np.concatenate((array, np.zeros(rows, array.dtype)))
+                for array in (self.student_ids, self.counts, self.totals))
+
+    def top_students(self, limit, min_courses=1):
+        '''
+        top_students(limit, min_courses) method
+            @INPUTS
+                    limit: number of students to return
+                    min_courses: scored courses needed to be ranked
+        '''
+        # Returns [(student id, average score, scored courses)], best
+        # average first (then by id)
+        import numpy as np
+
+        with self._lock:
+            self.refresh()
+            counts = self.counts[:self.size]
+            ranked = np.flatnonzero(counts >= max(min_courses, 1))
+            averages = self.totals[ranked] / counts[ranked]
+            if len(ranked) > limit:
+                # Only the students at or above the limit-th best average
+                # are sorted
+                cutoff = np.partition(
+                    averages, len(averages) - limit)[len(averages) - limit]
+                keep = averages >= cutoff
+                ranked, averages = ranked[keep], averages[keep]
+            order = np.lexsort((self.student_ids[ranked], -averages))
+            return [(int(self.student_ids[ranked[i]]), float(averages[i]),
+                     int(counts[ranked[i]])) for i in order[:limit]]
+
+    def at_risk(self, below, courses, offset, limit):
+        '''
+        at_risk(below, courses, offset, limit) method
+            @INPUTS
+                    below: scores under this value count as failing
+                    courses: failing courses needed to be listed
+                    offset: students to skip
+                    limit: number of students to return
+        '''
+        # Returns the number of students failing at least `courses` courses
+        # and one page of [(student id, [(course id, score)])], most failing
+        # courses first (then by id)
+        import numpy as np
+
+        with self._lock:
+            self.refresh()
+            scores, mask = self.scores[:self.size], self.mask[:self.size]
+            failing = mask & (scores < below)
+            counts = np.count_nonzero(failing, axis=1)
+            matched = np.flatnonzero(counts >= courses)
+            order = np.lexsort((self.student_ids[matched], -counts[matched]))
+            page = matched[order[offset:offset + limit]]
+            return len(matched), [
+                (int(self.student_ids[row]),
+                 [(int(self.course_ids[column]), int(scores[row, column]))
+                  for column in np.flatnonzero(failing[row])])
+                for row in page]
+
+    def course_correlations(self, min_students):
+        '''
+        course_correlations(min_students) method
+            @INPUTS
+                    min_students: students scored in both courses needed
+                                  for a pair to be listed
+        '''
+        # Returns [(course id, course id, Pearson correlation, students)]
+        # of every pair of courses, strongest correlation first. Computed
+        # once per version of the matrix.
+        with self._lock:
+            self.refresh()
+            if self._correlations is None or \
+                    self._correlations[:2] != (self.version, min_students):
+                self._correlations = (self.version, min_students,
+                                      self.correlate(min_students))
+            return self._correlations[2]
+
+    def correlate(self, min_students):
+        # Sums over the students scored in both courses of each pair, from
+        # matrix products: n = M'M, sx = X'M (sum of the first course's
+        # scores), sxx = (X*X)'M and sxy = X'X
+        import numpy as np
+
+        width = len(self.course_ids)
+        n, sx, sxx, sxy = (np.zeros((width, width)) for _ in range(4))
+        for start in range(0, self.size, CORRELATION_CHUNK_ROWS):
+            stop = min(start + CORRELATION_CHUNK_ROWS, self.size)
+            x = self.scores[start:stop].astype(np.float64)
+            m = self.mask[start:stop].astype(np.float64)
+            n += m.T @ m
+            sx += x.T @ m
+            sxx += (x * x).T @ m
+            sxy += x.T @ x
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = sxy - sx * sx.T / n
+            variance = sxx - sx * sx / n
+            correlation = covariance / np.sqrt(variance * variance.T)
+
+        first, second = np.triu_indices(width, k=1)
+        valid = (n[first, second] >= max(min_students, 2)) & \
+            (variance[first, second] > 1e-6) & \
+            (variance[second, first] > 1e-6)
+        first, second = first[valid], second[valid]
+        values = np.clip(correlation[first, second], -1, 1)
+        order = np.lexsort((second, first, -np.abs(values)))
+        return [(int(self.course_ids[first[i]]),
+                 int(self.course_ids[second[i]]), float(values[i]),
+                 int(n[first[i], second[i]])) for i in order]
+
+
+def get_gradebook(app):
+    # This process's gradebook, or None when numpy isn't installed
+    return app.extensions.get('gradebook')
+
+
+def init_app(app):
+    # Registers the gradebook; its matrix is loaded on first use, so in
+    # each gunicorn worker and not in the preloading master
+    app.config.setdefault('GRADEBOOK_MAX_AGE', 300)
+    app.config.setdefault('GRADEBOOK_PATCH_LIMIT', 5000)
+    if available():
+        app.extensions['gradebook'] = Gradebook(
+            max_age=app.config['GRADEBOOK_MAX_AGE'],
+            patch_limit=app.config['GRADEBOOK_PATCH_LIMIT'])
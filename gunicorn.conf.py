@@ -0,0 +1,81 @@
+# Production gunicorn settings, used by the Procfile:
+#     gunicorn -c gunicorn.conf.py app:app
+#
+# The app is imported once in the master (preload_app) and shared with the
+# workers. Each worker then drops the connections inherited from the master
+# and warms itself up (pool, hot statements, JWKS) before it accepts
+# traffic.
+#
+# Workers are recycled after max_requests (+ jitter so they don't all
+# restart at once); a recycled worker finishes its in-flight requests
+# while the others keep accepting. To deploy new code without dropping
+# requests send USR2 to the master (starts a new master and workers from
+# the new code), then WINCH and QUIT to the old master once the new workers
+# are up. HUP only restarts workers and does not reload preloaded code.
+import os
+
+bind = "0.0.0.0:{0}".format(os.getenv("PORT", "8000"))
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+# The admission limits (admission.py) count requests per worker, so they
+# only engage with more threads than a route class may use: 16 threads
+# against read=8, heavy=2, write=4. At most 14 requests run at once, within
+# the 15 connections of a worker's pool (5 plus 10 overflow).
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+preload_app = True
+
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 100))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+accesslog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+warmup_enabled = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+
+
+def when_ready(server):
+    # Configure the mappers once in the master so every worker inherits them
+    from sqlalchemy.orm import configure_mappers
+    import admission
+    from settings import get_settings
+
+    configure_mappers()
+
+    limits = admission.parse_limits(get_settings().admission_limits,
+                                    admission.DEFAULT_LIMITS)
+    if threads <= max(limits.values()):
+        server.log.warning("Admission limits %s never engage with %s "
+                           "threads per worker", limits, threads)
+
+
+def post_fork(server, worker):
+    from app import app
+    from warmup import reset_connections
+
+    reset_connections(app)
+
+
+def worker_exit(server, worker):
+    # Applies the score writes still pending in the worker's write-ahead
+    # log (SCORE_COALESCING_ENABLED)
+    import coalescing
+
+    coalescing.shutdown()
+
+
+def post_worker_init(worker):
+    # Runs in the worker after the app is loaded and before it accepts
+    # connections
+    if not warmup_enabled:
+        return
+
+    from app import app
+    from warmup import warm_up, format_timings
+
+    # The pool keeps 5 connections; opening more would only close them again
+    timings = warm_up(app, connections=min(threads, 5))
+    worker.log.info("Worker %s warmed up in %s", worker.pid,
+                    format_timings(timings))
@@ -0,0 +1,278 @@
+import threading
+import time
+
+from metrics import Counter, Gauge
+from settings import get_settings
+
+
+class IdentityProviderError(Exception):
+    '''
+    IdentityProviderError Exception
+    Raised when the identity provider can't be reached, times out, fails or
+    is short-circuited by the circuit breaker
+    '''
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class CircuitBreaker:
+    '''
+    Circuit breaker around calls to one remote dependency.
+
+    closed: calls go through; failure_threshold consecutive failures open it.
+    open: calls fail fast until reset_timeout seconds have passed.
+    half_open: a single trial call is let through; success closes the
+    circuit, failure opens it again.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and \
+                    self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        # Returns True if a call may be attempted now
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        # Returns True if this failure opened the circuit
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or \
+                    self._failures >= self.failure_threshold:
+                opened = self._state != self.OPEN
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                return opened
+            return False
+
+
+# Circuit state exported as a number: 0 closed, 1 half open, 2 open
+CIRCUIT_STATE_VALUES = {
+    CircuitBreaker.CLOSED: 0,
+    CircuitBreaker.HALF_OPEN: 1,
+    CircuitBreaker.OPEN: 2,
+}
+
+IDP_REQUESTS = Counter(
+    'cms_idp_requests_total',
+    'Outbound identity provider calls by endpoint and outcome.')
+IDP_CIRCUIT_OPENED = Counter(
+    'cms_idp_circuit_opened_total',
+    'Number of times the identity provider circuit opened.')
+IDP_CIRCUIT_STATE = Gauge(
+    'cms_idp_circuit_state',
+    'Identity provider circuit state (0 closed, 1 half open, 2 open).')
+IDP_JWKS_AGE = Gauge(
+    'cms_idp_jwks_cache_age_seconds',
+    'Age of the cached JWKS document (-1 when nothing is cached).')
+
+
+class IdentityProviderClient:
+    '''
+    Outbound HTTP client for the identity provider (Auth0).
+
+    All calls share one pooled keep-alive session, use connect/read
+    timeouts and go through one circuit breaker. The JWKS document is cached
+    for jwks_ttl seconds and the last good copy keeps being served while the
+    provider is degraded.
+    '''
+
+    def __init__(self, domain=None, jwks_url=None, userinfo_url=None,
+                 connect_timeout=2.0, read_timeout=5.0, jwks_ttl=600.0,
+                 jwks_min_refresh=30.0, pool_size=10, failure_threshold=5,
+                 reset_timeout=30.0, clock=time.monotonic):
+        self.jwks_url = jwks_url or \
+            f'https://{domain}/.well-known/jwks.json'
+        self.userinfo_url = userinfo_url or f'https://{domain}/userinfo'
+        self.timeout = (connect_timeout, read_timeout)
+        self.jwks_ttl = jwks_ttl
+        self.jwks_min_refresh = jwks_min_refresh
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, clock)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._jwks = None
+        self._jwks_fetched_at = None
+
+        # requests is imported with the first client, not with the app
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._requests = requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size,
+                              max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _get(self, endpoint, url, headers=None):
+        # Performs one GET through the circuit breaker. Connection errors,
+        # timeouts and 5xx responses count as failures; 4xx responses are
+        # the caller's problem and don't trip the breaker.
+        if not self.breaker.allow():
+            IDP_REQUESTS.inc(endpoint=endpoint, outcome='short_circuited')
+            raise IdentityProviderError(
+                'Identity provider circuit is open.')
+
+        try:
+            response = self.session.get(url, headers=headers,
+                                        timeout=self.timeout)
+        except self._requests.Timeout:
+            self._failure(endpoint, 'timeout')
+            raise IdentityProviderError('Identity provider timed out.')
+        except self._requests.RequestException:
+            self._failure(endpoint, 'error')
+            raise IdentityProviderError('Identity provider unreachable.')
+
+        if response.status_code >= 500:
+            self._failure(endpoint, 'error')
+            raise IdentityProviderError(
+                'Identity provider returned an error.', response.status_code)
+
+        self.breaker.record_success()
+        IDP_REQUESTS.inc(endpoint=endpoint, outcome='success')
+        if response.status_code >= 400:
+            raise IdentityProviderError(
+                'Identity provider rejected the request.',
+                response.status_code)
+        return response
+
+    def _failure(self, endpoint, outcome):
+        IDP_REQUESTS.inc(endpoint=endpoint, outcome=outcome)
+        if self.breaker.record_failure():
+            IDP_CIRCUIT_OPENED.inc()
+
+    def jwks_age(self):
+        # Seconds since the cached JWKS was fetched, or None
+        with self._lock:
+            if self._jwks_fetched_at is None:
+                return None
+            return self._clock() - self._jwks_fetched_at
+
+    def get_jwks(self, refresh=False):
+        '''
+        get_jwks(refresh) method
+            @INPUTS
+                    refresh: bypass the TTL (e.g. on an unknown key id)
+        '''
+        # Forced refreshes are rate limited so unknown key ids can't be used
+        # to hammer the provider
+        age = self.jwks_age()
+        max_age = self.jwks_min_refresh if refresh else self.jwks_ttl
+        if age is not None and age < max_age:
+            return self._jwks
+
+        try:
+            jwks = self._get('jwks', self.jwks_url).json()
+        except (IdentityProviderError, ValueError):
+            # Serve the last good keys while the provider is degraded
+            if self._jwks is not None:
+                return self._jwks
+            raise IdentityProviderError('Unable to fetch signing keys.')
+
+        with self._lock:
+            self._jwks = jwks
+            self._jwks_fetched_at = self._clock()
+        return jwks
+
+    def get_userinfo(self, token):
+        '''
+        get_userinfo(token) method
+            @INPUTS
+                    token: access token of the signed-in user
+        '''
+        response = self._get('userinfo', self.userinfo_url,
+                             headers={'Authorization': f'Bearer {token}'})
+        try:
+            return response.json()
+        except ValueError:
+            raise IdentityProviderError(
+                'Identity provider returned invalid JSON.')
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def create_client():
+    # Builds the client from the settings
+    settings = get_settings()
+    return IdentityProviderClient(
+        domain=settings.auth0_domain,
+        jwks_url=settings.jwks_url,
+        userinfo_url=settings.userinfo_url,
+        connect_timeout=settings.idp_connect_timeout,
+        read_timeout=settings.idp_read_timeout,
+        jwks_ttl=settings.idp_jwks_ttl,
+        pool_size=settings.idp_pool_size,
+        failure_threshold=settings.idp_failure_threshold,
+        reset_timeout=settings.idp_reset_timeout,
+    )
+
+
+def get_client():
+    # Returns the process wide identity provider client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                set_client(create_client())
+    return _client
+
+
+def reset_client():
+    # Drops the process wide client so the next call builds a new one (used
+    # after fork so workers don't share the master's connections)
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def set_client(client):
+    # Replaces the process wide client (used by tests and benchmarks)
+    global _client
+    _client = client
+    IDP_CIRCUIT_STATE.set_function(
+        lambda: CIRCUIT_STATE_VALUES[client.breaker.state])
+    IDP_JWKS_AGE.set_function(
+        lambda: -1 if client.jwks_age() is None else client.jwks_age())
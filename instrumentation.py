@@ -0,0 +1,132 @@
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Counter, Histogram
+
+# Per-request phases reported in the Server-Timing header
+PHASES = ('auth', 'db', 'encode')
+
+REQUESTS = Counter(
+    'cms_http_requests_total',
+    'HTTP requests by route, method and status.')
+REQUEST_DURATION = Histogram(
+    'cms_http_request_duration_seconds',
+    'Request latency by route and method.')
+PHASE_DURATION = Histogram(
+    'cms_http_request_phase_seconds',
+    'Time spent per request in auth, db and encode, by route.')
+QUERY_COUNT = Histogram(
+    'cms_http_request_queries',
+    'SQL statements executed per request, by route.',
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+
+
+def record(phase, seconds):
+    '''
+    record(phase, seconds) method
+        @INPUTS
+                phase: 'auth', 'db' or 'encode'
+                seconds: time spent in the phase
+    '''
+    # Adds time to the current request's phase (no-op outside a request or
+    # when instrumentation is disabled)
+    if has_request_context():
+        timings = g.get('timings')
+        if timings is not None:
+            timings[phase] += seconds
+
+
+class timed:
+    '''
+    Context manager recording the time spent in its block under phase
+    '''
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.phase, time.perf_counter() - self.start)
+        return False
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('cms_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    starts = conn.info.get('cms_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context() and g.get('timings') is not None:
+        g.timings['db'] += elapsed
+        g.query_count += 1
+
+
+def route_label():
+    # Route template (e.g. /students/<int:student_id>) to keep label
+    # cardinality bounded
+    if request.url_rule is not None:
+        return request.url_rule.rule
+    return 'unmatched'
+
+
+def server_timing(timings, query_count, total):
+    # Formats the Server-Timing header value (durations in ms)
+    entries = []
+    for phase in PHASES:
+        entry = '{0};dur={1:.2f}'.format(phase, timings[phase] * 1000)
+        if phase == 'db':
+            entry += ';desc="{0} queries"'.format(query_count)
+        entries.append(entry)
+    entries.append('total;dur={0:.2f}'.format(total * 1000))
+    return ', '.join(entries)
+
+
+def init_app(app):
+    # Registers per-request timing, the Server-Timing header and the
+    # Prometheus histograms
+    app.config.setdefault('INSTRUMENTATION_ENABLED', True)
+    app.config.setdefault('SERVER_TIMING_ENABLED', True)
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.timings = dict.fromkeys(PHASES, 0.0)
+        g.query_count = 0
+
+    @app.after_request
+    def stop_timer(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        timings = g.timings
+        route = route_label()
+
+        if app.config['SERVER_TIMING_ENABLED']:
+            response.headers['Server-Timing'] = server_timing(
+                timings, g.query_count, total)
+
+        if route != '/metrics':
+            REQUESTS.inc(route=route, method=request.method,
+                         status=response.status_code)
+            REQUEST_DURATION.observe(total, route=route,
+                                     method=request.method)
+            for phase in PHASES:
+                PHASE_DURATION.observe(timings[phase], route=route,
+                                       phase=phase)
+            QUERY_COUNT.observe(g.query_count, route=route)
+        return response
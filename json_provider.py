@@ -0,0 +1,120 @@
+import json
+import time
+import datetime
+import decimal
+import uuid
+from flask import current_app
+
+from instrumentation import record
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speed-up
+    orjson = None
+
+
+def json_default(obj):
+    # Serializes the non-JSON types that can come back from the database
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if hasattr(obj, '_asdict'):
+        # SQLAlchemy Row tuples
+        return obj._asdict()
+    raise TypeError(
+        f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class StdlibEncoder:
+    '''
+    JSON encoder backed by the standard library json module
+    '''
+    name = 'stdlib'
+
+    def dumps(self, obj, pretty=False, sort_keys=True):
+        if pretty:
+            text = json.dumps(obj, indent=2, separators=(', ', ': '),
+                              sort_keys=sort_keys, default=json_default)
+        else:
+            text = json.dumps(obj, separators=(',', ':'),
+                              sort_keys=sort_keys, default=json_default)
+        return text.encode('utf-8')
+
+
+class OrjsonEncoder:
+    '''
+    JSON encoder backed by orjson (only used when orjson is installed)
+    '''
+    name = 'orjson'
+
+    def dumps(self, obj, pretty=False, sort_keys=True):
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=json_default, option=option)
+
+
+def get_encoder(backend='auto'):
+    '''
+    get_encoder(backend) method
+        @INPUTS
+                backend: 'auto', 'orjson' or 'stdlib'
+    '''
+    # 'auto' picks orjson when installed and falls back to stdlib otherwise
+    if backend == 'auto':
+        backend = 'orjson' if orjson is not None else 'stdlib'
+
+    if backend == 'orjson':
+        if orjson is None:
+            raise RuntimeError('JSON_BACKEND is "orjson" but orjson is not '
+                               'installed.')
+        return OrjsonEncoder()
+    if backend == 'stdlib':
+        return StdlibEncoder()
+    raise ValueError(f'Unknown JSON_BACKEND "{backend}".')
+
+
+def init_app(app):
+    # Registers the configured encoder on the app
+    app.config.setdefault('JSON_BACKEND', 'auto')
+    app.extensions['json_encoder'] = get_encoder(app.config['JSON_BACKEND'])
+
+
+def dumps(obj, app=None):
+    # Encodes obj to bytes with the app's encoder. Output is compact unless
+    # the app runs in debug mode or JSONIFY_PRETTYPRINT_REGULAR is set.
+    app = app or current_app
+    encoder = app.extensions.get('json_encoder') or get_encoder()
+    pretty = app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug
+    start = time.perf_counter()
+    data = encoder.dumps(obj, pretty=pretty,
+                         sort_keys=app.config['JSON_SORT_KEYS'])
+    record('encode', time.perf_counter() - start)
+    return data
+
+
+def jsonify(*args, **kwargs):
+    # Drop-in replacement for flask.jsonify that goes through the configured
+    # encoder instead of flask.json
+    if args and kwargs:
+        raise TypeError(
+            'jsonify() behavior undefined when passed both args and kwargs')
+    elif len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    return json_response(dumps(data))
+
+
+def json_response(body):
+    # Response for an already encoded JSON document (e.g. from the cache)
+    return current_app.response_class(
+        body + b'\n',
+        mimetype=current_app.config['JSONIFY_MIMETYPE'],
+    )
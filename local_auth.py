@@ -0,0 +1,224 @@
+'''
+Offline stand-in for the Auth0 tenant, used by the benchmark suite and the
+tests. It signs tokens with a local RSA key and serves the matching JWKS and
+a /userinfo endpoint over HTTP, so auth.py verifies them exactly as it does
+Auth0 tokens.
+
+    provider = LocalIdentityProvider().start()
+    provider.install()          # points the settings at the stand-in
+    token = provider.issue_token(role='admin')
+    ...
+    provider.stop()
+'''
+import base64
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Permissions of the Auth0 roles (see "User Roles" in the README)
+STUDENT_PERMISSIONS = (
+    'get:student-profile',
+    'get:instructors',
+    'get:instructor_profile',
+    'post:instructor_search',
+    'enroll:student-course',
+    'unenroll:student-course',
+    'get:my-student-profile',
+)
+INSTRUCTOR_PERMISSIONS = (
+    'get:instructors',
+    'get:instructor_profile',
+    'post:instructor_search',
+    'get:students',
+    'get:student-profile',
+    'post:student_search',
+    'patch:student_edit',
+    'post:reports',
+)
+ADMIN_PERMISSIONS = tuple(sorted(
+    set(STUDENT_PERMISSIONS + INSTRUCTOR_PERMISSIONS) | {'delete:student_id'}))
+
+ROLE_PERMISSIONS = {
+    'student': STUDENT_PERMISSIONS,
+    'instructor': INSTRUCTOR_PERMISSIONS,
+    'admin': ADMIN_PERMISSIONS,
+}
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def generate_key(key_size=2048):
+    # Returns (private key PEM, public numbers (n, e)). Uses the `rsa`
+    # package, which python-jose already depends on.
+    import rsa
+
+    public_key, private_key = rsa.newkeys(key_size)
+    return private_key.save_pkcs1().decode('ascii'), (public_key.n,
+                                                      public_key.e)
+
+
+def load_or_generate_key(path, key_size=2048):
+    # Key generation takes seconds in pure Python, so keys can be kept in a
+    # file and reused across runs
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read()
+    private_key, _ = generate_key(key_size)
+    # Written under a temporary name first, as parallel test workers may
+    # race to create the same file
+    temporary = '{0}.{1}'.format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(private_key)
+    os.replace(temporary, path)
+    return private_key
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Serves /.well-known/jwks.json and /userinfo for the provider bound to
+    # the server
+
+    def do_GET(self):
+        provider = self.server.provider
+        if self.path == '/.well-known/jwks.json':
+            self.send_json(200, provider.jwks())
+        elif self.path == '/userinfo':
+            userinfo = provider.userinfo(self.headers.get('Authorization'))
+            if userinfo is None:
+                self.send_json(401, {'error': 'invalid_token'})
+            else:
+                self.send_json(200, userinfo)
+        else:
+            self.send_json(404, {'error': 'not_found'})
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalIdentityProvider:
+    '''
+    LocalIdentityProvider
+    Signs tokens with a local RSA key and serves the JWKS and /userinfo
+    '''
+
+    def __init__(self, domain='cms.local', audience='cms',
+                 kid='local-key', key_size=2048, private_key=None):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        if private_key is None:
+            private_key, public_numbers = generate_key(key_size)
+        else:
+            import rsa
+
+            key = rsa.PrivateKey.load_pkcs1(private_key.encode('ascii'))
+            public_numbers = (key.n, key.e)
+        self.private_key = private_key
+        self.public_numbers = public_numbers
+        self.emails = {}
+        self.server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.provider = self
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def environ(self):
+        # Settings that make auth.py trust this provider instead of Auth0
+        return {
+            'AUTH0_DOMAIN': self.domain,
+            'API_AUDIENCE': self.audience,
+            'ALGORITHMS': 'RS256',
+            'JWKS_URL': self.url + '/.well-known/jwks.json',
+            'USERINFO_URL': self.url + '/userinfo',
+        }
+
+    def install(self):
+        # Applies environ() to this process and drops the cached settings
+        # and identity provider client
+        from identity_provider import reset_client
+        from settings import reload_settings
+
+        os.environ.update(self.environ())
+        reload_settings()
+        reset_client()
+
+    def jwks(self):
+        n, e = self.public_numbers
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': b64url_uint(n),
+            'e': b64url_uint(e),
+        }]}
+
+    def issue_token(self, role=None, permissions=(), email=None, sub=None,
+                    expires_in=3600):
+        '''
+        issue_token(role, permissions, email, sub, expires_in) method
+            @INPUTS
+                    role: 'student', 'instructor' or 'admin' (optional)
+                    permissions: extra permissions (list of strings)
+                    email: email returned by /userinfo for this token
+        '''
+        from jose import jwt
+
+        sub = sub or 'local|' + uuid.uuid4().hex
+        if email is not None:
+            self.emails[sub] = email
+        granted = set(ROLE_PERMISSIONS.get(role, ())) | set(permissions)
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + self.domain + '/',
+            'sub': sub,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': sorted(granted),
+        }
+        return jwt.encode(claims, self.private_key, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def userinfo(self, authorization):
+        # Returns the profile of a token issued by this provider
+        from jose import jwt
+
+        if not authorization or not authorization.startswith('Bearer '):
+            return None
+        try:
+            claims = jwt.get_unverified_claims(authorization.split()[1])
+        except Exception:
+            return None
+        sub = claims.get('sub')
+        return {'sub': sub, 'email': self.emails.get(sub)}
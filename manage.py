@@ -1,6 +1,7 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
+import terms
 from app import app
 from models import db
 
@@ -10,5 +11,37 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+# Partitions of the grade table, one per term (Postgres, see terms.py)
+@manager.command
+def create_term(term):
+    "Creates the grade partition of a term"
+    with db.engine.begin() as connection:
+        terms.create_partition(connection, term)
+
+
+@manager.command
+def detach_term(term):
+    "Detaches a past term's grade partition, keeping it as a table"
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as connection:
+        terms.detach_partition(connection, term)
+
+
+@manager.command
+def attach_term(term):
+    "Attaches a detached term's table to the grade table again"
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as connection:
+        terms.attach_partition(connection, term)
+
+
+@manager.command
+def list_terms():
+    "Lists the grade partitions"
+    with db.engine.connect() as connection:
+        for name, bounds in terms.list_partitions(connection):
+            print(name, bounds)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,206 @@
+import bisect
+import os
+import threading
+
+
+# Minimal Prometheus text-format metrics. Values are kept per process, so
+# with several gunicorn workers each worker reports its own series, told
+# apart by a pid label (a scrape reaches one worker at random, and its
+# counters restart with it).
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''
+    Base class of a named metric with optional labels
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry or REGISTRY).register(self)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        # Returns a list of (name, labels, value)
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in self._values.items()]
+
+    def render(self, labels=()):
+        # labels: (name, value) pairs added to every sample
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.documentation),
+            '# TYPE {0} {1}'.format(self.name, self.kind),
+        ]
+        for name, sample_labels, value in self.samples():
+            lines.append('{0}{1} {2}'.format(
+                name, format_labels(sample_labels + tuple(labels)),
+                format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    '''
+    Monotonically increasing value
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    '''
+    Value that can go up and down, or be read from a callback at scrape time
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, registry=None):
+        super().__init__(name, documentation, registry)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        # function() is called every time the gauge is rendered
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def value(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            function = self._functions.get(key)
+            if function is None:
+                return self._values.get(key, 0)
+        return function()
+
+    def samples(self):
+        samples = super().samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            samples.append((self.name, key, function()))
+        return samples
+
+
+class Histogram(Metric):
+    '''
+    Distribution of observed values in cumulative buckets
+    '''
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                       0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS,
+                 registry=None):
+        super().__init__(name, documentation, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [count per bucket (+Inf last), sum, count]
+                state = self._values[key] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(state[0]), state[1], state[2])
+                      for key, state in self._values.items()]
+
+        samples = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(
+                    self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket',
+                                key + (('le', format_value(float(bound))),),
+                                cumulative))
+            samples.append((self.name + '_sum', key, total))
+            samples.append((self.name + '_count', key, count))
+        return samples
+
+
+class Registry:
+    '''
+    Collection of metrics rendered together on /metrics
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(
+                    'Metric "{0}" is already registered.'.format(metric.name))
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self, labels=()):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(
+            metric.render(labels) for metric in metrics) + '\n'
+
+
+def process_labels():
+    # Labels of the series of this process (evaluated after the fork)
+    return (('pid', os.getpid()),)
+
+
+REGISTRY = Registry()
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
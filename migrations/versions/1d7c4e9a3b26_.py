@@ -0,0 +1,26 @@
+"""report job claim attempts
+
+Revision ID: 1d7c4e9a3b26
+Revises: f6b3d8a2c915
+Create Date: 2026-10-19 23:10:45.218630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1d7c4e9a3b26'
+down_revision = 'f6b3d8a2c915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('report_job',
+                  sa.Column('attempt', sa.Integer(), nullable=False,
+                            server_default='0'))
+
+
+def downgrade():
+    op.drop_column('report_job', 'attempt')
@@ -0,0 +1,24 @@
+"""grade course/score index for the course roster
+
+Revision ID: 3b9e4c2a7d51
+Revises: 7fdc6d318117
+Create Date: 2026-10-19 10:12:31.204817
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e4c2a7d51'
+down_revision = '7fdc6d318117'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_grade_course_score', 'grade',
+                    ['course_id', 'score', 'student_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_grade_course_score', table_name='grade')
@@ -0,0 +1,134 @@
+"""grade terms, grade partitioned by term on postgres
+
+Revision ID: 5e8a2f6c1b94
+Revises: 9c41d7e2b6a8
+Create Date: 2026-10-19 16:27:05.884310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from settings import get_settings
+from terms import check_term, partition_name, DEFAULT_PARTITION
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8a2f6c1b94'
+down_revision = '9c41d7e2b6a8'
+branch_labels = None
+depends_on = None
+
+
+def existing_term():
+    # Term given to the grades recorded before terms existed
+    return check_term(get_settings().current_term)
+
+
+def grade_table(*extra):
+    # grade without its unique constraint (batch mode copies it from here)
+    return sa.Table(
+        'grade', sa.MetaData(),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('score', sa.Integer(), nullable=True),
+        sa.Column('course_id', sa.Integer(), nullable=True),
+        sa.Column('student_id', sa.Integer(), nullable=True),
+        *extra,
+        sa.ForeignKeyConstraint(['course_id'], ['course.id'], ),
+        sa.ForeignKeyConstraint(['student_id'], ['student.id'], ),
+        sa.PrimaryKeyConstraint('id'))
+
+
+def upgrade():
+    term = existing_term()
+    if op.get_bind().dialect.name != 'postgresql':
+        op.drop_index('ix_grade_course_score', table_name='grade')
+        with op.batch_alter_table('grade', copy_from=grade_table(),
+                                  recreate='always') as batch_op:
+            batch_op.add_column(sa.Column('term', sa.String(), nullable=False,
+                                          server_default=term))
+            batch_op.create_unique_constraint(
+                'grade_term_course_id_student_id_key',
+                ['term', 'course_id', 'student_id'])
+        op.create_index('ix_grade_course_score', 'grade',
+                        ['term', 'course_id', 'score', 'student_id'],
+                        unique=False)
+        return
+
+    # A table can't be partitioned in place: the rows are copied into a new
+    # partitioned grade table (the existing ids and sequence are kept). The
+    # copy locks grade for its duration; later terms only add partitions.
+    op.execute('ALTER SEQUENCE grade_id_seq OWNED BY NONE')
+    op.execute('ALTER TABLE grade RENAME TO grade_unpartitioned')
+    op.execute('ALTER TABLE grade_unpartitioned DROP CONSTRAINT grade_pkey')
+    op.execute('ALTER TABLE grade_unpartitioned '
+               'DROP CONSTRAINT grade_course_id_student_id_key')
+    op.drop_index('ix_grade_course_score', table_name='grade_unpartitioned')
+
+    # Unique constraints of a partitioned table must include the term
+    op.execute(
+        'CREATE TABLE grade ('
+        'id INTEGER NOT NULL DEFAULT nextval(\'grade_id_seq\'), '
+        'score INTEGER, '
+        'course_id INTEGER REFERENCES course (id), '
+        'student_id INTEGER REFERENCES student (id), '
+        'term VARCHAR NOT NULL DEFAULT \'{0}\', '
+        'CONSTRAINT grade_pkey PRIMARY KEY (id, term), '
+        'CONSTRAINT grade_term_course_id_student_id_key '
+        'UNIQUE (term, course_id, student_id)'
+        ') PARTITION BY LIST (term)'.format(term))
+    op.create_index('ix_grade_course_score', 'grade',
+                    ['term', 'course_id', 'score', 'student_id'],
+                    unique=False)
+    op.execute('CREATE TABLE {0} PARTITION OF grade DEFAULT'.format(
+        DEFAULT_PARTITION))
+    op.execute('CREATE TABLE {0} PARTITION OF grade '
+               'FOR VALUES IN (\'{1}\')'.format(partition_name(term), term))
+
+    op.execute('INSERT INTO grade (id, score, course_id, student_id, term) '
+               'SELECT id, score, course_id, student_id, \'{0}\' '
+               'FROM grade_unpartitioned'.format(term))
+    op.execute('DROP TABLE grade_unpartitioned')
+    op.execute('ALTER SEQUENCE grade_id_seq OWNED BY grade.id')
+
+
+def downgrade():
+    term = existing_term()
+    if op.get_bind().dialect.name != 'postgresql':
+        op.drop_index('ix_grade_course_score', table_name='grade')
+        with op.batch_alter_table('grade', copy_from=grade_table(
+                sa.Column('term', sa.String(), nullable=False)),
+                recreate='always') as batch_op:
+            batch_op.drop_column('term')
+            batch_op.create_unique_constraint(
+                'grade_course_id_student_id_key', ['course_id', 'student_id'])
+        op.create_index('ix_grade_course_score', 'grade',
+                        ['course_id', 'score', 'student_id'], unique=False)
+        return
+
+    # One enrollment per course and student is kept: the current term's,
+    # or the latest one. Detached terms are left alone.
+    op.execute('ALTER SEQUENCE grade_id_seq OWNED BY NONE')
+    op.execute('ALTER TABLE grade RENAME TO grade_partitioned')
+    op.execute('ALTER TABLE grade_partitioned DROP CONSTRAINT grade_pkey')
+    op.execute('ALTER TABLE grade_partitioned '
+               'DROP CONSTRAINT grade_term_course_id_student_id_key')
+    op.drop_index('ix_grade_course_score', table_name='grade_partitioned')
+
+    op.execute(
+        'CREATE TABLE grade ('
+        'id INTEGER NOT NULL DEFAULT nextval(\'grade_id_seq\'), '
+        'score INTEGER, '
+        'course_id INTEGER REFERENCES course (id), '
+        'student_id INTEGER REFERENCES student (id), '
+        'CONSTRAINT grade_pkey PRIMARY KEY (id), '
+        'CONSTRAINT grade_course_id_student_id_key '
+        'UNIQUE (course_id, student_id))')
+    op.create_index('ix_grade_course_score', 'grade',
+                    ['course_id', 'score', 'student_id'], unique=False)
+    op.execute('INSERT INTO grade (id, score, course_id, student_id) '
+               'SELECT DISTINCT ON (course_id, student_id) '
+               'id, score, course_id, student_id FROM grade_partitioned '
+               'ORDER BY course_id, student_id, term = \'{0}\' DESC, id DESC'
+               .format(term))
+    op.execute('DROP TABLE grade_partitioned')
+    op.execute('ALTER SEQUENCE grade_id_seq OWNED BY grade.id')
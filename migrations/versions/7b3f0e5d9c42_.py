@@ -0,0 +1,33 @@
+"""grade score versions
+
+Revision ID: 7b3f0e5d9c42
+Revises: 1d7c4e9a3b26
+Create Date: 2026-10-19 23:52:18.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3f0e5d9c42'
+down_revision = '1d7c4e9a3b26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing scores take version 0, so any logged write is newer
+    op.add_column('grade',
+                  sa.Column('score_version', sa.BigInteger(), nullable=False,
+                            server_default='0'))
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(sa.schema.CreateSequence(
+            sa.Sequence('grade_score_version_seq')))
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(sa.schema.DropSequence(
+            sa.Sequence('grade_score_version_seq')))
+    op.drop_column('grade', 'score_version')
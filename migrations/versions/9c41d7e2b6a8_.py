@@ -0,0 +1,40 @@
+"""report job queue
+
+Revision ID: 9c41d7e2b6a8
+Revises: 3b9e4c2a7d51
+Create Date: 2026-10-19 14:03:52.617204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c41d7e2b6a8'
+down_revision = '3b9e4c2a7d51'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('report_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('output_format', sa.String(), nullable=False),
+    sa.Column('params', sa.String(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('output_size', sa.Integer(), nullable=True),
+    sa.Column('output', sa.LargeBinary(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_report_job_status', 'report_job',
+                    ['status', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_report_job_status', table_name='report_job')
+    op.drop_table('report_job')
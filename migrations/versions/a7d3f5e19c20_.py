@@ -0,0 +1,24 @@
+"""grade term/student index for transcripts and gradebook patches
+
+Revision ID: a7d3f5e19c20
+Revises: 5e8a2f6c1b94
+Create Date: 2026-10-19 18:42:16.530917
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3f5e19c20'
+down_revision = '5e8a2f6c1b94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_grade_student', 'grade', ['term', 'student_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_grade_student', table_name='grade')
@@ -0,0 +1,45 @@
+"""drop the default grade partition
+
+Revision ID: c4e8b1d7f362
+Revises: a7d3f5e19c20
+Create Date: 2026-10-19 20:05:48.117342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from terms import partition_name, DEFAULT_PARTITION
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8b1d7f362'
+down_revision = 'a7d3f5e19c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A default partition makes DETACH ... CONCURRENTLY fail and has to be
+    # scanned under lock by every new partition. Rows it holds are moved to
+    # partitions of their own terms.
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE grade DETACH PARTITION {0}'.format(
+        DEFAULT_PARTITION))
+    for term, in op.get_bind().execute(sa.text(
+            'SELECT DISTINCT term FROM {0}'.format(DEFAULT_PARTITION))):
+        op.execute('CREATE TABLE IF NOT EXISTS {0} PARTITION OF grade '
+                   'FOR VALUES IN (\'{1}\')'.format(
+                       partition_name(term), term))
+        op.execute('INSERT INTO grade (id, score, course_id, student_id, '
+                   'term) SELECT id, score, course_id, student_id, term '
+                   'FROM {0} WHERE term = \'{1}\''.format(
+                       DEFAULT_PARTITION, term))
+    op.execute('DROP TABLE {0}'.format(DEFAULT_PARTITION))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE TABLE {0} PARTITION OF grade DEFAULT'.format(
+        DEFAULT_PARTITION))
@@ -0,0 +1,34 @@
+"""unique lower(title) index on course
+
+Revision ID: e2a9c5f4b817
+Revises: c4e8b1d7f362
+Create Date: 2026-10-19 21:14:02.481653
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a9c5f4b817'
+down_revision = 'c4e8b1d7f362'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Titles differing only by case have to be renamed before the index can
+    # be built; name them rather than fail on an anonymous violation.
+    duplicates = [title for title, in op.get_bind().execute(sa.text(
+        'SELECT lower(title) FROM course GROUP BY lower(title) '
+        'HAVING count(*) > 1'))]
+    if duplicates:
+        raise RuntimeError(
+            'course titles differ only by case: {0}'.format(
+                ', '.join(duplicates)))
+    op.create_index('ix_course_lower_title', 'course',
+                    [sa.text('lower(title)')], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_course_lower_title', table_name='course')
@@ -0,0 +1,28 @@
+"""report job lease
+
+Revision ID: f6b3d8a2c915
+Revises: e2a9c5f4b817
+Create Date: 2026-10-19 21:52:37.904125
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6b3d8a2c915'
+down_revision = 'e2a9c5f4b817'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('report_job',
+                  sa.Column('heartbeat_at', sa.DateTime(), nullable=True))
+    # Jobs running now keep the lease they had under the started_at rule
+    op.execute("UPDATE report_job SET heartbeat_at = started_at "
+               "WHERE status = 'running'")
+
+
+def downgrade():
+    op.drop_column('report_job', 'heartbeat_at')
@@ -0,0 +1,268 @@
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from flask import g, request, current_app
+
+# Permission required (in addition to the route's own) to profile a request
+PROFILE_PERMISSION = 'profile:request'
+
+# Request header (or ?profile= argument) selecting the profiler
+PROFILE_HEADER = 'X-Profile'
+PROFILE_MODES = ('cprofile', 'sample')
+
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def frame_label(code):
+    # Spaces and semicolons are separators in the collapsed format
+    label = '{0}:{1}'.format(
+        os.path.splitext(os.path.basename(code.co_filename))[0],
+        code.co_name)
+    return label.replace(' ', '_').replace(';', '_')
+
+
+def collapse_stack(frame):
+    # Returns a frame's stack, outermost first, in the collapsed stack format
+    # used by flamegraph tools ("module:function;module:function")
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler:
+    '''
+    Sampling profiler. A background thread records the stacks of the target
+    threads (one thread, or every other thread when thread_id is None)
+    every interval seconds into collapsed-stack counts.
+    '''
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        frames = sys._current_frames()
+        own = threading.get_ident()
+        if self.thread_id is not None:
+            frames = {self.thread_id: frames.get(self.thread_id)}
+        with self._lock:
+            for thread_id, frame in frames.items():
+                if frame is None or thread_id == own:
+                    continue
+                self.stacks[collapse_stack(frame)] += 1
+            self.samples += 1
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name='cms-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def drain(self):
+        # Returns and clears the collected stacks
+        with self._lock:
+            stacks, self.stacks = self.stacks, Counter()
+            self.samples = 0
+        return stacks
+
+
+def format_collapsed(stacks):
+    return ''.join('{0} {1}\n'.format(stack, count)
+                   for stack, count in sorted(stacks.items()))
+
+
+def requested_mode():
+    # Returns the profiler asked for by the current request, if any
+    mode = request.headers.get(PROFILE_HEADER) or \
+        request.args.get('profile')
+    if mode is None:
+        return None
+    mode = mode.lower()
+    if mode in ('1', 'true'):
+        return 'cprofile'
+    return mode if mode in PROFILE_MODES else None
+
+
+def profile_call(mode, f, *args, **kwargs):
+    '''
+    profile_call(mode, f, *args, **kwargs) method
+        @INPUTS
+                mode: 'cprofile' or 'sample'
+                f: view function to run under the profiler
+    '''
+    # The profile is written after the response is built (see init_app), so
+    # it can be tagged with the status code
+    start = time.perf_counter()
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(f, *args, **kwargs)
+        finally:
+            g.profile = {'mode': mode, 'profiler': profiler,
+                         'duration': time.perf_counter() - start}
+
+    sampler = Sampler(
+        interval=current_app.config['PROFILE_SAMPLE_INTERVAL'],
+        thread_id=threading.get_ident()).start()
+    try:
+        return f(*args, **kwargs)
+    finally:
+        sampler.stop()
+        g.profile = {'mode': mode, 'stacks': sampler.drain(),
+                     'duration': time.perf_counter() - start}
+
+
+def profile_path(directory, profile_id, extension):
+    return os.path.join(directory, '{0}.{1}'.format(profile_id, extension))
+
+
+def save_profile(profile, directory, status):
+    # Writes the profile (.pstats or .collapsed) and its metadata (.json)
+    os.makedirs(directory, exist_ok=True)
+    profile_id = uuid.uuid4().hex
+    metadata = {
+        'id': profile_id,
+        'mode': profile['mode'],
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule else None,
+        'path': request.full_path,
+        'status': status,
+        'duration_ms': round(profile['duration'] * 1000, 3),
+        'created_at': time.time(),
+    }
+    if profile['mode'] == 'cprofile':
+        profile['profiler'].dump_stats(
+            profile_path(directory, profile_id, 'pstats'))
+        metadata['format'] = 'pstats'
+    else:
+        with open(profile_path(directory, profile_id, 'collapsed'), 'w') as f:
+            f.write(format_collapsed(profile['stacks']))
+        metadata['format'] = 'collapsed'
+
+    with open(profile_path(directory, profile_id, 'json'), 'w') as f:
+        json.dump(metadata, f)
+    return metadata
+
+
+def load_profile(directory, profile_id):
+    # Returns (metadata, path of the profile data) or None
+    if not PROFILE_ID.match(profile_id):
+        return None
+    try:
+        with open(profile_path(directory, profile_id, 'json')) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+    return metadata, profile_path(directory, profile_id, metadata['format'])
+
+
+class ContinuousProfiler:
+    '''
+    Low-rate sampling of every thread of this process, flushed to a
+    collapsed-stack file in the profile directory every flush_interval
+    seconds
+    '''
+
+    def __init__(self, directory, rate, flush_interval=60.0):
+        self.directory = directory
+        self.sampler = Sampler(interval=1.0 / rate)
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def flush(self):
+        stacks = self.sampler.drain()
+        if not stacks:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'continuous-{0}-{1}.collapsed'
+                            .format(self.pid, int(time.time())))
+        with open(path, 'w') as f:
+            f.write(format_collapsed(stacks))
+        return path
+
+    def run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        self.sampler.start()
+        self._thread = threading.Thread(
+            target=self.run, name='cms-profile-flush', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.sampler.stop()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+_continuous = None
+_continuous_lock = threading.Lock()
+
+
+def ensure_continuous_profiler(app):
+    # Starts one continuous profiler per process. Started on the first
+    # request rather than at import so it runs in each gunicorn worker and
+    # not in the preloading master.
+    global _continuous
+    if _continuous is not None and _continuous.pid == os.getpid():
+        return _continuous
+    with _continuous_lock:
+        if _continuous is None or _continuous.pid != os.getpid():
+            _continuous = ContinuousProfiler(
+                app.config['PROFILE_DIR'],
+                app.config['CONTINUOUS_PROFILING_RATE'],
+                app.config['CONTINUOUS_PROFILING_FLUSH']).start()
+    return _continuous
+
+
+def init_app(app):
+    # Registers on-demand profiling and, if a rate is configured, continuous
+    # sampling
+    app.config.setdefault('PROFILE_DIR', 'profiles')
+    app.config.setdefault('PROFILE_SAMPLE_INTERVAL', 0.001)
+    app.config.setdefault('CONTINUOUS_PROFILING_RATE', 0)
+    app.config.setdefault('CONTINUOUS_PROFILING_FLUSH', 60)
+
+    if app.config['CONTINUOUS_PROFILING_RATE'] > 0:
+        @app.before_request
+        def start_continuous_profiler():
+            ensure_continuous_profiler(app)
+
+    @app.after_request
+    def store_profile(response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        metadata = save_profile(profile, app.config['PROFILE_DIR'],
+                                response.status_code)
+        response.headers['X-Profile-Id'] = metadata['id']
+        response.headers['X-Profile-Format'] = metadata['format']
+        return response
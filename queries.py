@@ -0,0 +1,391 @@
+import base64
+import json
+import threading
+import time
+
+from sqlalchemy import and_, or_, tuple_, func, text
+
+from models import db, Student, Course, Grade
+from terms import current_term
+
+
+# Columns read by short() and long() on Student and Instructor. Read-only
+# endpoints select these directly so that SQLAlchemy returns plain Row tuples
+# instead of building ORM instances, tracking them in the identity map and
+# eager loading their relationships.
+SHORT_COLUMNS = ('id', 'name', 'email')
+LONG_COLUMNS = ('id', 'name', 'email', 'image_link')
+
+# Fields accepted by ?fields= on the student and instructor endpoints. List
+# and search endpoints accept the columns only; detail endpoints also accept
+# the related collection, which is only queried when it is requested.
+STUDENT_DETAIL_FIELDS = LONG_COLUMNS + ('grades',)
+INSTRUCTOR_DETAIL_FIELDS = LONG_COLUMNS + ('courses',)
+
+
+def parse_fields(value, allowed, default, name='fields'):
+    '''
+    parse_fields(value, allowed, default, name) method
+        @INPUTS
+                value: comma separated ?fields= value (or None)
+                allowed: fields accepted by the endpoint
+                default: fields returned when value is None
+                name: parameter name used in error messages
+    '''
+    # Raises ValueError with a client facing message on invalid input
+    if value is None:
+        return default
+
+    requested = [field.strip() for field in value.split(",")
+                 if field.strip()]
+    if len(requested) == 0:
+        raise ValueError('No {0} requested'.format(name))
+
+    invalid = [field for field in requested if field not in allowed]
+    if invalid:
+        raise ValueError('Invalid {0}: {1}'.format(name, ", ".join(invalid)))
+
+    return tuple(dict.fromkeys(requested))
+
+
+def parse_ids(value, limit):
+    '''
+    parse_ids(value, limit) method
+        @INPUTS
+                value: comma separated ?ids= value
+                limit: maximum number of ids
+    '''
+    # Returns the ids in request order (duplicates kept). Raises ValueError
+    # with a client facing message on invalid input
+    try:
+        ids = [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        raise ValueError('ids must be comma separated integers')
+    if len(ids) == 0:
+        raise ValueError('No ids requested')
+    if len(ids) > limit:
+        raise ValueError('At most {0} ids can be requested'.format(limit))
+    return ids
+
+
+def column_fields(fields):
+    # Returns the column names in fields; id is always selected
+    return ('id',) + tuple(
+        name for name in fields if name in LONG_COLUMNS and name != 'id')
+
+
+def select_columns(model, names=SHORT_COLUMNS):
+    # Returns a query over the named columns of model (no ORM hydration)
+    return db.session.query(*[getattr(model, name) for name in names])
+
+
+def format_rows(rows):
+    # Serializes Row tuples straight into response dicts
+    return [row._asdict() for row in rows]
+
+
+def format_row(row):
+    # Serializes a single Row tuple (or None) into a response dict
+    if row is None:
+        return None
+    return row._asdict()
+
+
+def current_grades(term=None):
+    # Condition selecting the grades of a term (default: the current one).
+    # Every grade query filters on the term, so Postgres only scans that
+    # term's partition.
+    return Grade.term == (term or current_term())
+
+
+def student_grades(student_id, versions=False):
+    # Returns the (course, score) rows of a student's transcript in one join,
+    # with each score's version when versions is set (coalescing overlay)
+    columns = [Course.title.label('course'), Grade.score]
+    if versions:
+        columns.append(Grade.score_version.label('version'))
+    return db.session.query(*columns).join(
+        Course, Grade.course_id == Course.id).filter(
+        current_grades(),
+        Grade.student_id == student_id).order_by(Grade.id).all()
+
+
+def instructor_courses(instructor_id):
+    # Returns the course titles taught by an instructor
+    return db.session.query(
+        Course.title.label('course')
+    ).filter(
+        Course.instructor_id == instructor_id).order_by(Course.id).all()
+
+
+def students_grades(student_ids, term=None, versions=False):
+    # Returns {student id: [(course, score) rows]} for many students in one
+    # join (the batch counterpart of student_grades)
+    grades = {student_id: [] for student_id in student_ids}
+    for row in db.session.query(
+            Grade.student_id, Course.title.label('course'), Grade.score,
+            Grade.score_version
+    ).join(Course, Grade.course_id == Course.id).filter(
+            current_grades(term),
+            Grade.student_id.in_(student_ids)).order_by(Grade.id):
+        grade = {'course': row.course, 'score': row.score}
+        if versions:
+            grade['version'] = row.score_version
+        grades[row.student_id].append(grade)
+    return grades
+
+
+def scored_grades(student_ids=None, term=None):
+    # Returns the query of the (student_id, course_id, score) rows of a
+    # term's scored enrollments, or of those of some students (the
+    # gradebook's bulk load and patches)
+    query = db.session.query(
+        Grade.student_id, Grade.course_id, Grade.score
+    ).filter(current_grades(term), Grade.score.isnot(None))
+    if student_ids is not None:
+        query = query.filter(Grade.student_id.in_(student_ids))
+    return query
+
+
+def instructors_courses(instructor_ids):
+    # Returns {instructor id: [course rows]} for many instructors in one
+    # query (the batch counterpart of instructor_courses)
+    courses = {instructor_id: [] for instructor_id in instructor_ids}
+    for row in db.session.query(
+            Course.instructor_id, Course.title.label('course')
+    ).filter(
+            Course.instructor_id.in_(instructor_ids)).order_by(Course.id):
+        courses[row.instructor_id].append({'course': row.course})
+    return courses
+
+
+def instructor_dashboard(instructor_id):
+    # Returns enrollment and score aggregates for each course taught by an
+    # instructor, from one GROUP BY over course and grade. Courses without
+    # students are kept (outer join) with zero counts.
+    enrolled = func.count(Grade.id)
+    graded = func.count(Grade.score)
+    return db.session.query(
+        Course.id,
+        Course.title.label('course'),
+        enrolled.label('enrolled'),
+        graded.label('graded'),
+        (enrolled - graded).label('ungraded'),
+        func.round(func.avg(Grade.score), 2).label('average_score')
+    ).outerjoin(Grade, and_(Grade.course_id == Course.id,
+                            current_grades())).filter(
+        Course.instructor_id == instructor_id).group_by(
+        Course.id, Course.title).order_by(Course.id).all()
+
+
+# Orders accepted by ?sort= on the course roster ('-' sorts descending).
+# Students without a score are always listed last.
+ROSTER_SORTS = ('name', '-name', 'score', '-score')
+
+
+def encode_cursor(values):
+    # Opaque keyset cursor holding the sort key values of a page's last row
+    return base64.urlsafe_b64encode(
+        json.dumps(values, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(value, types):
+    # Returns the values of a cursor, checked against types. Raises
+    # ValueError with a client facing message on invalid input
+    try:
+        values = json.loads(base64.urlsafe_b64decode(value.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(types) or not all(
+            isinstance(value, kind) and not isinstance(value, bool)
+            for value, kind in zip(values, types)):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def course_roster(course_id, sort='name', after=None, limit=10):
+    '''
+    course_roster(course_id, sort, after, limit) method
+        @INPUTS
+                course_id: course ID
+                sort: one of ROSTER_SORTS
+                after: cursor of the previous page's last row (or None)
+                limit: page size
+    '''
+    # Returns (rows, next cursor). Keyset pagination: each page seeks past
+    # the previous one's last (sort key, student id) instead of skipping
+    # rows with OFFSET, so every page costs the same and only `limit` rows
+    # leave the database.
+    descending = sort.startswith('-')
+    by_score = sort.lstrip('-') == 'score'
+    key = Grade.score if by_score else Student.name
+    student_id = Grade.student_id
+
+    def past(column, value):
+        return column < value if descending else column > value
+
+    def ordered(column):
+        return column.desc() if descending else column.asc()
+
+    query = db.session.query(
+        student_id.label('id'), Student.name, Grade.score
+    ).join(Student, Student.id == student_id).filter(
+        current_grades(), Grade.course_id == course_id)
+
+    if after is not None and by_score:
+        # Scores are nullable: graded rows come first, then ungraded ones
+        score, last_id = decode_cursor(after, ((int, type(None)), int))
+        if score is None:
+            query = query.filter(key.is_(None), past(student_id, last_id))
+        else:
+            query = query.filter(or_(
+                past(key, score),
+                and_(key == score, past(student_id, last_id)),
+                key.is_(None)))
+    elif after is not None:
+        name, last_id = decode_cursor(after, (str, int))
+        query = query.filter(
+            past(tuple_(Student.name, student_id), (name, last_id)))
+
+    rows = query.order_by(ordered(key).nulls_last(), ordered(student_id)) \
+        .limit(limit + 1).all()
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([last.score if by_score else last.name,
+                                last.id])
+
+
+# Single-statement writes for enrollments in the current term. Each is one
+# round trip whose RETURNING row tells success apart from a missing course
+# or enrollment.
+# Written as SQL text because SQLAlchemy 1.4 only compiles RETURNING for
+# Postgres; the same statements run on SQLite 3.35+.
+COURSE_BY_TITLE = 'SELECT id FROM course WHERE lower(title) = lower(:course)'
+RETURNING_COURSE = (
+    'RETURNING course_id, '
+    '(SELECT title FROM course WHERE course.id = grade.course_id) AS title, '
+    '(SELECT instructor_id FROM course WHERE course.id = grade.course_id) '
+    'AS instructor_id')
+
+# A new enrollment takes a fresh version, so score writes logged for an
+# earlier enrollment in the same course are never applied to it
+ENROLL = text(
+    'INSERT INTO grade (student_id, course_id, term, score_version) '
+    'SELECT student.id, course.id, :term, :version FROM student, course '
+    'WHERE student.id = :student_id AND lower(course.title) = lower(:course) '
+    'ON CONFLICT DO NOTHING ' + RETURNING_COURSE)
+# A score committed with a later version (a coalesced write flushed first)
+# is kept: this write is ordered before it
+UPDATE_SCORE = text(
+    'UPDATE grade SET '
+    'score = CASE WHEN score_version < :version THEN :score ELSE score END, '
+    'score_version = CASE WHEN score_version < :version THEN :version '
+    'ELSE score_version END '
+    'WHERE term = :term AND student_id = :student_id '
+    'AND course_id = (' + COURSE_BY_TITLE + ') ' + RETURNING_COURSE)
+UNENROLL = text(
+    'DELETE FROM grade '
+    'WHERE term = :term AND student_id = :student_id '
+    'AND course_id = (' + COURSE_BY_TITLE + ') ' + RETURNING_COURSE)
+
+
+def enroll_student(student_id, course):
+    # Returns the (course_id, title, instructor_id) row of the new
+    # enrollment, or None if the student or course doesn't exist or the
+    # student is already enrolled (see enrollment_failure)
+    return db.session.execute(ENROLL, {
+        'student_id': student_id, 'course': course,
+        'term': current_term(), 'version': next_score_version()}).first()
+
+
+def enrollment_failure(student_id, course):
+    # Tells why enroll_student returned no row (only run on that path):
+    # 'course', 'student' or 'enrolled'
+    row = db.session.execute(text(
+        'SELECT (' + COURSE_BY_TITLE + ') AS course_id, '
+        '(SELECT id FROM student WHERE id = :student_id) AS student_id'),
+        {'student_id': student_id, 'course': course}).first()
+    if row.course_id is None:
+        return 'course'
+    if row.student_id is None:
+        return 'student'
+    return 'enrolled'
+
+
+def update_score(student_id, course, score):
+    # Returns the updated enrollment's course row, or None if the student
+    # isn't enrolled in the course
+    return db.session.execute(UPDATE_SCORE, {
+        'student_id': student_id, 'course': course, 'score': score,
+        'term': current_term(), 'version': next_score_version()}).first()
+
+
+def unenroll_student(student_id, course):
+    # Returns the deleted enrollment's course row, or None if the student
+    # isn't enrolled in the course
+    return db.session.execute(UNENROLL, {
+        'student_id': student_id, 'course': course,
+        'term': current_term()}).first()
+
+
+def find_enrollment(student_id, course):
+    # Returns the (course_id, title, instructor_id) row of a student's
+    # current enrollment in a course, or None
+    return db.session.query(
+        Grade.course_id, Course.title, Course.instructor_id
+    ).join(Course, Grade.course_id == Course.id).filter(
+        current_grades(), Grade.student_id == student_id,
+        func.lower(Course.title) == func.lower(course)).first()
+
+
+_last_version = 0
+_version_lock = threading.Lock()
+
+
+def next_score_version():
+    # Orders score writes across workers and processes: the version is
+    # taken when a write is accepted and stored with its score. Postgres
+    # hands them out from a sequence; SQLite (tests, a single host) has no
+    # sequences and uses the clock, never repeating a version.
+    global _last_version
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(text(
+            "SELECT nextval('grade_score_version_seq')")).scalar()
+    with _version_lock:
+        _last_version = max(time.time_ns(), _last_version + 1)
+        return _last_version
+
+
+def apply_scores(scores):
+    '''
+    apply_scores(scores) method
+        @INPUTS
+                scores: [{'term', 'student_id', 'course_id', 'score',
+                        'version'}], at most one per enrollment
+    '''
+    # Sets many scores with one UPDATE ... FROM (VALUES ...) statement
+    # (Postgres, SQLite 3.33+) instead of a round trip per row. A score is
+    # only applied over an older version, so a write flushed late never
+    # overwrites a later one. Returns the number of rows updated;
+    # unenrolled students' and outdated scores are dropped.
+    values, params = [], {}
+    for index, score in enumerate(scores):
+        values.append(
+            '(CAST(:t{0} AS VARCHAR), CAST(:s{0} AS INTEGER), '
+            'CAST(:c{0} AS INTEGER), CAST(:v{0} AS INTEGER), '
+            'CAST(:n{0} AS BIGINT))'.format(index))
+        params.update({'t{0}'.format(index): score['term'],
+                       's{0}'.format(index): score['student_id'],
+                       'c{0}'.format(index): score['course_id'],
+                       'v{0}'.format(index): score['score'],
+                       'n{0}'.format(index): score['version']})
+    # Both name the VALUES columns column1 (term) to column5 (version)
+    return db.session.execute(text(
+        'UPDATE grade SET score = new.column4, score_version = new.column5 '
+        'FROM (VALUES ' + ', '.join(values) + ') AS new '
+        'WHERE grade.term = new.column1 AND grade.student_id = new.column2 '
+        'AND grade.course_id = new.column3 '
+        'AND grade.score_version < new.column5'), params).rowcount
@@ -0,0 +1,181 @@
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from collections import Counter as Tally
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+N_PLUS_ONE = Counter(
+    'cms_query_audit_n_plus_one_total',
+    'Requests with a statement shape repeated N+1 style, by route.')
+SLOW_QUERIES = Counter(
+    'cms_query_audit_slow_queries_total',
+    'Statements over the slow query threshold, by route.')
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_whitespace = re.compile(r'\s+')
+_in_list = re.compile(r'\bIN \((?:[^()]|\([^()]*\))*\)', re.IGNORECASE)
+_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_savepoint = re.compile(r'^\s*(?:RELEASE |ROLLBACK TO )?SAVEPOINT\b',
+                        re.IGNORECASE)
+
+# Counters opened by count_queries(), per thread
+_local = threading.local()
+
+
+def statement_shape(statement):
+    # Normalizes a statement so that executions differing only in literal
+    # values or IN list length share one shape
+    shape = _whitespace.sub(' ', statement).strip()
+    shape = _in_list.sub('IN (...)', shape)
+    return _literal.sub('?', shape)
+
+
+def stack_summary(limit=6):
+    # Returns the innermost project frames (outside site-packages and this
+    # module) as "file:line in function" strings
+    frames = [
+        frame for frame in traceback.extract_stack()[:-1]
+        if frame.filename.startswith(PROJECT_ROOT)
+        and 'site-packages' not in frame.filename
+        and not frame.filename.endswith('query_audit.py')
+    ]
+    return ['{0}:{1} in {2}'.format(
+        os.path.relpath(frame.filename, PROJECT_ROOT), frame.lineno,
+        frame.name) for frame in frames[-limit:]]
+
+
+def route_label():
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return 'unmatched'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('cms_audit_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    starts = conn.info.get('cms_audit_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+
+    # SAVEPOINTs are transaction control (the test harness wraps every
+    # request in one), not queries
+    if not _savepoint.match(statement):
+        for counter in getattr(_local, 'counters', ()):
+            counter.statements.append(statement)
+
+    if not has_request_context():
+        return
+    audit = g.get('query_audit')
+    if audit is None:
+        return
+
+    # Keep where a shape was first repeated, for the N+1 report
+    shape = statement_shape(statement)
+    audit['shapes'][shape] += 1
+    if audit['shapes'][shape] == 2:
+        audit['stacks'][shape] = stack_summary()
+    if elapsed * 1000 >= audit['slow_query_ms']:
+        SLOW_QUERIES.inc(route=route_label())
+        logger.warning(
+            'Slow query (%.1f ms) on %s %s: %s\n  %s', elapsed * 1000,
+            request.method, route_label(), _whitespace.sub(' ', statement),
+            '\n  '.join(stack_summary()))
+
+
+def init_app(app):
+    # Registers the query audit mode (off unless QUERY_AUDIT_ENABLED)
+    app.config.setdefault('QUERY_AUDIT_ENABLED', False)
+    app.config.setdefault('SLOW_QUERY_MS', 100)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', 3)
+
+    @app.before_request
+    def start_audit():
+        if app.config['QUERY_AUDIT_ENABLED']:
+            g.query_audit = {
+                'slow_query_ms': app.config['SLOW_QUERY_MS'],
+                'shapes': Tally(),
+                'stacks': {},
+            }
+
+    @app.after_request
+    def report_audit(response):
+        audit = g.get('query_audit')
+        if audit is None:
+            return response
+
+        repeated = [
+            (shape, count) for shape, count in audit['shapes'].most_common()
+            if count >= app.config['N_PLUS_ONE_THRESHOLD']]
+        if repeated:
+            N_PLUS_ONE.inc(route=route_label())
+            for shape, count in repeated:
+                logger.warning(
+                    'N+1 suspected on %s %s: %d executions of %s\n  %s',
+                    request.method, route_label(), count, shape,
+                    '\n  '.join(audit['stacks'].get(shape, [])))
+        return response
+
+
+class count_queries:
+    '''
+    Context manager collecting the SQL statements run in its block on the
+    current thread
+
+        with count_queries() as queries:
+            client.get('/students/22001', headers=...)
+        assert len(queries) <= 2
+    '''
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        if not hasattr(_local, 'counters'):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _local.counters.remove(self)
+        return False
+
+
+class assert_max_queries(count_queries):
+    '''
+    Context manager failing with AssertionError when its block runs more
+    than max_queries SQL statements (test helper)
+    '''
+
+    def __init__(self, max_queries):
+        super().__init__()
+        self.max_queries = max_queries
+
+    def __exit__(self, exc_type, *exc):
+        super().__exit__(exc_type, *exc)
+        if exc_type is None and len(self) > self.max_queries:
+            raise AssertionError(
+                '{0} queries executed, expected at most {1}:\n{2}'.format(
+                    len(self), self.max_queries, '\n'.join(
+                        '  ' + statement_shape(statement)
+                        for statement in self.statements)))
+        return False
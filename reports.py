@@ -0,0 +1,533 @@
+'''
+Report jobs: report cards and course grade sheets (of the current term) as
+CSV or PDF.
+
+POST /reports queues a job as a report_job row. The report worker, a
+separate process (the Procfile's worker entry):
+    python reports.py [--once]
+
+claims queued jobs with SELECT ... FOR UPDATE SKIP LOCKED, so several
+workers never build the same report, reads the data in pages of
+REPORT_CHUNK_SIZE students (two set-based queries per page) and renders the
+pages across a ProcessPoolExecutor of REPORT_PROCESSES processes. While it
+builds a report, a thread renews the job's lease (heartbeat_at), so only
+the jobs of a worker that died are claimed again. The
+finished file is stored on the job row (dynos don't share a filesystem) and
+downloaded with GET /reports/<id>?format=raw. Web requests only insert and
+read job rows.
+'''
+import argparse
+import collections
+import csv
+import datetime
+import io
+import json
+import logging
+import os
+import signal
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from sqlalchemy import and_, or_, tuple_
+
+from models import db, Student, Course, Grade, ReportJob
+from queries import students_grades, current_grades
+from terms import current_term, check_term
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('report_cards', 'course_grades')
+FORMATS = ('csv', 'pdf')
+CONTENT_TYPES = {'csv': 'text/csv', 'pdf': 'application/pdf'}
+
+# CSV columns of each report kind
+COLUMNS = {
+    'report_cards': ('student_id', 'student', 'email', 'course', 'score'),
+    'course_grades': ('course_id', 'course', 'student_id', 'student',
+                      'score'),
+}
+
+CHUNK_SIZE = 500
+# Chunks submitted to the process pool and not yet collected
+PENDING_CHUNKS = 8
+# Running jobs whose lease wasn't renewed for this long (their worker died)
+# are claimed again. The lease is renewed every third of it.
+JOB_TIMEOUT = 600
+
+# Spreadsheets evaluate cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+# US Letter pages, in points
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+MARGIN = 54
+FONT_SIZE = 10
+LEADING = 14
+LINES_PER_PAGE = (PAGE_HEIGHT - 2 * MARGIN) // LEADING
+
+
+def parse_request(body):
+    '''
+    parse_request(body) method
+        @INPUTS
+                body: decoded POST /reports body
+    '''
+    # Returns (kind, output format, params). Raises ValueError with a client
+    # facing message on invalid input
+    if not isinstance(body, dict):
+        raise ValueError('A report kind is expected')
+    kind = body.get('kind')
+    if kind not in KINDS:
+        raise ValueError('kind must be one of: ' + ', '.join(KINDS))
+    output_format = body.get('format', 'csv')
+    if output_format not in FORMATS:
+        raise ValueError('format must be one of: ' + ', '.join(FORMATS))
+
+    # Jobs keep the term they were queued in
+    params = {'term': body.get('term') or current_term()}
+    check_term(params['term'])
+    course_id = body.get('course_id')
+    if course_id is not None:
+        if not isinstance(course_id, int) or isinstance(course_id, bool):
+            raise ValueError('course_id must be an integer')
+        params['course_id'] = course_id
+    return kind, output_format, params
+
+
+def enqueue(kind, output_format, params):
+    # Queues a report job and returns it
+    job = ReportJob(kind, output_format, json.dumps(params, sort_keys=True),
+                    utcnow())
+    job.insert()
+    return job
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def filename(job):
+    # Download name of a finished report
+    return 'report-{0}-{1}.{2}'.format(job.id, job.kind, job.output_format)
+
+
+# ----------------------------------------------------------------------#
+# Data (runs in the worker, against the database)
+# ----------------------------------------------------------------------#
+
+def student_pages(term, course_id=None, size=CHUNK_SIZE):
+    # Yields pages of (id, name, email) student rows in name order, seeking
+    # past the previous page's last (name, id) like the course roster
+    query = db.session.query(Student.id, Student.name, Student.email)
+    if course_id is not None:
+        query = query.join(Grade, Grade.student_id == Student.id).filter(
+            current_grades(term), Grade.course_id == course_id)
+
+    after = None
+    while True:
+        page = query
+        if after is not None:
+            page = page.filter(tuple_(Student.name, Student.id) > after)
+        rows = page.order_by(Student.name, Student.id).limit(size).all()
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        after = (rows[-1].name, rows[-1].id)
+
+
+def report_card_chunks(term, course_id=None, size=CHUNK_SIZE):
+    # Yields lists of (student id, name, email, [(course, score)]) with the
+    # transcripts of a whole page from one join (students_grades)
+    for page in student_pages(term, course_id, size):
+        grades = students_grades([row.id for row in page], term)
+        yield [(row.id, row.name, row.email,
+                [(grade['course'], grade['score'])
+                 for grade in grades[row.id]])
+               for row in page]
+
+
+def course_grade_chunks(term, course_id=None, size=CHUNK_SIZE):
+    # Yields lists of (course id, title, student id, name, score) rows in
+    # course then student name order, streamed from a single query. Courses
+    # without students have one row with no student.
+    query = db.session.query(
+        Course.id, Course.title, Student.id, Student.name, Grade.score
+    ).outerjoin(Grade, and_(Grade.course_id == Course.id,
+                            current_grades(term))).outerjoin(
+        Student, Student.id == Grade.student_id)
+    if course_id is not None:
+        query = query.filter(Course.id == course_id)
+
+    chunk = []
+    for row in query.order_by(Course.title, Student.name).yield_per(size):
+        chunk.append(tuple(row))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+CHUNKS = {
+    'report_cards': report_card_chunks,
+    'course_grades': course_grade_chunks,
+}
+
+
+# ----------------------------------------------------------------------#
+# Rendering (runs in the process pool: plain tuples in, bytes out)
+# ----------------------------------------------------------------------#
+
+def csv_rows(kind, rows):
+    if kind == 'course_grades':
+        return rows
+    flat = []
+    for student_id, name, email, grades in rows:
+        for course, score in grades or [(None, None)]:
+            flat.append((student_id, name, email, course, score))
+    return flat
+
+
+def csv_cell(value):
+    # Text that a spreadsheet would run as a formula (CSV injection through
+    # a student name or course title) is prefixed with a quote
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_bytes(rows):
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerows(rows)
+    return out.getvalue().encode('utf-8')
+
+
+def render_csv(kind, rows):
+    return csv_bytes([[csv_cell(value) for value in row]
+                      for row in csv_rows(kind, rows)])
+
+
+def cell(value):
+    return '-' if value is None else str(value)
+
+
+def report_card_pages(rows):
+    # One page per student (more when the transcript doesn't fit)
+    pages = []
+    for student_id, name, email, grades in rows:
+        lines = ['Report card: {0}'.format(name),
+                 'Student #{0}  {1}'.format(student_id, cell(email)), '']
+        lines += ['{0:<60}{1:>6}'.format(course, cell(score))
+                  for course, score in grades] or ['No courses']
+        pages += paginate(lines, lines[0] + ' (continued)')
+    return pages
+
+
+def course_grade_pages(rows):
+    # Pages per course. A course split between chunks continues on a new
+    # page with its heading repeated.
+    pages = []
+    groups = collections.OrderedDict()
+    for course_id, title, student_id, name, score in rows:
+        lines = groups.setdefault((course_id, title), [])
+        if student_id is not None:
+            lines.append('{0:<60}{1:>6}'.format(name, cell(score)))
+    for (course_id, title), lines in groups.items():
+        heading = 'Grades: {0} (course #{1})'.format(title, course_id)
+        pages += paginate([heading, ''] + (lines or ['No students']),
+                          heading + ' (continued)')
+    return pages
+
+
+def paginate(lines, continued):
+    pages = [lines[:LINES_PER_PAGE]]
+    rest = lines[LINES_PER_PAGE:]
+    while rest:
+        size = LINES_PER_PAGE - 2
+        pages.append([continued, ''] + rest[:size])
+        rest = rest[size:]
+    return pages
+
+
+def pdf_string(line):
+    return line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def page_stream(lines):
+    # Compressed PDF content stream drawing lines of Courier text (fixed
+    # width, so the score column lines up)
+    commands = ['BT', '/F1 {0} Tf'.format(FONT_SIZE),
+                '{0} TL'.format(LEADING),
+                '{0} {1} Td'.format(MARGIN, PAGE_HEIGHT - MARGIN)]
+    commands += ['({0}) Tj T*'.format(pdf_string(line)) for line in lines]
+    commands.append('ET')
+    return zlib.compress(
+        '\n'.join(commands).encode('cp1252', 'replace'))
+
+
+def render_pdf_pages(kind, rows):
+    if kind == 'course_grades':
+        pages = course_grade_pages(rows)
+    else:
+        pages = report_card_pages(rows)
+    return [page_stream(lines) for lines in pages]
+
+
+def render_chunk(kind, output_format, rows):
+    '''
+    render_chunk(kind, output_format, rows) method
+        @INPUTS
+                kind: one of KINDS
+                output_format: one of FORMATS
+                rows: a chunk from CHUNKS[kind]
+    '''
+    # Returns CSV bytes, or a list of PDF page content streams
+    if output_format == 'pdf':
+        return render_pdf_pages(kind, rows)
+    return render_csv(kind, rows)
+
+
+def assemble_pdf(streams):
+    # Writes a PDF document with one page per content stream
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [{0}] /Count {1} >>'.format(
+            ' '.join('{0} 0 R'.format(4 + 2 * index)
+                     for index in range(len(streams))),
+            len(streams)).encode(),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier '
+        b'/Encoding /WinAnsiEncoding >>',
+    ]
+    for index, stream in enumerate(streams):
+        objects.append((
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {0} {1}] '
+            '/Resources << /Font << /F1 3 0 R >> >> /Contents {2} 0 R >>'
+        ).format(PAGE_WIDTH, PAGE_HEIGHT, 5 + 2 * index).encode())
+        objects.append(
+            b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(stream)
+            + stream + b'\nendstream')
+
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+    xref = out.tell()
+    out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b'%010d 00000 n \n' % offset)
+    out.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+              % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+# ----------------------------------------------------------------------#
+# Worker
+# ----------------------------------------------------------------------#
+
+def build_report(job, executor, chunk_size=CHUNK_SIZE):
+    '''
+    build_report(job, executor, chunk_size) method
+        @INPUTS
+                job: the claimed ReportJob
+                executor: process pool rendering the chunks
+                chunk_size: students (or grade rows) per chunk
+    '''
+    # Returns the report file. The next chunk is read from the database
+    # while the pool renders the previous ones; at most PENDING_CHUNKS are
+    # held in memory.
+    params = json.loads(job.params)
+    chunks = CHUNKS[job.kind](params.get('term'), params.get('course_id'),
+                              chunk_size)
+    pending = collections.deque()
+    parts = []
+    for rows in chunks:
+        pending.append(executor.submit(
+            render_chunk, job.kind, job.output_format, rows))
+        if len(pending) >= PENDING_CHUNKS:
+            parts.append(pending.popleft().result())
+    parts.extend(future.result() for future in pending)
+
+    if job.output_format == 'pdf':
+        streams = [stream for part in parts for stream in part]
+        return assemble_pdf(streams or [page_stream(['No records'])])
+    return csv_bytes([COLUMNS[job.kind]]) + b''.join(parts)
+
+
+def claim_job(job_timeout=JOB_TIMEOUT):
+    # Marks the oldest queued job (or one whose lease expired) as running
+    # and returns it, or None. SKIP LOCKED lets concurrent workers pass over
+    # a row another worker is claiming instead of waiting for it (Postgres;
+    # SQLite has a single writer and ignores FOR UPDATE).
+    expired = utcnow() - datetime.timedelta(seconds=job_timeout)
+    job = db.session.query(ReportJob).filter(or_(
+        ReportJob.status == 'queued',
+        and_(ReportJob.status == 'running',
+             ReportJob.heartbeat_at < expired))
+    ).order_by(ReportJob.id).with_for_update(skip_locked=True).first()
+    if job is None:
+        return None
+    job.status = 'running'
+    job.started_at = job.heartbeat_at = utcnow()
+    # Identifies this claim: a worker whose lease expired and was claimed
+    # again can no longer renew it or store its result
+    job.attempt += 1
+    job.update()
+    return job
+
+
+def finish_job(job_id, attempt, values):
+    '''
+    finish_job(job_id, attempt, values) method
+        @INPUTS
+                job_id: report job ID
+                attempt: the job's attempt when this worker claimed it
+                values: {column: value} of the outcome (status, output...)
+    '''
+    # Stores the outcome unless the job was claimed again since. Returns
+    # whether it was stored.
+    stored = db.session.query(ReportJob).filter(
+        ReportJob.id == job_id, ReportJob.attempt == attempt
+    ).update(values, synchronize_session=False)
+    db.session.commit()
+    return stored == 1
+
+
+class Lease:
+    '''
+    Lease
+    Renews a running job's heartbeat from a thread (with its own session)
+    while the report is built, as long as the job is still this worker's
+    claim (attempt)
+    '''
+
+    def __init__(self, app, job_id, attempt, interval):
+        self.app = app
+        self.job_id = job_id
+        self.attempt = attempt
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def renew(self):
+        with self.app.app_context():
+            try:
+                db.session.query(ReportJob).filter(
+                    ReportJob.id == self.job_id,
+                    ReportJob.status == 'running',
+                    ReportJob.attempt == self.attempt
+                ).update({ReportJob.heartbeat_at: utcnow()},
+                         synchronize_session=False)
+                db.session.commit()
+            except Exception:
+                # Retried at the next interval; the lease only expires
+                # after three missed renewals
+                logger.exception('Renewing report job %s failed',
+                                 self.job_id)
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.renew()
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self.run, name='cms-report-lease', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def run_next(executor, chunk_size=CHUNK_SIZE, job_timeout=JOB_TIMEOUT):
+    '''
+    run_next(executor, chunk_size, job_timeout) method
+        @INPUTS
+                executor: process pool rendering the chunks
+                chunk_size: students (or grade rows) per chunk
+                job_timeout: seconds a running job's lease lasts unrenewed
+    '''
+    # Builds the next queued report. Returns the finished (done or failed)
+    # job, or None when the queue is empty. Needs an app context.
+    job = claim_job(job_timeout)
+    if job is None:
+        return None
+    job_id, attempt = job.id, job.attempt
+    lease = Lease(current_app._get_current_object(), job_id, attempt,
+                  job_timeout / 3)
+    try:
+        with lease:
+            output = build_report(job, executor, chunk_size)
+    except Exception as error:
+        logger.exception('Report job %s failed', job_id)
+        db.session.rollback()
+        values = {'status': 'failed',
+                  'error': str(error) or type(error).__name__}
+    else:
+        values = {'status': 'done', 'output': output,
+                  'output_size': len(output)}
+    values['finished_at'] = utcnow()
+
+    if not finish_job(job_id, attempt, values):
+        logger.warning('Report job %s was claimed again by another worker; '
+                       'this result is dropped', job_id)
+    elif values['status'] == 'done':
+        logger.info('Report job %s done (%d bytes)', job_id,
+                    values['output_size'])
+    return job
+
+
+def work(app, executor, poll_interval=1.0, chunk_size=CHUNK_SIZE,
+         job_timeout=JOB_TIMEOUT, stop=None, once=False):
+    # Builds queued reports until stop is set (or the queue is empty, with
+    # once), polling every poll_interval seconds while it is empty
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                job = run_next(executor, chunk_size, job_timeout)
+            finally:
+                db.session.remove()
+        if job is None:
+            if once:
+                return
+            stop.wait(poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Builds queued reports.')
+    parser.add_argument('--once', action='store_true',
+                        help='exit once the queue is empty')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from settings import get_settings
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    settings = get_settings()
+    app = create_app()
+
+    # Heroku sends SIGTERM on restarts; the current report is finished
+    # (or claimed again by another worker once its lease expires)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    processes = settings.report_processes or os.cpu_count()
+    with ProcessPoolExecutor(processes) as executor:
+        work(app, executor, settings.report_poll_interval,
+             settings.report_chunk_size, settings.report_job_timeout,
+             stop, args.once)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import os
+import threading
+
+
+def normalize_database_url(database_url):
+    # Heroku still hands out postgres:// URLs, which SQLAlchemy 1.4 rejects
+    if database_url and database_url.startswith("postgres://"):
+        return database_url.replace("postgres://", "postgresql://", 1)
+    return database_url
+
+
+class Settings:
+    '''
+    Settings
+    Configuration read once from the environment (and the .env file)
+    '''
+
+    def __init__(self, environ):
+        get = environ.get
+
+        # Database
+        self.database_url = normalize_database_url(get('DATABASE_URL'))
+        self.secret_key = get('SECRET_KEY')
+        self.current_term = get('CURRENT_TERM', 'initial')
+
+        # Auth0
+        self.auth0_domain = get('AUTH0_DOMAIN')
+        self.algorithms = get('ALGORITHMS')
+        self.api_audience = get('API_AUDIENCE')
+
+        # Identity provider client
+        self.jwks_url = get('JWKS_URL')
+        self.userinfo_url = get('USERINFO_URL')
+        self.idp_connect_timeout = float(get('IDP_CONNECT_TIMEOUT', 2))
+        self.idp_read_timeout = float(get('IDP_READ_TIMEOUT', 5))
+        self.idp_jwks_ttl = float(get('IDP_JWKS_TTL', 600))
+        self.idp_pool_size = int(get('IDP_POOL_SIZE', 10))
+        self.idp_failure_threshold = int(get('IDP_FAILURE_THRESHOLD', 5))
+        self.idp_reset_timeout = float(get('IDP_RESET_TIMEOUT', 30))
+
+        # Responses
+        self.json_backend = get('JSON_BACKEND', 'auto')
+        self.compress_min_size = int(get('COMPRESS_MIN_SIZE', 500))
+        self.compress_level = int(get('COMPRESS_LEVEL', 6))
+        self.compress_br_level = int(get('COMPRESS_BR_LEVEL', 4))
+
+        # Query audit (N+1 and slow query detection)
+        self.query_audit_enabled = \
+            get('QUERY_AUDIT_ENABLED', 'false').lower() == 'true'
+        self.slow_query_ms = float(get('SLOW_QUERY_MS', 100))
+        self.n_plus_one_threshold = int(get('N_PLUS_ONE_THRESHOLD', 3))
+
+        # Detail cache
+        self.detail_cache_enabled = \
+            get('DETAIL_CACHE_ENABLED', 'true').lower() == 'true'
+        self.detail_cache_max_entries = \
+            int(get('DETAIL_CACHE_MAX_ENTRIES', 10000))
+        self.detail_cache_max_bytes = \
+            int(get('DETAIL_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+        self.detail_cache_ttl = float(get('DETAIL_CACHE_TTL', 60))
+        self.cache_notify_enabled = \
+            get('CACHE_NOTIFY_ENABLED', 'true').lower() == 'true'
+
+        # Bearer token required by /metrics (open when unset)
+        self.metrics_token = get('METRICS_TOKEN')
+
+        # Profiling
+        self.profile_dir = get('PROFILE_DIR', 'profiles')
+        self.continuous_profiling_rate = \
+            float(get('CONTINUOUS_PROFILING_RATE', 0))
+        self.continuous_profiling_flush = \
+            float(get('CONTINUOUS_PROFILING_FLUSH', 60))
+
+        # Admission control
+        self.admission_enabled = \
+            get('ADMISSION_ENABLED', 'true').lower() == 'true'
+        self.admission_limits = get('ADMISSION_LIMITS')
+        self.admission_queue = get('ADMISSION_QUEUE')
+        self.admission_queue_timeout = \
+            float(get('ADMISSION_QUEUE_TIMEOUT', 5))
+        self.admission_retry_after = int(get('ADMISSION_RETRY_AFTER', 1))
+
+        # Score write coalescing
+        self.score_coalescing_enabled = \
+            get('SCORE_COALESCING_ENABLED', 'false').lower() == 'true'
+        self.score_wal_dir = get('SCORE_WAL_DIR', 'wal')
+        self.score_flush_interval = float(get('SCORE_FLUSH_INTERVAL', 0.5))
+        self.score_flush_max_rows = int(get('SCORE_FLUSH_MAX_ROWS', 500))
+
+        # Analytics gradebook
+        self.gradebook_max_age = float(get('GRADEBOOK_MAX_AGE', 300))
+        self.gradebook_patch_limit = int(get('GRADEBOOK_PATCH_LIMIT', 5000))
+
+        # Report worker
+        self.report_processes = int(get('REPORT_PROCESSES', 0))
+        self.report_chunk_size = int(get('REPORT_CHUNK_SIZE', 500))
+        self.report_poll_interval = float(get('REPORT_POLL_INTERVAL', 1))
+        self.report_job_timeout = float(get('REPORT_JOB_TIMEOUT', 600))
+
+        # Serving
+        self.warmup_connections = int(get('WARMUP_CONNECTIONS', 1))
+        self.async_pool_size = int(get('ASYNC_POOL_SIZE', 10))
+        self.async_max_overflow = int(get('ASYNC_MAX_OVERFLOW', 10))
+        self.async_auth_threads = int(get('ASYNC_AUTH_THREADS', 32))
+
+
+_settings = None
+_settings_lock = threading.Lock()
+
+
+def get_settings():
+    # Loads the .env file and reads the environment on first use only
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                from dotenv import load_dotenv
+
+                load_dotenv()
+                _settings = Settings(os.environ)
+    return _settings
+
+
+def reload_settings():
+    # Re-reads the environment (used by tests and benchmarks that change it)
+    global _settings
+    with _settings_lock:
+        _settings = None
+    return get_settings()
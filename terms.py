@@ -0,0 +1,143 @@
+'''
+Academic terms and the partitions of the grade table.
+
+Every enrollment (grade row) belongs to a term. Requests read and write the
+CURRENT_TERM only, so on Postgres, where grade is partitioned by LIST
+(term), their queries touch a single partition. There is no default
+partition: it would make DETACH ... CONCURRENTLY impossible and every new
+partition scan it under lock, so a row of a term without a partition is
+rejected.
+
+Partitions are managed with manage.py:
+    python manage.py create_term 2027-spring
+    python manage.py detach_term 2025-fall
+    python manage.py attach_term 2025-fall
+    python manage.py list_terms
+
+Create a term's partition before switching CURRENT_TERM to it (writes to
+the new term fail until then). A detached
+term stays in the database as a plain table (grade_2025_fall) that can be
+dumped and dropped, or attached again.
+'''
+import re
+
+from flask import current_app
+from sqlalchemy import text
+
+# Lowercase letters, digits and dashes, e.g. "2026-fall"
+TERM_PATTERN = re.compile(r'^[a-z0-9][a-z0-9-]{0,39}$')
+
+# Default partition created by the first partitioning migration and dropped
+# by the next one
+DEFAULT_PARTITION = 'grade_default'
+
+# Longest wait for the lock on grade taken by CREATE TABLE ... PARTITION OF.
+# A DDL statement waiting for its lock blocks every query queued behind it,
+# so it gives up instead (run it again later).
+LOCK_TIMEOUT = '5s'
+
+
+def current_term():
+    # Term of new enrollments and of every query that doesn't name one
+    return current_app.config['CURRENT_TERM']
+
+
+def check_term(term):
+    # Returns term, or raises ValueError when it is not a valid term name
+    if not isinstance(term, str) or not TERM_PATTERN.match(term):
+        raise ValueError('Invalid term: {0!r} (use lowercase letters, digits '
+                         'and dashes, e.g. 2026-fall)'.format(term))
+    return term
+
+
+def partition_name(term):
+    # Table holding the grades of a term, e.g. grade_2026_fall
+    return 'grade_' + check_term(term).replace('-', '_')
+
+
+def create_partition(connection, term):
+    '''
+    create_partition(connection, term) method
+        @INPUTS
+                connection: Postgres connection (in a transaction)
+                term: term name
+    '''
+    # Takes an ACCESS EXCLUSIVE lock on grade for an instant (there is no
+    # default partition to scan), waiting for it at most LOCK_TIMEOUT
+    table = partition_name(term)
+    connection.execute(text(
+        'SET LOCAL lock_timeout = \'{0}\''.format(LOCK_TIMEOUT)))
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS {0} PARTITION OF grade '
+        'FOR VALUES IN (\'{1}\')'.format(table, term)))
+
+
+def detach_partition(connection, term):
+    '''
+    detach_partition(connection, term) method
+        @INPUTS
+                connection: Postgres connection in autocommit mode
+                term: term name
+    '''
+    # DETACH ... CONCURRENTLY (Postgres 14+) only takes a SHARE UPDATE
+    # EXCLUSIVE lock on grade, so requests keep running while it waits for
+    # the transactions using the partition to finish. It can't run inside a
+    # transaction block, nor when grade has a default partition.
+    if term == current_term():
+        raise ValueError('The current term can\'t be detached')
+    default = default_partition(connection)
+    if default is not None:
+        raise ValueError('grade has a default partition ({0}), which '
+                         'DETACH ... CONCURRENTLY doesn\'t allow'.format(
+                             default))
+    connection.execute(text('ALTER TABLE grade DETACH PARTITION {0} '
+                            'CONCURRENTLY'.format(partition_name(term))))
+
+
+def attach_partition(connection, term):
+    '''
+    attach_partition(connection, term) method
+        @INPUTS
+                connection: Postgres connection in autocommit mode
+                term: term name
+    '''
+    # Re-attaches a detached term's table. The CHECK constraint is validated
+    # first (SHARE UPDATE EXCLUSIVE lock, reads and writes go on) so that
+    # ATTACH can skip its own scan of the table under a stronger lock.
+    table = partition_name(term)
+    constraint = table + '_term_check'
+    connection.execute(text(
+        'ALTER TABLE {0} ADD CONSTRAINT {1} CHECK (term = \'{2}\') '
+        'NOT VALID'.format(table, constraint, term)))
+    connection.execute(text('ALTER TABLE {0} VALIDATE CONSTRAINT {1}'.format(
+        table, constraint)))
+    connection.execute(text(
+        'ALTER TABLE grade ATTACH PARTITION {0} FOR VALUES IN (\'{1}\')'
+        .format(table, term)))
+    connection.execute(text('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(
+        table, constraint)))
+
+
+def default_partition(connection):
+    # Name of grade's default partition, or None
+    return connection.execute(text(
+        'SELECT NULLIF(partdefid, 0)::regclass::text '
+        'FROM pg_partitioned_table '
+        'WHERE partrelid = \'grade\'::regclass')).scalar()
+
+
+def list_partitions(connection):
+    # Returns the (partition, bounds) of grade, e.g.
+    # ('grade_2026_fall', "FOR VALUES IN ('2026-fall')")
+    return connection.execute(text(
+        'SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) '
+        'FROM pg_inherits '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'WHERE pg_inherits.inhparent = \'grade\'::regclass '
+        'ORDER BY child.relname')).fetchall()
+
+
+def init_app(app):
+    # Checks CURRENT_TERM once at start up
+    app.config.setdefault('CURRENT_TERM', 'initial')
+    check_term(app.config['CURRENT_TERM'])
@@ -0,0 +1,105 @@
+import logging
+import time
+
+from sqlalchemy import text
+from sqlalchemy.orm import configure_mappers
+
+from models import db, Student, Instructor
+from identity_provider import get_client, reset_client, IdentityProviderError
+from queries import (select_columns, student_grades, instructor_courses,
+                     LONG_COLUMNS)
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+def reset_connections(app):
+    '''
+    reset_connections(app) method
+        @INPUTS
+                app: flask app loaded in the gunicorn master (preload_app)
+    '''
+    # Connections and sessions created before fork belong to the master and
+    # must not be shared with the workers
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    reset_client()
+
+
+def warm_pool(connections):
+    # Opens `connections` pooled connections up front so the first requests
+    # don't pay for connection setup
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(db.engine.connect())
+        for connection in opened:
+            connection.execute(text('SELECT 1'))
+    finally:
+        for connection in opened:
+            connection.close()
+
+
+def warm_statements():
+    # Runs the hot read statements once so SQLAlchemy compiles and caches
+    # them before the first real request
+    select_columns(Student).order_by(Student.name, Student.id).limit(1).all()
+    select_columns(Instructor).order_by(
+        Instructor.name, Instructor.id).limit(1).all()
+    select_columns(Student, LONG_COLUMNS).filter(
+        Student.id == 0).one_or_none()
+    select_columns(Instructor, LONG_COLUMNS).filter(
+        Instructor.id == 0).one_or_none()
+    student_grades(0)
+    instructor_courses(0)
+    db.session.query(db.func.count(Student.id)).scalar()
+    db.session.query(db.func.count(Instructor.id)).scalar()
+
+
+def warm_up(app, connections=None):
+    '''
+    warm_up(app, connections) method
+        @INPUTS
+                app: flask app
+                connections: pooled connections to open (default
+                             WARMUP_CONNECTIONS or 1)
+    '''
+    # Warms up one worker before it accepts traffic: mapper configuration,
+    # the connection pool, the hot statements and the JWKS keys. Each step
+    # is best effort; a failure is logged and the worker still starts.
+    if connections is None:
+        connections = get_settings().warmup_connections
+    timings = {}
+
+    start = time.perf_counter()
+    configure_mappers()
+    timings['mappers'] = time.perf_counter() - start
+
+    with app.app_context():
+        start = time.perf_counter()
+        try:
+            warm_pool(connections)
+            warm_statements()
+        except Exception:
+            logger.exception('Database warm-up failed')
+        finally:
+            db.session.remove()
+        timings['database'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        get_client().get_jwks()
+    except IdentityProviderError:
+        logger.warning('JWKS warm-up failed; keys will be fetched lazily')
+    timings['jwks'] = time.perf_counter() - start
+
+    return timings
+
+
+def format_timings(timings):
+    # Formats warm_up() timings for the logs
+    return '{0:.1f} ms ({1})'.format(
+        sum(timings.values()) * 1000,
+        ', '.join('{0} {1:.1f} ms'.format(name, seconds * 1000)
+                  for name, seconds in timings.items()))